@@ -1,4 +1,5 @@
 import sys
+import os
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
@@ -18,9 +19,20 @@ names = [
     'pyspades.mapmaker'
 ]
 
+# set PYSPADES_OPENMP=1 to build with OpenMP, which lets the batched ray
+# queries in pyspades.world and the classic map generator run on several
+# threads
+compile_args = link_args = []
+if os.environ.get('PYSPADES_OPENMP') == '1':
+    if sys.platform == 'win32':
+        compile_args = ['/openmp']
+    else:
+        compile_args = link_args = ['-fopenmp']
+
 for name in names:
     ext_modules.append(Extension(name, ['./%s.pyx' % name.replace('.', '/')],
-        language = 'c++', include_dirs=['./pyspades', './include']))
+        language = 'c++', include_dirs=['./pyspades', './include'],
+        extra_compile_args = compile_args, extra_link_args = link_args))
 
 setup(
     name = 'pyspades extensions',
@@ -86,7 +86,6 @@ HEAD_RADIUS = 0.7
 FOG_DISTANCE = 135.0
 
 # Don't touch any of this stuff
-FOG_DISTANCE2 = FOG_DISTANCE**2
 NEAR_MISS_COS = cos(NEAR_MISS_ANGLE * (pi/180.0))
 HEADSHOT_SNAP_ANGLE_COS = cos(HEADSHOT_SNAP_ANGLE * (pi/180.0))
 
@@ -95,12 +94,6 @@ aimbot_pattern = re.compile(".*(aim|bot|ha(ck|x)|cheat).*", re.IGNORECASE)
 def aimbot_match(msg):
     return (not aimbot_pattern.match(msg) is None)
 
-def point_distance2(c1, c2):
-    if c1.world_object is not None and c2.world_object is not None:
-        p1 = c1.world_object.position
-        p2 = c2.world_object.position
-        return (p1.x - p2.x)**2 + (p1.y - p2.y)**2 + (p1.z - p2.z)**2
-
 def dot3d(v1, v2):
     return v1[0] * v2[0] + v1[1] * v2[1] + v1[2] * v2[2]
 
@@ -251,8 +244,11 @@ def apply_script(protocol, connection, config):
             if self.tool == WEAPON_TOOL:
                 if shoot and not self.bullet_loop.running:
                     self.possible_targets = []
-                    for enemy in self.team.other.get_players():
-                        if point_distance2(self, enemy) <= FOG_DISTANCE2:
+                    world = self.protocol.world
+                    for character in world.players_in_radius(
+                        self.world_object.position, FOG_DISTANCE):
+                        enemy = character.owner
+                        if enemy is not None and enemy.team is self.team.other:
                             self.possible_targets.append(enemy)
                     self.bullet_loop_start(self.weapon_object.delay)
                 elif not shoot:
@@ -0,0 +1,63 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Times the classic map generator for a few seeds on different numbers of
+threads, and checks that every thread count generates the same maps.
+
+Usage: classicgen_benchmark.py [max threads] [seeds]
+
+Threads are only used when pyspades is built with PYSPADES_OPENMP=1.
+"""
+
+import sys
+import time
+import hashlib
+from pyspades.mapmaker import generate_classic
+
+SEEDS = [0, 1, 1234, 31337, 65535]
+
+def main():
+    max_threads = 4
+    seeds = SEEDS
+    if len(sys.argv) > 1:
+        max_threads = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        seeds = [int(value) for value in sys.argv[2].split(',')]
+    thread_counts = [1]
+    while thread_counts[-1] * 2 <= max_threads:
+        thread_counts.append(thread_counts[-1] * 2)
+    if thread_counts[-1] != max_threads:
+        thread_counts.append(max_threads)
+    digests = {}
+    print '%-12s %s' % ('seed', ''.join('%10s' % ('%s thr.' % count)
+        for count in thread_counts))
+    for seed in seeds:
+        times = []
+        for count in thread_counts:
+            start = time.time()
+            map = generate_classic(seed, count)
+            times.append(time.time() - start)
+            digest = hashlib.md5(map.generate()).hexdigest()
+            if digests.setdefault(seed, digest) != digest:
+                print 'seed %s differs on %s threads!' % (seed, count)
+                sys.exit(1)
+        print '%-12s %s' % (seed, ''.join('%9.3fs' % value
+            for value in times))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logging that never blocks the reactor.
+
+AsyncLogObserver only puts the formatted record on a bounded queue, and a
+writer thread does the actual writing. When the output can't keep up and
+the queue is full, records are dropped and counted instead of stalling the
+game. Keyword arguments given to log.msg are kept as fields, and are written
+out with structured (JSON lines) output.
+
+RateLimiter limits how often a message can be logged for the same key, for
+messages that clients can trigger at will.
+"""
+
+from twisted.python import log
+import sys
+import time
+import json
+import threading
+import Queue
+
+DEFAULT_QUEUE_SIZE = 10000
+BATCH_SIZE = 256
+CLOSE_TIMEOUT = 5.0
+LIMIT_INTERVAL = 10.0
+MAX_LIMIT_KEYS = 10000
+
+STOP = object()
+
+FIELD_TYPES = (basestring, int, long, float, bool, type(None))
+IGNORED_FIELDS = set(['message', 'format', 'system', 'time', 'isError',
+    'printed', 'why', 'failure'])
+
+def get_fields(event):
+    fields = {}
+    for key, value in event.iteritems():
+        if key in IGNORED_FIELDS or key.startswith('log_'):
+            continue
+        if isinstance(value, FIELD_TYPES):
+            fields[key] = value
+    return fields
+
+class AsyncLogObserver(object):
+    dropped = 0
+    thread = None
+
+    def __init__(self, output, structured = False,
+                 queue_size = DEFAULT_QUEUE_SIZE):
+        self.output = output
+        self.structured = structured
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        # only used for its time formatting, so the text output matches the
+        # usual Twisted log files
+        self.formatter = log.FileLogObserver(output)
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, event):
+        text = log.textFromEventDict(event)
+        if text is None:
+            return
+        fields = None
+        if self.structured:
+            fields = get_fields(event)
+        record = (event['time'], event.get('system', '-'), text,
+            bool(event.get('isError', False)), fields)
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def close(self):
+        """
+        Writes the queued records and stops the writer thread, giving up
+        after CLOSE_TIMEOUT seconds
+        """
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(STOP, timeout = CLOSE_TIMEOUT)
+        except Queue.Full:
+            return
+        self.thread.join(CLOSE_TIMEOUT)
+        self.thread = None
+
+    # writer thread
+
+    def format_record(self, record):
+        when, system, text, is_error, fields = record
+        if self.structured:
+            value = {'time' : when, 'system' : system, 'message' : text,
+                'isError' : is_error}
+            value.update(fields)
+            return json.dumps(value) + '\n'
+        text = text.replace('\n', '\n\t')
+        return '%s [%s] %s\n' % (self.formatter.formatTime(when), system,
+            text)
+
+    def run(self):
+        queue = self.queue
+        stopped = False
+        while not stopped:
+            records = [queue.get()]
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if records[-1] is STOP:
+                records.pop()
+                stopped = True
+            with self.lock:
+                dropped = self.dropped
+                self.dropped = 0
+            lines = [self.format_record(record) for record in records]
+            if dropped:
+                lines.append(self.format_record((time.time(), '-',
+                    '(%s log messages dropped)' % dropped, True, {})))
+            try:
+                self.output.write(''.join(lines))
+                self.output.flush()
+            except (IOError, OSError), e:
+                sys.__stderr__.write('Could not write log: %s\n' % e)
+
+class RateLimiter(object):
+    """
+    Logs a message for the same key at most once every interval seconds,
+    and adds the number of messages suppressed in between to the next one
+    """
+    def __init__(self, interval = LIMIT_INTERVAL):
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+
+    def msg(self, key, message, **kw):
+        current_time = time.time()
+        last = self.last.get(key, None)
+        if last is not None and current_time - last < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        if len(self.last) >= MAX_LIMIT_KEYS:
+            self.prune(current_time)
+            if len(self.last) >= MAX_LIMIT_KEYS:
+                self.last.clear()
+                self.suppressed.clear()
+        self.last[key] = current_time
+        count = self.suppressed.pop(key, 0)
+        if count:
+            message += ' (%s similar messages suppressed)' % count
+            kw['suppressed'] = count
+        log.msg(message, **kw)
+        return True
+
+    def prune(self, current_time):
+        for key, last in self.last.items():
+            if current_time - last >= self.interval:
+                del self.last[key]
+                self.suppressed.pop(key, None)
@@ -0,0 +1,235 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Ban persistence through an append-only journal.
+
+Changes to the ban list are appended to the journal by a writer thread, which
+also keeps its own copy of the list and periodically compacts it into the
+snapshot (bans.txt, in the usual format) and starts a new journal. The first
+line of the journal holds the hash of the snapshot it applies to, so a
+journal that was already compacted into the snapshot is never replayed.
+"""
+
+from networkdict import NetworkDict
+import os
+import json
+import time
+import hashlib
+import threading
+import Queue
+
+COMPACT_INTERVAL = 5 * 60 # 5 minutes
+COMPACT_RECORDS = 1000
+
+STOP = object()
+
+def read_file(filename):
+    try:
+        fp = open(filename, 'rb')
+    except IOError:
+        return ''
+    data = fp.read()
+    fp.close()
+    return data
+
+def write_file(filename, data):
+    temp = filename + '.tmp'
+    fp = open(temp, 'wb')
+    fp.write(data)
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+    if os.path.isfile(filename):
+        os.remove(filename)
+    os.rename(temp, filename)
+
+def get_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def get_ban_expiry(ban):
+    name, reason, timestamp = ban
+    return timestamp
+
+def apply_record(bans, record):
+    action = record[0]
+    if action == 'add':
+        bans[record[1]] = record[2]
+    elif action == 'remove':
+        bans.remove(record[1])
+    elif action == 'pop':
+        # older journals don't name the network that was removed
+        if len(record) > 1:
+            bans.remove_network(record[1])
+        else:
+            bans.pop()
+    elif action == 'expire':
+        bans.remove_expired(record[1])
+    else:
+        raise ValueError('invalid journal record: %r' % (record,))
+
+class BanJournal(object):
+    thread = None
+    records = 0
+
+    def __init__(self, filename, journal_filename = None):
+        self.filename = filename
+        self.journal_filename = journal_filename or filename + '.journal'
+        self.queue = Queue.Queue()
+
+    def load(self, bans):
+        """
+        Loads the snapshot and journal into the given NetworkDict, and starts
+        writing changes to the journal
+        """
+        snapshot = read_file(self.filename)
+        mirror = NetworkDict(bans.get_expiry)
+        if snapshot:
+            bans.read_list(json.loads(snapshot))
+            mirror.read_list(json.loads(snapshot))
+        snapshot_hash = get_hash(snapshot)
+        records = self.read_journal(snapshot_hash)
+        if records is not None:
+            for record in records:
+                apply_record(bans, record)
+                apply_record(mirror, record)
+            self.records = len(records)
+        self.thread = threading.Thread(target = self.run, args = (mirror,
+            snapshot_hash, records is not None))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_journal(self, snapshot_hash):
+        """
+        Returns the records of the journal, or None if there is no journal
+        for the current snapshot
+        """
+        lines = read_file(self.journal_filename).splitlines()
+        if not lines:
+            return None
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or (
+                header.get('snapshot', None) != snapshot_hash):
+            if len(lines) > 1:
+                print 'Ignoring ban journal that does not match %s' % (
+                    self.filename)
+            return None
+        records = []
+        for line in lines[1:]:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # incomplete record from a crash, nothing after it was
+                # written
+                break
+        return records
+
+    # changes, called from the reactor thread
+
+    def add(self, ip, ban):
+        self.append(['add', ip, list(ban)])
+
+    def remove(self, ip):
+        self.append(['remove', ip])
+
+    def pop(self, ip):
+        self.append(['pop', ip])
+
+    def remove_expired(self, current_time):
+        self.append(['expire', current_time])
+
+    def append(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        """
+        Writes the remaining changes and compacts the journal
+        """
+        if self.thread is None:
+            return
+        self.queue.put(STOP)
+        self.thread.join()
+        self.thread = None
+
+    # writer thread
+
+    def run(self, bans, snapshot_hash, valid):
+        journal = None
+        try:
+            if valid:
+                journal = open(self.journal_filename, 'ab')
+            else:
+                journal = self.start_journal(snapshot_hash)
+        except (IOError, OSError), e:
+            print 'Could not open ban journal: %s' % e
+        last_compaction = time.time()
+        while 1:
+            try:
+                record = self.queue.get(timeout = COMPACT_INTERVAL)
+            except Queue.Empty:
+                record = None
+            if record is STOP:
+                break
+            if record is not None:
+                apply_record(bans, record)
+                self.records += 1
+                if journal is not None:
+                    journal = self.write_record(journal, record)
+            current_time = time.time()
+            # changes that could not be written to the journal are only
+            # kept in memory until the next compaction succeeds
+            if journal is None or self.records >= COMPACT_RECORDS or (
+                    self.records and
+                    current_time - last_compaction >= COMPACT_INTERVAL):
+                journal = self.compact(bans, journal)
+                last_compaction = current_time
+        if self.records or journal is None:
+            journal = self.compact(bans, journal)
+        if journal is not None:
+            journal.close()
+
+    def write_record(self, journal, record):
+        try:
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+            return journal
+        except (IOError, OSError), e:
+            print 'Could not write ban journal: %s' % e
+            journal.close()
+            return None
+
+    def start_journal(self, snapshot_hash):
+        write_file(self.journal_filename, json.dumps(
+            {'snapshot' : snapshot_hash}) + '\n')
+        return open(self.journal_filename, 'ab')
+
+    def compact(self, bans, journal):
+        if journal is not None:
+            journal.close()
+        try:
+            snapshot = json.dumps(bans.make_list())
+            write_file(self.filename, snapshot)
+            journal = self.start_journal(get_hash(snapshot))
+        except (IOError, OSError), e:
+            print 'Could not compact ban journal: %s' % e
+            return None
+        self.records = 0
+        return journal
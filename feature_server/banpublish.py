@@ -16,10 +16,11 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet import reactor
-from twisted.web import static, server
+from twisted.web import static, server, http
 from twisted.web.resource import Resource
 from string import Template
 import json
+import hashlib
 
 class PublishResource(Resource):
     def __init__(self, factory):
@@ -30,9 +31,38 @@ class PublishResource(Resource):
         return self
 
     def render_GET(self, request):
-        return self.factory.json_bans
+        factory = self.factory
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('etag', factory.etag)
+        request.setHeader('last-modified', http.datetimeToString(
+            factory.last_modified))
+        if is_cached(request, factory.etag, factory.last_modified):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return ''
+        return factory.json_bans
+
+def is_cached(request, etag, last_modified):
+    """
+    Checks the validators sent with a conditional request. If-None-Match
+    takes precedence over If-Modified-Since
+    """
+    tags = request.getHeader('if-none-match')
+    if tags is not None:
+        tags = [tag.strip() for tag in tags.split(',')]
+        return etag in tags or '*' in tags
+    since = request.getHeader('if-modified-since')
+    if since is not None:
+        try:
+            return http.stringToDatetime(since) >= int(last_modified)
+        except (ValueError, IndexError, KeyError):
+            return False
+    return False
 
 class PublishServer(object):
+    json_bans = None
+    etag = None
+    last_modified = None
+
     def __init__(self, protocol, config):
         self.protocol = protocol
         publish_resource = PublishResource(self)
@@ -45,4 +75,9 @@ class PublishServer(object):
         for network, (name, reason, timestamp) in self.protocol.bans.iteritems():
             if timestamp is None or reactor.seconds() < timestamp:
                 bans.append({"ip" : network, "reason" : reason})
-        self.json_bans = json.dumps(bans)
+        json_bans = json.dumps(bans)
+        if json_bans == self.json_bans:
+            return
+        self.json_bans = json_bans
+        self.etag = '"%s"' % hashlib.sha1(json_bans).hexdigest()
+        self.last_modified = reactor.seconds()
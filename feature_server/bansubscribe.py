@@ -1 +1 @@
-# Copyright (c) Mathias Kaerlev 2011-2012.# This file is part of pyspades.# pyspades is free software: you can redistribute it and/or modify# it under the terms of the GNU General Public License as published by# the Free Software Foundation, either version 3 of the License, or# (at your option) any later version.# pyspades is distributed in the hope that it will be useful,# but WITHOUT ANY WARRANTY; without even the implied warranty of# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the# GNU General Public License for more details.# You should have received a copy of the GNU General Public License# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.import jsonfrom twisted.web.client import getPagefrom twisted.internet.task import LoopingCallfrom twisted.internet.defer import DeferredListfrom networkdict import NetworkDictUPDATE_INTERVAL = 5 * 60 # every 5 minute# format is [{"ip" : "1.1.1.1", "reason : "blah"}, ...]class BanManager(object):    bans = None    new_bans = None    def __init__(self, protocol, config):        self.protocol = protocol        self.urls = [(str(item), filter) for (item, filter) in             config.get('urls', [])]        self.loop = LoopingCall(self.update_bans)        self.loop.start(UPDATE_INTERVAL, now = True)            def update_bans(self):        self.new_bans = NetworkDict()        defers = []        for url, filter in self.urls:            defers.append(self.protocol.getPage(url).addCallback(self.got_bans,                filter))        DeferredList(defers).addCallback(self.bans_finished)        def got_bans(self, data, filter):        bans = json.loads(data)        for entry in bans:            name = entry.get('name', None)            if name is not None and name in filter:                continue            self.new_bans[str(entry['ip'])] = str(entry['reason'])        def bans_finished(self, result):        self.bans = self.new_bans        self.new_bans = None            def get_ban(self, ip):        if self.bans is None:            return None        try:            return self.bans[ip]        except KeyError:            return None
\ No newline at end of file
+# Copyright (c) Mathias Kaerlev 2011-2012.# This file is part of pyspades.# pyspades is free software: you can redistribute it and/or modify# it under the terms of the GNU General Public License as published by# the Free Software Foundation, either version 3 of the License, or# (at your option) any later version.# pyspades is distributed in the hope that it will be useful,# but WITHOUT ANY WARRANTY; without even the implied warranty of# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the# GNU General Public License for more details.# You should have received a copy of the GNU General Public License# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.import jsonfrom twisted.internet import threadsfrom twisted.internet.task import LoopingCallfrom twisted.internet.defer import DeferredListfrom twisted.web.error import Errorfrom networkdict import NetworkDictUPDATE_INTERVAL = 5 * 60 # every 5 minute# format is [{"ip" : "1.1.1.1", "reason : "blah"}, ...]class BanSource(object):    """    A subscribed ban list. The list is fetched with the validators of the    last response, so unchanged lists aren't transferred or parsed again    """    etag = None    last_modified = None    data = None    entries = ()    def __init__(self, url, filter):        self.url = url        self.filter = filter    def get_headers(self):        headers = {}        if self.etag is not None:            headers['If-None-Match'] = self.etag        if self.last_modified is not None:            headers['If-Modified-Since'] = self.last_modified        return headers    def parse(self):        # called from a worker thread        entries = []        for entry in json.loads(self.data):            name = entry.get('name', None)            if name is not None and name in self.filter:                continue            entries.append((str(entry['ip']), str(entry['reason'])))        return entriesclass BanManager(object):    bans = None    updating = False    def __init__(self, protocol, config):        self.protocol = protocol        self.sources = [BanSource(str(item), filter) for (item, filter) in             config.get('urls', [])]        self.loop = LoopingCall(self.update_bans)        self.loop.start(UPDATE_INTERVAL, now = True)            def update_bans(self):        if self.updating:            return        self.updating = True        defers = []        for source in self.sources:            factory = self.protocol.getPageFactory(source.url,                headers = source.get_headers())            defers.append(factory.deferred.addCallbacks(self.got_bans,                self.got_error, callbackArgs = (source, factory),                errbackArgs = (source,)))        DeferredList(defers).addCallback(self.bans_finished)        def got_bans(self, data, source, factory):        headers = factory.response_headers or {}        source.etag = headers.get('etag', [None])[0]        source.last_modified = headers.get('last-modified', [None])[0]        source.data = data        return True    def got_error(self, failure, source):        if failure.check(Error) and failure.value.status == '304':            return False        # keep the last list we got from this source        print 'Could not update bans from %s: %s' % (source.url,            failure.getErrorMessage())        return False        def bans_finished(self, result):        if not any(changed for (success, changed) in result):            self.updating = False            return        threads.deferToThread(self.build_bans).addBoth(self.bans_built)    def build_bans(self):        # called from a worker thread. lists that changed are parsed, and the        # index is built from scratch, so it can simply replace the old one        bans = NetworkDict()        for source in self.sources:            if source.data is not None:                try:                    source.entries = source.parse()                except (ValueError, TypeError, KeyError, AttributeError), e:                    print 'Invalid ban list from %s: %s' % (source.url, e)                    source.etag = source.last_modified = None                source.data = None            for ip, reason in source.entries:                try:                    bans[ip] = reason                except ValueError:                    pass        return bans    def bans_built(self, result):        self.updating = False        if isinstance(result, NetworkDict):            self.bans = result        else:            result.printTraceback()            def get_ban(self, ip):        if self.bans is None:            return None        try:            return self.bans[ip]        except KeyError:            return None
\ No newline at end of file
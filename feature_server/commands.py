@@ -97,6 +97,15 @@ def join_arguments(arg, default = None):
         return default
     return ' '.join(arg)
 
+def send_result(connection, message):
+    # for commands that finish after they have returned
+    if hasattr(connection, 'send_chat'):
+        connection.send_chat(message)
+    elif hasattr(connection, 'send'):
+        connection.send(message)
+    else:
+        print message
+
 def parse_maps(pre_maps):
     maps = []
     for n in pre_maps:
@@ -824,6 +833,37 @@ def scripts(connection):
     scripts = connection.protocol.config.get('scripts', [])
     return 'Scripts enabled: %s' % (', '.join(scripts))
 
+@name('hookstats')
+@admin
+def hook_stats(connection, count = 5):
+    stats = connection.protocol.hooks.get_stats()[:int(count)]
+    if not stats:
+        return 'No script hooks are registered'
+    return ', '.join('%s.%s: %s calls, %.1f ms' % (item.script, item.event,
+        item.calls, item.time * 1000.0) for item in stats)
+
+@admin
+def profile(connection, duration = 10):
+    deferred = connection.protocol.profiler.start(float(duration))
+    if deferred is None:
+        return 'A profile is already running'
+    def profile_done(result):
+        message = 'Profile written to %s: %s' % (result.filename, ', '.join(
+            '%s %d%%' % (name, value * 100)
+            for (name, value) in result.get_summary()[:4]))
+        send_result(connection, message)
+    def profile_failed(failure):
+        send_result(connection, 'Profile failed: %s' % (
+            failure.getErrorMessage()))
+    deferred.addCallbacks(profile_done, profile_failed)
+    return 'Profiling for %s seconds...' % duration
+
+@admin
+def memory(connection):
+    usage = connection.protocol.get_memory_usage()
+    return ', '.join('%s: %s (%.1f MB)' % (name, count,
+        size / (1024.0 * 1024.0)) for (name, count, size) in usage)
+
 @admin
 def fog(connection, r, g, b):
     r = int(r)
@@ -897,6 +937,9 @@ command_list = [
     version,
     server_info,
     scripts,
+    hook_stats,
+    profile,
+    memory,
     weapon,
     mapname
 ]
@@ -0,0 +1,476 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+pyspades - server farm
+
+Runs several servers from the same config, each in its own worker process
+forked from this supervisor, so they can use separate cores. Configured
+through the farm section of config.txt:
+
+    "farm" : {
+        "workers" : 4,
+        "status_file" : "farm.json"
+    }
+
+workers is either the number of servers to run, or a list with the config
+overrides for every server. Either way, the servers get consecutive ports
+(and log files) starting from the configured ones, unless their overrides
+say otherwise.
+
+The supervisor loads the (not generated) maps of the rotation and their
+transfer streams before it starts the workers, and keeps all of them in
+memory, at around 12 MB for every map. The first game a worker plays on one
+of these maps runs on the inherited map itself, so the pages of the map are
+shared until the worker writes to them, and only the written ones are
+copied. Later games on the same map decompress it from the shared transfer
+stream, so once the rotation has come around, every worker holds a full
+copy of its current map like a single server does, and the maps kept by
+the supervisor come on top of that. What the farm saves in the long run is
+reading the maps and compressing their transfer streams, not memory.
+
+The supervisor also keeps the ban list: bans made on any
+of the servers are written to bans.txt by the supervisor and passed on to
+the others. The health of every worker (players, slowest update, current
+map) is written to the status file, and workers that exit or stop
+responding are restarted.
+
+The supervisor doesn't run a reactor, and is only available on systems
+with fork().
+"""
+
+import sys
+import os
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import runpy
+import traceback
+
+sys.path.append('..')
+
+from networkdict import NetworkDict
+from banjournal import BanJournal, apply_record, get_ban_expiry
+from map import load_base_maps, MapNotFound
+
+RUN_SCRIPT = 'run.py'
+DEFAULT_WORKERS = 2
+DEFAULT_STATUS_FILE = 'farm.json'
+# config sections of listening services that get a port per worker
+PORT_SECTIONS = ('status_server', 'ssh', 'ban_publish')
+
+POLL_INTERVAL = 1.0
+STATUS_INTERVAL = 1.0
+HEALTH_TIMEOUT = 10.0 # reported as unresponsive after this
+HANG_TIMEOUT = 60.0 # and restarted after this
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_TIME = 60.0 # workers that ran this long restart without delay
+STOP_TIMEOUT = 10.0
+
+def load_config():
+    """
+    Returns the config, and the overrides given on the command line that
+    are passed on to the workers
+    """
+    for name in ('config.txt', 'config.txt.default'):
+        try:
+            config = json.load(open(name, 'rb'))
+            break
+        except IOError:
+            pass
+    else:
+        raise SystemExit('no config.txt file found')
+    overrides = {}
+    if len(sys.argv) > 1:
+        overrides = eval(' '.join(sys.argv[1:]))
+        config.update(overrides)
+    return config, overrides
+
+def get_worker_configs(config, base = {}):
+    """
+    Returns the config overrides for every worker, on top of the given ones
+    """
+    workers = config.get('farm', {}).get('workers', DEFAULT_WORKERS)
+    base_port = config.get('port', 32887)
+    if not isinstance(workers, list):
+        workers = [{}] * workers
+    overrides = []
+    for index, values in enumerate(workers):
+        item = dict(base)
+        item['port'] = base_port + index
+        for name in PORT_SECTIONS:
+            section = config.get(name, None)
+            if section and 'port' in section:
+                section = dict(section)
+                section['port'] += index
+                item[name] = section
+        logfile = config.get('logfile', None)
+        if logfile:
+            root, ext = os.path.splitext(logfile)
+            item['logfile'] = '%s-%s%s' % (root, index, ext)
+        # the values given for the worker win over the ones made up here
+        item.update(values)
+        overrides.append(item)
+    return overrides
+
+def write_status(filename, status):
+    temp = filename + '.tmp'
+    fp = open(temp, 'wb')
+    fp.write(json.dumps(status, indent = 4))
+    fp.close()
+    os.rename(temp, filename)
+
+class Worker(object):
+    pid = None
+    sock = None
+    start_time = None
+    restart_time = None
+    health = None
+    health_time = None
+    exit_reason = None
+    restarts = 0
+
+    def __init__(self, index, overrides):
+        self.index = index
+        self.overrides = overrides
+        self.port = overrides['port']
+        self.restart_delay = MIN_RESTART_DELAY
+        self.input = ''
+        self.output = ''
+
+    def get_state(self, current_time):
+        if self.pid is None:
+            return 'stopped'
+        if self.health_time is None:
+            return 'starting'
+        if current_time - self.health_time >= HEALTH_TIMEOUT:
+            return 'unresponsive'
+        return 'running'
+
+class Supervisor(object):
+    running = True
+
+    def __init__(self, config, overrides = {}):
+        self.config = config
+        farm = config.get('farm', {})
+        self.status_file = farm.get('status_file', DEFAULT_STATUS_FILE)
+        self.workers = [Worker(index, item) for (index, item) in
+            enumerate(get_worker_configs(config, overrides))]
+        self.bans = NetworkDict(get_ban_expiry)
+        self.ban_journal = BanJournal('bans.txt')
+        self.ban_journal.load(self.bans)
+        try:
+            count = load_base_maps(config['maps'])
+        except MapNotFound, e:
+            self.ban_journal.close()
+            raise SystemExit('Invalid map in map rotation (%s), exiting.' % (
+                e.map))
+        print 'Loaded %s maps to share between %s servers' % (count,
+            len(self.workers))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            self.start_worker(worker)
+        last_status = 0
+        while self.running:
+            self.reap()
+            current_time = time.time()
+            for worker in self.workers:
+                if worker.pid is None:
+                    if current_time >= worker.restart_time:
+                        self.start_worker(worker)
+                elif self.is_hung(worker, current_time):
+                    print 'Worker %s stopped responding, killing it' % (
+                        worker.index)
+                    self.kill(worker, signal.SIGKILL)
+            if current_time - last_status >= STATUS_INTERVAL:
+                self.write_status()
+                last_status = current_time
+            self.poll(POLL_INTERVAL)
+        self.stop_workers()
+        self.ban_journal.close()
+        self.write_status()
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    # workers
+
+    def start_worker(self, worker):
+        parent, child = socket.socketpair()
+        # or the child would write out what is still buffered again
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            self.run_worker(worker, child)
+        child.close()
+        parent.setblocking(False)
+        worker.pid = pid
+        worker.sock = parent
+        worker.input = worker.output = ''
+        worker.start_time = time.time()
+        worker.health = worker.health_time = None
+        self.send(worker, {'type' : 'bans', 'bans' : self.bans.make_list()})
+        print 'Started worker %s on port %s (pid %s)' % (worker.index,
+            worker.port, pid)
+
+    def run_worker(self, worker, sock):
+        """
+        Runs the server in the forked child. Never returns
+        """
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            for other in self.workers:
+                if other.sock is not None:
+                    other.sock.close()
+            # only the supervisor reads from the terminal
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.close(devnull)
+            overrides = dict(worker.overrides)
+            overrides['farm_worker'] = {'fd' : os.dup(sock.fileno()),
+                'index' : worker.index}
+            sock.close()
+            sys.argv = [RUN_SCRIPT, repr(overrides)]
+            runpy.run_path(RUN_SCRIPT, run_name = '__main__')
+            code = 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print e.code
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def is_hung(self, worker, current_time):
+        # workers can also hang before their first report, e.g. while
+        # loading their maps
+        last_time = worker.health_time
+        if last_time is None:
+            last_time = worker.start_time
+        return current_time - last_time >= HANG_TIMEOUT
+
+    def kill(self, worker, signum = signal.SIGTERM):
+        try:
+            os.kill(worker.pid, signum)
+        except OSError:
+            pass
+
+    def reap(self):
+        while 1:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if pid == 0:
+                return
+            for worker in self.workers:
+                if worker.pid == pid:
+                    self.worker_exited(worker, status)
+                    break
+
+    def worker_exited(self, worker, status):
+        current_time = time.time()
+        self.close_socket(worker)
+        worker.pid = None
+        worker.health = worker.health_time = None
+        if os.WIFSIGNALED(status):
+            worker.exit_reason = 'signal %s' % os.WTERMSIG(status)
+        else:
+            worker.exit_reason = 'exit code %s' % os.WEXITSTATUS(status)
+        if not self.running:
+            return
+        if current_time - worker.start_time >= STABLE_TIME:
+            worker.restart_delay = MIN_RESTART_DELAY
+        worker.restart_time = current_time + worker.restart_delay
+        print 'Worker %s exited with %s, restarting in %s seconds' % (
+            worker.index, worker.exit_reason, worker.restart_delay)
+        worker.restart_delay = min(worker.restart_delay * 2,
+            MAX_RESTART_DELAY)
+        worker.restarts += 1
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker.pid is not None:
+                self.kill(worker)
+        end_time = time.time() + STOP_TIMEOUT
+        while time.time() < end_time:
+            # keep taking ban changes until the workers are gone
+            self.reap()
+            if not [worker for worker in self.workers if worker.pid]:
+                return
+            self.poll(0.1)
+        for worker in self.workers:
+            if worker.pid is not None:
+                print 'Worker %s did not stop, killing it' % worker.index
+                self.kill(worker, signal.SIGKILL)
+                try:
+                    os.waitpid(worker.pid, 0)
+                except OSError:
+                    pass
+                worker.pid = None
+
+    # communication
+
+    def poll(self, timeout):
+        workers = {}
+        readers = []
+        writers = []
+        for worker in self.workers:
+            if worker.sock is None:
+                continue
+            workers[worker.sock] = worker
+            readers.append(worker.sock)
+            if worker.output:
+                writers.append(worker.sock)
+        try:
+            readable, writable, _ = select.select(readers, writers, [],
+                timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for sock in readable:
+            self.read(workers[sock])
+        for sock in writable:
+            self.flush(workers[sock])
+
+    def read(self, worker):
+        if worker.sock is None:
+            return
+        try:
+            data = worker.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.close_socket(worker)
+            return
+        worker.input += data
+        while '\n' in worker.input:
+            line, worker.input = worker.input.split('\n', 1)
+            try:
+                message = json.loads(line)
+            except ValueError:
+                print 'Invalid message from worker %s' % worker.index
+                continue
+            self.message_received(worker, message)
+
+    def send(self, worker, message):
+        if worker.sock is None:
+            return
+        worker.output += json.dumps(message) + '\n'
+        self.flush(worker)
+
+    def flush(self, worker):
+        if worker.sock is None or not worker.output:
+            return
+        try:
+            sent = worker.sock.send(worker.output)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.close_socket(worker)
+            return
+        worker.output = worker.output[sent:]
+
+    def close_socket(self, worker):
+        if worker.sock is None:
+            return
+        worker.sock.close()
+        worker.sock = None
+        worker.input = worker.output = ''
+
+    def message_received(self, worker, message):
+        message_type = message.get('type', None)
+        if message_type == 'health':
+            worker.health = message
+            worker.health_time = time.time()
+        elif message_type == 'ban':
+            record = message['record']
+            try:
+                apply_record(self.bans, record)
+            except (ValueError, KeyError, IndexError), e:
+                print 'Invalid ban change from worker %s: %s' % (
+                    worker.index, e)
+                return
+            self.ban_journal.append(record)
+            for other in self.workers:
+                if other is not worker:
+                    self.send(other, message)
+
+    # status
+
+    def get_status(self):
+        current_time = time.time()
+        workers = []
+        players = 0
+        for worker in self.workers:
+            item = {
+                'index' : worker.index,
+                'port' : worker.port,
+                'pid' : worker.pid,
+                'state' : worker.get_state(current_time),
+                'restarts' : worker.restarts,
+                'last_exit' : worker.exit_reason
+            }
+            if worker.health is not None:
+                for key, value in worker.health.iteritems():
+                    if key != 'type':
+                        item[key] = value
+                item['last_report'] = current_time - worker.health_time
+                players += worker.health.get('players', 0)
+            workers.append(item)
+        return {
+            'time' : current_time,
+            'players' : players,
+            'bans' : len(self.bans),
+            'workers' : workers
+        }
+
+    def write_status(self):
+        try:
+            write_status(self.status_file, self.get_status())
+        except (IOError, OSError), e:
+            print 'Could not write farm status: %s' % e
+
+def main():
+    if not hasattr(os, 'fork'):
+        raise SystemExit('The server farm needs a system with fork()')
+    config, overrides = load_config()
+    supervisor = Supervisor(config, overrides)
+    supervisor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The worker side of a server farm (see farm.py).
+
+WorkerClient takes the place of the ban journal of the server: ban changes
+are sent to the supervisor, which writes them to the ban list and passes
+them on to the other workers, and the changes made on the other workers are
+applied as they come in. It also reports the health of the server to the
+supervisor.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from banjournal import apply_record
+from networkdict import NetworkDict
+import os
+import json
+import socket
+
+HEALTH_INTERVAL = 1.0
+MAX_LINE_LENGTH = 16 * 1024 * 1024
+
+def read_line(sock):
+    """
+    Reads the first line from a blocking socket, and returns it together
+    with the data received after it
+    """
+    data = ''
+    while '\n' not in data:
+        value = sock.recv(65536)
+        if not value:
+            raise IOError('farm supervisor closed the connection')
+        data += value
+    return data.split('\n', 1)
+
+class SupervisorConnection(LineReceiver):
+    delimiter = '\n'
+    MAX_LENGTH = MAX_LINE_LENGTH
+
+    def connectionMade(self):
+        self.factory.client.connection = self
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            print 'Invalid message from farm supervisor'
+            return
+        self.factory.client.message_received(message)
+
+    def connectionLost(self, reason):
+        self.factory.client.connection_lost()
+
+class WorkerClient(object):
+    connection = None
+    closed = False
+
+    def __init__(self, protocol, config):
+        self.protocol = protocol
+        self.fd = config['fd']
+        self.index = config['index']
+        self.health_loop = LoopingCall(self.send_health)
+
+    def load(self, bans):
+        """
+        Loads the ban list of the supervisor into the given NetworkDict, and
+        starts listening for changes
+        """
+        sock = socket.fromfd(self.fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(self.fd)
+        line, rest = read_line(sock)
+        bans.read_list(json.loads(line)['bans'])
+        sock.setblocking(False)
+        factory = Factory()
+        factory.protocol = SupervisorConnection
+        factory.client = self
+        reactor.adoptStreamConnection(sock.fileno(), socket.AF_UNIX, factory)
+        sock.close()
+        if rest:
+            self.connection.dataReceived(rest)
+        self.health_loop.start(HEALTH_INTERVAL, now = False)
+
+    def message_received(self, message):
+        if message.get('type', None) == 'ban':
+            self.ban_received(message['record'])
+
+    def ban_received(self, record):
+        protocol = self.protocol
+        try:
+            apply_record(protocol.bans, record)
+        except (ValueError, KeyError, IndexError), e:
+            print 'Could not apply ban change from farm: %s' % e
+            return
+        if record[0] == 'add':
+            network = NetworkDict()
+            network[record[1]] = True
+            for connection in protocol.connections.values():
+                if connection.address[0] in network:
+                    connection.kick(silent = True)
+        if protocol.ban_publish is not None:
+            protocol.ban_publish.update()
+
+    def connection_lost(self):
+        self.connection = None
+        if self.closed:
+            return
+        # without the supervisor, bans would no longer be saved
+        print 'Lost connection to farm supervisor, stopping server'
+        reactor.callLater(0, reactor.stop)
+
+    def send(self, message):
+        if self.connection is None:
+            return
+        self.connection.sendLine(json.dumps(message))
+
+    def send_health(self):
+        protocol = self.protocol
+        map_info = protocol.map_info
+        self.send({
+            'type' : 'health',
+            'name' : protocol.name,
+            'port' : protocol.port,
+            'map' : map_info.name if map_info is not None else None,
+            'players' : len(protocol.players),
+            'max_players' : protocol.max_players,
+            'connections' : len(protocol.connections),
+            'update_time' : protocol.max_update_time,
+            'uptime' : reactor.seconds() - protocol.start_time
+        })
+        protocol.max_update_time = 0.0
+
+    # ban journal interface
+
+    def add(self, ip, ban):
+        self.send_record(['add', ip, list(ban)])
+
+    def remove(self, ip):
+        self.send_record(['remove', ip])
+
+    def pop(self, ip):
+        self.send_record(['pop', ip])
+
+    def remove_expired(self, current_time):
+        self.send_record(['expire', current_time])
+
+    def send_record(self, record):
+        self.send({'type' : 'ban', 'record' : record})
+
+    def close(self):
+        self.closed = True
+        if self.health_loop.running:
+            self.health_loop.stop()
+        if self.connection is not None:
+            self.connection.transport.loseConnection()
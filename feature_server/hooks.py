@@ -0,0 +1,125 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event hooks for scripts.
+
+Instead of subclassing the protocol and connection classes in apply_script,
+a script can define apply_hooks(hooks, config) and subscribe to just the
+events it handles:
+
+    def on_block_build_attempt(connection, x, y, z):
+        if connection.protocol.is_protected(x, y, z):
+            return False
+
+    def apply_hooks(hooks, config):
+        hooks.add_connection_hook('on_block_build_attempt',
+            on_block_build_attempt)
+
+Only events with subscribers are wrapped, by a single method that calls the
+subscribers in the order the scripts were loaded and then the original
+method. It sits below the classes of apply_script scripts, so their
+overrides run first as before, and an override that vetoes an event without
+calling the base method keeps it from the subscribers as well. A subscriber
+that returns None lets the event continue, while any other value (including
+False, which vetoes the event like in apply_script scripts) stops the
+dispatch and becomes the result of the event. As the hooks are applied
+before apply_script scripts, only the events of the server classes themselves
+can be subscribed to.
+"""
+
+from timeit import default_timer
+
+class HookStats(object):
+    calls = 0
+    time = 0.0
+
+    def __init__(self, script, event):
+        self.script = script
+        self.event = event
+
+class HookRegistry(object):
+    script = None
+
+    def __init__(self):
+        self.connection_hooks = {}
+        self.protocol_hooks = {}
+        self.stats = {}
+
+    def add_connection_hook(self, event, func):
+        self.add_hook(self.connection_hooks, event, func)
+
+    def add_protocol_hook(self, event, func):
+        self.add_hook(self.protocol_hooks, event, func)
+
+    def add_hook(self, hooks, event, func):
+        key = (self.script, event)
+        stats = self.stats.get(key, None)
+        if stats is None:
+            stats = self.stats[key] = HookStats(self.script, event)
+        hooks.setdefault(event, []).append((func, stats))
+
+    def load_script(self, name, module, config):
+        self.script = name
+        try:
+            module.apply_hooks(self, config)
+        finally:
+            self.script = None
+
+    def apply(self, protocol_class, connection_class):
+        """
+        Returns subclasses of the given classes that dispatch the subscribed
+        events
+        """
+        if self.protocol_hooks:
+            protocol_class = create_class(protocol_class, self.protocol_hooks)
+        if self.connection_hooks:
+            connection_class = create_class(connection_class,
+                self.connection_hooks)
+        return protocol_class, connection_class
+
+    def get_stats(self):
+        """
+        Returns the stats of every subscriber, most expensive first
+        """
+        return sorted(self.stats.itervalues(), key = lambda item: item.time,
+            reverse = True)
+
+def create_dispatcher(event, base, subscribers):
+    subscribers = tuple(subscribers)
+    timer = default_timer
+    def dispatch(self, *arg, **kw):
+        for func, stats in subscribers:
+            start = timer()
+            result = func(self, *arg, **kw)
+            stats.time += timer() - start
+            stats.calls += 1
+            if result is not None:
+                return result
+        return base(self, *arg, **kw)
+    dispatch.__name__ = event
+    return dispatch
+
+def create_class(base_class, hooks):
+    methods = {}
+    for event, subscribers in hooks.iteritems():
+        base = getattr(base_class, event, None)
+        if base is None:
+            raise AttributeError('%s has no event %r' % (base_class.__name__,
+                event))
+        methods[event] = create_dispatcher(event, base, subscribers)
+    return type('Hooked' + base_class.__name__, (base_class,), methods)
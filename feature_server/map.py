@@ -16,14 +16,65 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from pyspades.vxl import VXLData
+from mapcache import get_cache_key, COMPRESSION_LEVEL
 
+import sys
 import os
 import imp
 import math
 import random
+import mmap
+import zlib
+from cStringIO import StringIO
+from pyspades import mapmaker
 
 DEFAULT_LOAD_DIR = './maps'
 
+cache = None
+generator_threads = 1
+
+# map filename -> (VXLData, transfer stream) of pristine maps, loaded by the
+# farm supervisor before it starts its workers. A forked worker plays the
+# first game on a map directly on the inherited map, so the operating system
+# only copies the pages it writes to. As the map is no longer pristine after
+# that, the worker then drops it from its base_maps, and later games load
+# the map from the transfer stream, which stays valid for it
+base_maps = {}
+
+def set_map_cache(new_cache):
+    global cache
+    cache = new_cache
+
+def set_generator_threads(count):
+    """
+    Sets how many threads the map generators that support it (such as the
+    classic generator) can use
+    """
+    global generator_threads
+    generator_threads = max(1, count)
+    mapmaker.default_threads = generator_threads
+
+def load_base_maps(maps, load_dir = DEFAULT_LOAD_DIR):
+    """
+    Loads the maps in the given rotation that aren't generated as base maps,
+    and returns how many were loaded
+    """
+    count = 0
+    for rot_info in check_rotation(maps, load_dir):
+        filename = rot_info.get_map_filename(load_dir)
+        if filename in base_maps:
+            continue
+        map = Map(rot_info, load_dir, load = False)
+        if map.gen_script:
+            continue
+        map.load_vxl(rot_info, load_dir)
+        # build the land index now, rather than in the pages of every worker
+        map.data.count_land(0, 0, 512, 512)
+        stream = zlib.compress(map.data.generate(), COMPRESSION_LEVEL)
+        base_maps[filename] = (map.data, stream)
+        count += 1
+    return count
+
 class MapNotFound(Exception):
     def __init__(self, map):
         self.map = map
@@ -44,23 +95,90 @@ def check_rotation(maps, load_dir = DEFAULT_LOAD_DIR):
     return infos
 
 class Map(object):
-    def __init__(self, rot_info, load_dir = DEFAULT_LOAD_DIR):
+    data = None
+    transfer_data = None
+    transfer_map = None
+    transfer_revision = None
+
+    def __init__(self, rot_info, load_dir = DEFAULT_LOAD_DIR, load = True):
+        self.load_dir = load_dir
         self.load_information(rot_info, load_dir)
-        
+        if load:
+            self.load_data(rot_info, load_dir)
+
+    def load_data(self, rot_info, load_dir):
         if self.gen_script:
             self.name = '%s #%s' % (rot_info.name, rot_info.get_seed())
-            print "Generating map '%s'..." % self.name
-            random.seed(rot_info.get_seed())
-            self.data = self.gen_script(rot_info.name, rot_info.get_seed())
+            key = self.get_cache_key(rot_info)
+            if not self.load_cached(key):
+                print "Generating map '%s'..." % self.name
+                self.data = self.generate_data(rot_info)
+                self.store_cached(key)
         else:
             print "Loading map '%s'..." % self.name
             self.load_vxl(rot_info, load_dir)
 
         print 'Map loaded successfully.'
+    
+    def generate_data(self, rot_info):
+        random.seed(rot_info.get_seed())
+        return self.gen_script(rot_info.name, rot_info.get_seed())
+    
+    def get_cache_key(self, rot_info):
+        if cache is None:
+            return None
+        try:
+            script = open(rot_info.get_meta_filename(self.load_dir),
+                'rb').read()
+        except IOError:
+            return None
+        return get_cache_key(script, self.version, rot_info.get_seed())
+    
+    def load_cached(self, key):
+        if key is None:
+            return False
+        entry = cache.load(key)
+        if entry is None:
+            return False
+        data, stream = entry
+        self.data = data
+        self.set_transfer_data(stream, data, data.get_revision())
+        return True
+    
+    def store_cached(self, key, data = None):
+        """
+        Writes the map to the cache in a worker thread. data is the VXL string
+        of the map, if it is already known.
+        """
+        if key is None:
+            return
+        from twisted.internet import threads
+        if data is None:
+            data = self.data.generate()
+        deferred = threads.deferToThread(cache.store, key, data)
+        deferred.addCallback(self.set_transfer_data, self.data,
+            self.data.get_revision())
+    
+    def set_transfer_data(self, stream, data, revision):
+        self.transfer_data = stream
+        self.transfer_map = data
+        self.transfer_revision = revision
+    
+    def get_transfer_data(self):
+        """
+        Returns the compressed transfer stream of the map, or None if it is
+        unknown or the map was modified since
+        """
+        data = self.data
+        if (self.transfer_data is None or data is not self.transfer_map or
+            data.get_revision() != self.transfer_revision):
+            return None
+        return self.transfer_data
 
     def load_information(self, rot_info, load_dir):
         try:
-            info = imp.load_source(rot_info.name, rot_info.get_meta_filename())
+            info = imp.load_source(rot_info.name,
+                rot_info.get_meta_filename(load_dir))
         except IOError:
             info = None
         self.info = info
@@ -92,12 +210,35 @@ class Map(object):
         return protocol, connection
 
     def load_vxl(self, rot_info, load_dir):
+        filename = rot_info.get_map_filename(load_dir)
+        base = base_maps.get(filename, None)
+        if base is not None:
+            data, stream = base
+            if data is None:
+                data = VXLData(StringIO(zlib.decompress(stream)))
+            else:
+                base_maps[filename] = (None, stream)
+            self.data = data
+            self.set_transfer_data(stream, data, data.get_revision())
+            return
         try:
-            fp = open(rot_info.get_map_filename(load_dir), 'rb')
-        except OSError:
+            fp = open(filename, 'rb')
+        except (IOError, OSError):
             raise MapNotFound(rot_info.name)
-        self.data = VXLData(fp)
-        fp.close()
+        try:
+            # parse the file in place, without reading it into memory first
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # empty files can't be mapped
+                data = fp
+            try:
+                self.data = VXLData(data)
+            finally:
+                if data is not fp:
+                    data.close()
+        finally:
+            fp.close()
 
 class RotationInfo(object):
     seed = None
@@ -124,3 +265,81 @@ class RotationInfo(object):
     
     def __str__(self):
         return self.full_name
+
+class GenerateError(Exception):
+    pass
+
+def generate_external(rot_info, load_dir = DEFAULT_LOAD_DIR):
+    """
+    Runs the generator script of a map in a separate process and returns a
+    Deferred that fires with the VXL data it wrote.
+
+    Generator scripts share the global random module, so running them in a
+    thread would make the output depend on whatever else the reactor does
+    in the meantime.
+    """
+    from twisted.internet import utils
+    name = '%s #%s' % (rot_info.name, rot_info.get_seed())
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(os.path.abspath(path)
+        for path in sys.path if path)
+    deferred = utils.getProcessOutputAndValue(sys.executable,
+        (script, name, load_dir, str(generator_threads)), env)
+    def check_output(result):
+        out, err, code = result
+        if code != 0:
+            raise GenerateError(err.strip() or 'exit code %s' % code)
+        return out
+    return deferred.addCallback(check_output)
+
+def prepare_map(rot_info, load_dir = DEFAULT_LOAD_DIR):
+    """
+    Loads or generates a map without blocking the reactor. Returns a Deferred
+    that fires with the finished Map.
+    """
+    from twisted.internet import threads, defer
+    map = Map(rot_info, load_dir, load = False)
+    if not map.gen_script:
+        deferred = threads.deferToThread(map.load_vxl, rot_info, load_dir)
+    elif hasattr(sys, 'frozen'):
+        # no interpreter to run the generator with, so do it in-place
+        deferred = defer.maybeDeferred(map.load_data, rot_info, load_dir)
+    else:
+        map.name = '%s #%s' % (rot_info.name, rot_info.get_seed())
+        key = map.get_cache_key(rot_info)
+        if key is None:
+            deferred = defer.succeed(False)
+        else:
+            deferred = threads.deferToThread(map.load_cached, key)
+        def generate(cached):
+            if cached:
+                return
+            deferred = generate_external(rot_info, load_dir)
+            deferred.addCallback(got_data, key)
+            return deferred
+        def got_data(data, key):
+            deferred = threads.deferToThread(VXLData, StringIO(data))
+            deferred.addCallback(got_map, key, data)
+            return deferred
+        def got_map(data, key, vxl):
+            map.data = data
+            map.store_cached(key, vxl)
+        deferred.addCallback(generate)
+    return deferred.addCallback(lambda result: map)
+
+def main():
+    name, load_dir, threads = sys.argv[1:]
+    set_generator_threads(int(threads))
+    out = sys.stdout
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode(out.fileno(), os.O_BINARY)
+    sys.stdout = sys.stderr # keep the map data stream clean
+    rot_info = RotationInfo(name)
+    data = Map(rot_info, load_dir, load = False).generate_data(rot_info)
+    out.write(data.generate())
+    out.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk cache for generated maps.
+
+Entries are addressed by a hash of the generator script, its version and the
+seed, and consist of the generated VXL data and the compressed stream that is
+sent to clients. The least recently used entries are evicted once the cache
+grows beyond its size limit.
+"""
+
+from pyspades.vxl import VXLData
+from pyspades.exceptions import InvalidData
+
+import os
+import mmap
+import zlib
+import hashlib
+import threading
+
+COMPRESSION_LEVEL = 9
+DEFAULT_PATH = './cache/maps'
+DEFAULT_MAX_SIZE = 128 # in megabytes
+
+def get_cache_key(script, version, seed):
+    return hashlib.sha1('%s\0%s\0%s' % (script, version, seed)).hexdigest()
+
+def map_file(filename):
+    fp = open(filename, 'rb')
+    try:
+        return mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        fp.close()
+
+def write_file(filename, data):
+    # write to a temporary file first, so other readers never see a partial
+    # entry
+    temp = filename + '.tmp'
+    fp = open(temp, 'wb')
+    fp.write(data)
+    fp.close()
+    if os.path.isfile(filename):
+        os.remove(filename)
+    os.rename(temp, filename)
+
+class MapCache(object):
+    def __init__(self, path = DEFAULT_PATH, max_size = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_filenames(self, key):
+        base = os.path.join(self.path, key)
+        return base + '.vxl', base + '.stream'
+
+    def load(self, key):
+        """
+        Returns the cached map data and its compressed transfer stream (as a
+        memory map), or None if the entry doesn't exist
+        """
+        vxl_name, stream_name = self.get_filenames(key)
+        with self.lock:
+            try:
+                vxl = map_file(vxl_name)
+                stream = map_file(stream_name)
+            except (IOError, OSError, mmap.error):
+                return None
+            # mark as recently used
+            os.utime(vxl_name, None)
+        try:
+            data = VXLData(vxl)
+        except InvalidData, e:
+            print 'Ignoring invalid map cache entry %s: %s' % (key, e)
+            stream.close()
+            return None
+        finally:
+            vxl.close()
+        return data, stream
+
+    def store(self, key, data):
+        """
+        Stores the given VXL string and returns the compressed transfer
+        stream for it
+        """
+        stream = zlib.compress(data, COMPRESSION_LEVEL)
+        vxl_name, stream_name = self.get_filenames(key)
+        with self.lock:
+            try:
+                write_file(stream_name, stream)
+                write_file(vxl_name, data)
+            except (IOError, OSError), e:
+                print 'Could not write map cache entry %s: %s' % (key, e)
+            self.evict()
+        return stream
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            key, ext = os.path.splitext(name)
+            if ext != '.vxl':
+                continue
+            vxl_name, stream_name = self.get_filenames(key)
+            try:
+                size = os.path.getsize(vxl_name)
+                if os.path.isfile(stream_name):
+                    size += os.path.getsize(stream_name)
+                entries.append((os.path.getmtime(vxl_name), size, key))
+            except OSError:
+                continue
+            total_size += size
+        entries.sort()
+        for mtime, size, key in entries:
+            if total_size <= self.max_size:
+                break
+            for filename in self.get_filenames(key):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            total_size -= size
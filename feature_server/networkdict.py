@@ -1,4 +1,9 @@
 from pyspades.ipaddr import IPNetwork
+from collections import OrderedDict
+from socket import inet_aton
+import socket
+import struct
+import heapq
 
 cache = {}
 
@@ -11,66 +16,191 @@ def get_network(cidr):
         return network
 
 def get_cidr(network):
-    if network._prefixlen == 32:
+    if network._prefixlen == network._max_prefixlen:
         return str(network.ip)
     return str(network)
 
+def get_address(key):
+    """
+    Returns the IPv4 address of the given IP or CIDR as an integer, and the
+    prefix length, or None for other networks
+    """
+    if '/' not in key:
+        try:
+            return struct.unpack('!I', inet_aton(key))[0], 32
+        except socket.error:
+            pass
+    network = get_network(key)
+    if network.version != 4:
+        return None
+    return int(network.network), network._prefixlen
+
 class NetworkDict(object):
-    def __init__(self):
-        self.networks = []
-    
+    """
+    Maps IPv4 networks to values. Lookups by IP or CIDR return the first
+    inserted network that contains it, walking a binary trie of the address
+    bits, so they take at most 32 steps regardless of the number of
+    networks. Other (IPv6) networks are kept in a list that is searched
+    in order, as they are only ever looked up by IPv6 keys.
+
+    If get_expiry is given, it is called with every value and should return
+    the time the entry expires at (or None), and remove_expired() removes
+    the entries that have expired.
+    """
+    def __init__(self, get_expiry = None):
+        # trie nodes are [zero child, one child, entry ids]
+        self.root = [None, None, None]
+        # entry id -> (address, prefix length, cidr, value), in insertion
+        # order
+        self.entries = OrderedDict()
+        # entry id -> network, for the networks that aren't IPv4
+        self.others = OrderedDict()
+        self.next_id = 0
+        self.get_expiry = get_expiry
+        self.expiry = []
+
     def read_list(self, values):
         for item in values:
             self[item[1]] = [item[0]] + item[2:]
-        
+
     def make_list(self):
         values = []
         for network, value in self.iteritems():
             values.append([value[0]] + [network] + list(value[1:]))
         return values
-    
+
+    def find_ids(self, key):
+        """
+        Returns the ids of the entries that contain the given IP or CIDR
+        """
+        address = get_address(key)
+        if address is not None:
+            return self.get_ids(*address)
+        network = get_network(key)
+        return [entry_id for (entry_id, other) in self.others.iteritems()
+            if network in other]
+
+    def get_ids(self, address, prefix):
+        """
+        Returns the ids of the IPv4 entries that contain the given network
+        """
+        ids = []
+        node = self.root
+        depth = 0
+        while node is not None:
+            if node[2]:
+                ids.extend(node[2])
+            if depth == prefix:
+                break
+            node = node[(address >> (31 - depth)) & 1]
+            depth += 1
+        return ids
+
+    def remove_id(self, entry_id):
+        address, prefix, cidr, value = self.entries.pop(entry_id)
+        if address is None:
+            del self.others[entry_id]
+            return cidr, value
+        path = []
+        node = self.root
+        for depth in xrange(prefix):
+            bit = (address >> (31 - depth)) & 1
+            path.append((node, bit))
+            node = node[bit]
+        node[2].remove(entry_id)
+        # prune the nodes that no longer lead to an entry
+        while path and node[0] is None and node[1] is None and not node[2]:
+            parent, bit = path.pop()
+            parent[bit] = None
+            node = parent
+        return cidr, value
+
     def remove(self, key):
-        ip = get_network(key)
-        networks = []
+        return [self.remove_id(entry_id)
+            for entry_id in sorted(self.find_ids(key))]
+
+    def remove_network(self, key):
+        """
+        Removes the newest entry for exactly the given network, and returns
+        it
+        """
+        cidr = get_cidr(get_network(key))
+        ids = [entry_id for entry_id in self.find_ids(key)
+            if self.entries[entry_id][2] == cidr]
+        if not ids:
+            raise KeyError(key)
+        return self.remove_id(max(ids))
+
+    def remove_expired(self, current_time):
+        """
+        Removes the entries that expired at or before current_time and
+        returns them
+        """
         results = []
-        for item in self.networks:
-            network, value = item
-            if ip in network:
-                results.append(item)
-            else:
-                networks.append(item)
-        self.networks = networks
+        expiry = self.expiry
+        while expiry and expiry[0][0] <= current_time:
+            entry_time, entry_id = heapq.heappop(expiry)
+            if entry_id in self.entries:
+                results.append(self.remove_id(entry_id))
         return results
-    
+
     def __setitem__(self, key, value):
-        self.networks.append((get_network(key), value))
-    
+        network = get_network(key)
+        entry_id = self.next_id
+        self.next_id += 1
+        if network.version != 4:
+            self.others[entry_id] = network
+            self.entries[entry_id] = (None, None, get_cidr(network), value)
+        else:
+            address = int(network.network)
+            prefix = network._prefixlen
+            node = self.root
+            for depth in xrange(prefix):
+                bit = (address >> (31 - depth)) & 1
+                child = node[bit]
+                if child is None:
+                    child = node[bit] = [None, None, None]
+                node = child
+            if node[2] is None:
+                node[2] = []
+            node[2].append(entry_id)
+            self.entries[entry_id] = (address, prefix, get_cidr(network),
+                value)
+        if self.get_expiry is not None:
+            expiry = self.get_expiry(value)
+            if expiry is not None:
+                heapq.heappush(self.expiry, (expiry, entry_id))
+
     def __getitem__(self, key):
         return self.get_entry(key)[1]
-    
+
     def get_entry(self, key):
-        ip = get_network(key)
-        for entry in self.networks:
-            network, value = entry
-            if ip in network:
-                return entry
-        raise KeyError()
-    
+        ids = self.find_ids(key)
+        if not ids:
+            raise KeyError(key)
+        address, prefix, cidr, value = self.entries[min(ids)]
+        return cidr, value
+
     def __len__(self):
-        return len(self.networks)
-    
-    def __delitem__(self, key, value):
-        ip = get_network(key)
-        self.networks = [item for item in self.networks if ip not in item]
-    
-    def pop(self, *arg, **kw):
-        network, value = self.networks.pop(*arg, **kw)
-        return get_cidr(network), value
-    
+        return len(self.entries)
+
+    def __delitem__(self, key):
+        if not self.remove(key):
+            raise KeyError(key)
+
+    def pop(self, index = -1):
+        if not self.entries:
+            raise IndexError('pop from empty NetworkDict')
+        if index == -1:
+            entry_id = next(reversed(self.entries))
+        else:
+            entry_id = self.entries.keys()[index]
+        return self.remove_id(entry_id)
+
     def iteritems(self):
-        for network, value in self.networks:
-            yield get_cidr(network), value
-    
+        for address, prefix, cidr, value in self.entries.itervalues():
+            yield cidr, value
+
     def __contains__(self, key):
         try:
             self.get_entry(key)
@@ -0,0 +1,182 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sampling profiler for the live server.
+
+A background thread periodically looks at the stack of the reactor thread
+and counts each stack it sees. Every sample is attributed to the script
+module it runs in, or otherwise to the core subsystem that called it. The
+result is written in the collapsed stack format used by flamegraph.pl, with
+the attribution as the root frame.
+"""
+
+from twisted.internet import reactor, defer
+from timeit import default_timer
+import os
+import sys
+import time
+import thread
+import threading
+
+DEFAULT_PATH = './profiles'
+DEFAULT_INTERVAL = 0.005
+MAX_DURATION = 120.0
+
+IDLE = 'idle'
+CORE = 'core'
+
+# frames that mark a core subsystem, looked up from the innermost frame out
+SUBSYSTEMS = {
+    ('pyspades.server', 'continue_map_transfer') : 'map transfer',
+    ('pyspades.server', 'send_map') : 'map transfer',
+    ('pyspades.server', 'update_network') : 'network',
+    ('pyspades.server', 'loader_received') : 'network',
+    ('pyspades.protocol', 'update') : 'network',
+    ('pyspades.server', 'grenade_exploded') : 'world tick',
+    ('pyspades.server', '_on_fall') : 'world tick',
+    ('pyspades.server', 'update') : 'world tick'
+}
+
+IDLE_FUNCTIONS = set(['doPoll', 'doSelect', 'doKEvent', 'doIteration',
+    'doWaitForMultipleEvents'])
+
+def get_module(frame):
+    return frame.f_globals.get('__name__', '?')
+
+class Profile(object):
+    def __init__(self, filename, duration, interval):
+        self.filename = filename
+        self.duration = duration
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self.categories = {}
+        self.labels = {}
+
+    def get_label(self, frame):
+        code = frame.f_code
+        label = self.labels.get(code, None)
+        if label is None:
+            label = self.labels[code] = '%s:%s' % (get_module(frame),
+                code.co_name)
+        return label
+
+    def get_category(self, frames):
+        for frame in frames:
+            module = get_module(frame)
+            if module.startswith('scripts.'):
+                return module
+        for frame in frames:
+            module = get_module(frame)
+            name = frame.f_code.co_name
+            if (module.startswith('twisted.internet') and
+                    name in IDLE_FUNCTIONS):
+                return IDLE
+            category = SUBSYSTEMS.get((module, name), None)
+            if category is not None:
+                return category
+        return CORE
+
+    def add_sample(self, frame):
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        category = self.get_category(frames)
+        labels = [category]
+        labels.extend(self.get_label(frame) for frame in reversed(frames))
+        stack = ';'.join(labels)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.categories[category] = self.categories.get(category, 0) + 1
+        self.samples += 1
+
+    def get_summary(self):
+        """
+        Returns (category, fraction of samples) pairs, largest first
+        """
+        if not self.samples:
+            return []
+        samples = float(self.samples)
+        items = sorted(self.categories.iteritems(), key = lambda item: item[1],
+            reverse = True)
+        return [(name, count / samples) for (name, count) in items]
+
+    def get_collapsed(self):
+        lines = ['%s %s\n' % item for item in sorted(self.stacks.iteritems())]
+        return ''.join(lines)
+
+    def write(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fp = open(filename, 'wb')
+        fp.write(self.get_collapsed())
+        fp.close()
+
+class Profiler(object):
+    """
+    Profiles the thread that created it (the reactor thread), one profile at
+    a time
+    """
+    running = False
+
+    def __init__(self, path = DEFAULT_PATH, interval = DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.thread_id = thread.get_ident()
+
+    def start(self, duration):
+        """
+        Starts a profile of the given length in seconds. Returns a Deferred
+        that fires with the Profile once it has been written to disk, or None
+        if a profile is already running
+        """
+        if self.running:
+            return None
+        self.running = True
+        duration = max(0.0, min(duration, MAX_DURATION))
+        filename = os.path.join(self.path, 'profile-%s.txt' % (
+            time.strftime('%Y%m%d-%H%M%S')))
+        profile = Profile(filename, duration, self.interval)
+        deferred = defer.Deferred()
+        sampler = threading.Thread(target = self.run, args = (profile,
+            deferred))
+        sampler.daemon = True
+        sampler.start()
+        return deferred
+
+    def run(self, profile, deferred):
+        get_frames = sys._current_frames
+        sleep = time.sleep
+        end = default_timer() + profile.duration
+        try:
+            while default_timer() < end:
+                sleep(profile.interval)
+                frame = get_frames().get(self.thread_id, None)
+                if frame is not None:
+                    profile.add_sample(frame)
+                frame = None
+            profile.write(profile.filename)
+        except Exception, e:
+            reactor.callFromThread(self.finish, deferred.errback, e)
+        else:
+            reactor.callFromThread(self.finish, deferred.callback, profile)
+
+    def finish(self, func, value):
+        self.running = False
+        func(value)
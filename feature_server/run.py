@@ -85,23 +85,29 @@ if sys.version_info < (2, 7):
 
 import pyspades.debug
 from pyspades.server import (ServerProtocol, ServerConnection, position_data,
-    grenade_packet, Team)
-from map import Map, MapNotFound, check_rotation
+    grenade_packet, Team, CompressedMapStream)
+from map import (Map, MapNotFound, check_rotation, prepare_map,
+    set_map_cache, set_generator_threads)
+from mapcache import MapCache
 from console import create_console
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.python.logfile import DailyLogFile
-from pyspades.web import getPage
+from pyspades.web import getPage, getPageFactory
 from pyspades.common import encode, decode, prettify_timespan
 from pyspades.constants import *
 from pyspades.master import MAX_SERVER_NAME_SIZE, get_external_ip
 from pyspades.tools import make_server_identifier
 from pyspades.types import AttributeSet
-from networkdict import NetworkDict, get_network
+from networkdict import NetworkDict
+from banjournal import BanJournal, get_ban_expiry
 from pyspades.exceptions import InvalidData
 from pyspades.bytes import NoDataLeft
-from scheduler import Scheduler
+from scheduler import Scheduler, TimerWheel
+from hooks import HookRegistry
+from profiler import Profiler
+from asynclog import AsyncLogObserver, RateLimiter
 import commands
 
 def create_path(path):
@@ -141,6 +147,13 @@ class FeatureConnection(ServerConnection):
     chat_count = 0
     user_types = None
     
+    def __init__(self, *arg, **kw):
+        ServerConnection.__init__(self, *arg, **kw)
+        self.scheduler = Scheduler(self.protocol)
+    
+    def call_later(self, *arg, **kw):
+        return self.scheduler.call_later(*arg, **kw)
+    
     def on_connect(self):
         protocol = self.protocol
         client_ip = self.address[0]
@@ -150,8 +163,9 @@ class FeatureConnection(ServerConnection):
                 protocol.remove_ban(client_ip)
                 protocol.save_bans()
             else:
-                print 'banned user %s (%s) attempted to join' % (name, 
-                    client_ip)
+                protocol.log_limiter.msg(('banned', client_ip),
+                    'banned user %s (%s) attempted to join' % (name,
+                    client_ip), event = 'banned_join', ip = client_ip)
                 self.disconnect(ERROR_BANNED)
                 return
         except KeyError:
@@ -160,8 +174,10 @@ class FeatureConnection(ServerConnection):
         if manager is not None:
             reason = manager.get_ban(client_ip)
             if reason is not None:
-                print ('federated banned user (%s) attempted to join, '
-                    'banned for %r') % (client_ip, reason)
+                protocol.log_limiter.msg(('banned', client_ip),
+                    ('federated banned user (%s) attempted to join, '
+                    'banned for %r') % (client_ip, reason),
+                    event = 'banned_join', ip = client_ip)
                 self.disconnect(ERROR_BANNED)
                 return
         ServerConnection.on_connect(self)
@@ -172,8 +188,10 @@ class FeatureConnection(ServerConnection):
     
     def on_login(self, name):
         self.printable_name = name.encode('ascii', 'replace')
-        print '%s (IP %s, ID %s) entered the game!' % (self.printable_name, 
-            self.address[0], self.player_id)
+        log.msg('%s (IP %s, ID %s) entered the game!' % (self.printable_name,
+            self.address[0], self.player_id), event = 'join',
+            name = self.printable_name, ip = self.address[0],
+            player_id = self.player_id)
         self.protocol.irc_say('* %s (IP %s, ID %s) entered the game!' % 
             (self.name, self.address[0], self.player_id))
         if self.user_types is None:
@@ -192,12 +210,16 @@ class FeatureConnection(ServerConnection):
     
     def on_disconnect(self):
         if self.name is not None:
-            print self.printable_name, 'disconnected!'
+            log.msg('%s disconnected!' % self.printable_name,
+                event = 'disconnect', name = self.printable_name,
+                ip = self.address[0])
             self.protocol.irc_say('* %s (IP %s) disconnected' % 
                 (self.name, self.address[0]))
             self.protocol.player_memory.append((self.name, self.address[0]))
         else:
-            print '%s disconnected' % self.address[0]
+            self.protocol.log_limiter.msg(('disconnect', self.address[0]),
+                '%s disconnected' % self.address[0], event = 'disconnect',
+                ip = self.address[0])
         ServerConnection.on_disconnect(self)
     
     def on_command(self, command, parameters):
@@ -209,7 +231,8 @@ class FeatureConnection(ServerConnection):
         if result:
             log_message += ' -> %s' % result
             self.send_chat(result)
-        print log_message.encode('ascii', 'replace')
+        log.msg(log_message.encode('ascii', 'replace'), event = 'command',
+            name = self.printable_name, command = command)
     
     def _can_build(self):
         if not self.building:
@@ -311,6 +334,8 @@ class FeatureConnection(ServerConnection):
     def on_reset(self):
         self.streak = 0
         self.best_streak = 0
+        # the calls of the connection don't carry over to the next map
+        self.scheduler.reset()
     
     def on_animation_update(self, jump, crouch, sneak, sprint):
         if self.fly and crouch and self.world_object.velocity.z != 0.0:
@@ -415,8 +440,10 @@ class FeatureConnection(ServerConnection):
             current_time += 2
     
     def on_hack_attempt(self, reason):
-        print 'Hack attempt detected from %s: %s' % (self.printable_name, 
-            reason)
+        self.protocol.log_limiter.msg(('hack', self.address[0]),
+            'Hack attempt detected from %s: %s' % (self.printable_name,
+            reason), event = 'hack_attempt', name = self.printable_name,
+            ip = self.address[0], reason = reason)
         self.kick(reason)
     
     def on_user_login(self, user_type, verbose = True):
@@ -511,6 +538,7 @@ class FeatureProtocol(ServerProtocol):
     global_chat = True
     remote_console = None
     debug_log = None
+    log_observer = None
     advance_call = None
     master_reconnect_call = None
     master = False
@@ -518,6 +546,11 @@ class FeatureProtocol(ServerProtocol):
     identifier = None
 
     planned_map = None
+    next_rotation = None
+    prefetch_maps = True
+    prefetch_info = None
+    prefetch_deferred = None
+    prefetched_map = None
     
     map_info = None
     spawns = None
@@ -525,6 +558,7 @@ class FeatureProtocol(ServerProtocol):
     god_blocks = None
     
     last_time = None
+    max_update_time = 0.0
     interface = None
     
     team_class = FeatureTeam
@@ -536,6 +570,7 @@ class FeatureProtocol(ServerProtocol):
     
     def __init__(self, interface, config):
         self.config = config
+        self.timer_wheel = TimerWheel(UPDATE_FREQUENCY)
         if config.get('random_rotation', False):
             self.map_rotator_type = random_choice_cycle
         else:
@@ -544,11 +579,17 @@ class FeatureProtocol(ServerProtocol):
         self.default_cap_limit = config.get('cap_limit', 10.0)
         self.advance_on_win = int(config.get('advance_on_win', False))
         self.win_count = itertools.count(1)
-        self.bans = NetworkDict()
-        try:
-            self.bans.read_list(json.load(open('bans.txt', 'rb')))
-        except IOError:
-            pass
+        self.bans = NetworkDict(get_ban_expiry)
+        farm_worker = config.get('farm_worker', None)
+        if farm_worker is not None:
+            # the farm supervisor keeps the ban list for all its servers
+            from farmworker import WorkerClient
+            self.ban_journal = WorkerClient(self, farm_worker)
+        else:
+            self.ban_journal = BanJournal('bans.txt')
+        self.ban_journal.load(self.bans)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+            self.ban_journal.close)
         self.hard_bans = set() # possible DDoS'ers are added here
         self.player_memory = deque(maxlen = 100)
         self.config = config
@@ -587,6 +628,12 @@ class FeatureProtocol(ServerProtocol):
              900, 1200, 1800, 2400, 3000])
         self.balanced_teams = config.get('balanced_teams', None)
         self.login_retries = config.get('login_retries', 1)
+        self.prefetch_maps = config.get('prefetch_maps', True)
+        map_cache = config.get('map_cache', {})
+        if map_cache.get('enabled', True):
+            set_map_cache(MapCache(map_cache.get('path', './cache/maps'),
+                map_cache.get('max_size', 128)))
+        set_generator_threads(config.get('generator_threads', 1))
         
         # voting configuration
         self.default_ban_time = config.get('default_ban_duration', 24*60)
@@ -595,6 +642,8 @@ class FeatureProtocol(ServerProtocol):
         if config.get('user_blocks_only', False):
             self.user_blocks = set()
         self.set_god_build = config.get('set_god_build', False)
+        self.profiler = Profiler(config.get('profile_path', './profiles'))
+        self.log_limiter = RateLimiter(config.get('log_limit_interval', 10.0))
         self.debug_log = config.get('debug_log', False)
         if self.debug_log:
             pyspades.debug.open_debug_log()
@@ -625,9 +674,18 @@ class FeatureProtocol(ServerProtocol):
                 logging_file = DailyLogFile(logfile, '.')
             else:
                 logging_file = open_create(logfile, 'a')
-            log.addObserver(log.FileLogObserver(logging_file).emit)
+            self.log_observer = AsyncLogObserver(logging_file,
+                config.get('log_format', 'text') == 'json',
+                config.get('log_queue_size', 10000))
+            log.addObserver(self.log_observer.emit)
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                self.log_observer.close)
             log.msg('pyspades server started on %s' % time.strftime('%c'))
-        log.startLogging(sys.stdout) # force twisted logging
+        # force twisted logging, without blocking on a slow terminal either
+        stdout_observer = AsyncLogObserver(sys.stdout)
+        reactor.addSystemEventTrigger('after', 'shutdown',
+            stdout_observer.close)
+        log.startLoggingWithObserver(stdout_observer.emit)
         
         self.start_time = reactor.seconds()
         self.end_calls = []
@@ -712,7 +770,8 @@ class FeatureProtocol(ServerProtocol):
     def advance_rotation(self, message = None):
         self.set_time_limit(False)
         if self.planned_map is None:
-            self.planned_map = self.map_rotator.next()
+            self.planned_map = self.peek_rotation()
+            self.next_rotation = None
         map = self.planned_map
         self.planned_map = None
         self.on_advance(map)
@@ -721,7 +780,16 @@ class FeatureProtocol(ServerProtocol):
         else:
             self.send_chat('%s Next map: %s.' % (message, map.full_name),
                            irc = True)
-            reactor.callLater(10, self.set_map_name, map)
+            self.prefetch_map(map)
+            reactor.callLater(10, self.set_prepared_map_name, map)
+    
+    def peek_rotation(self):
+        """
+        Returns the next map in rotation without advancing past it
+        """
+        if self.next_rotation is None:
+            self.next_rotation = self.map_rotator.next()
+        return self.next_rotation
     
     def get_mode_name(self):
         return self.game_mode_name
@@ -738,11 +806,53 @@ class FeatureProtocol(ServerProtocol):
         self.set_map(self.map_info.data)
         self.set_time_limit(self.map_info.time_limit)
         self.update_format()
+        self.prefetch_map(self.planned_map or self.peek_rotation())
         return True
     
+    def set_prepared_map_name(self, rot_info):
+        """
+        Like set_map_name, but waits for the map to finish preparing if it is
+        still being loaded in the background
+        """
+        deferred = self.prefetch_deferred
+        if rot_info is self.prefetch_info and not deferred.called:
+            deferred.addCallback(lambda result: self.set_map_name(rot_info))
+            return
+        self.set_map_name(rot_info)
+    
     def get_map(self, rot_info):
+        map_info = self.prefetched_map
+        if rot_info is self.prefetch_info:
+            self.prefetch_info = self.prefetched_map = None
+            self.prefetch_deferred = None
+            if map_info is not None:
+                return map_info
         return Map(rot_info)
     
+    def prefetch_map(self, rot_info):
+        """
+        Starts preparing a map in the background, so that switching to it
+        later only has to swap it in
+        """
+        if not self.prefetch_maps or rot_info is self.prefetch_info:
+            return
+        self.prefetch_info = rot_info
+        self.prefetched_map = None
+        self.prefetch_deferred = prepare_map(rot_info)
+        self.prefetch_deferred.addCallbacks(self._map_prefetched,
+            self._map_prefetch_failed, callbackArgs = (rot_info,),
+            errbackArgs = (rot_info,))
+    
+    def _map_prefetched(self, map_info, rot_info):
+        if rot_info is self.prefetch_info:
+            self.prefetched_map = map_info
+    
+    def _map_prefetch_failed(self, failure, rot_info):
+        if rot_info is self.prefetch_info:
+            self.prefetch_info = self.prefetch_deferred = None
+        print 'Could not prepare map %s: %s' % (rot_info,
+            failure.getErrorMessage())
+    
     def set_map_rotation(self, maps, now = True):
         try:
             maps = check_rotation(maps)
@@ -750,10 +860,34 @@ class FeatureProtocol(ServerProtocol):
             return e
         self.maps = maps
         self.map_rotator = self.map_rotator_type(maps)
+        self.next_rotation = None
         if now:
             self.advance_rotation()
         return True
 
+    def get_map_stream(self, parent = False):
+        map_info = self.map_info
+        if map_info is not None and map_info.data is self.map:
+            data = map_info.get_transfer_data()
+            if data is not None:
+                return CompressedMapStream(data)
+        return ServerProtocol.get_map_stream(self, parent)
+
+    def get_map_buffers(self):
+        buffers = ServerProtocol.get_map_buffers(self)
+        for map_info in (self.map_info, self.prefetched_map):
+            if map_info is not None and map_info.transfer_data is not None:
+                buffers.append(map_info.transfer_data)
+        return buffers
+
+    def get_memory_usage(self):
+        usage = ServerProtocol.get_memory_usage(self)
+        size = 0
+        for name, ip in self.player_memory:
+            size += sys.getsizeof(name) + sys.getsizeof(ip)
+        usage.append(('player memory', len(self.player_memory), size))
+        return usage
+
     def get_map_rotation(self):
         return [map.full_name for map in self.maps]
     
@@ -844,30 +978,40 @@ class FeatureProtocol(ServerProtocol):
         Ban an ip with an optional reason and duration in minutes. If duration 
         is None, ban is permanent.
         """
-        network = get_network(ip)
+        network = NetworkDict()
+        network[ip] = True
         for connection in self.connections.values():
-            if get_network(connection.address[0]) in network:
+            if connection.address[0] in network:
                 name = connection.name
                 connection.kick(silent = True)
         if duration:
             duration = reactor.seconds() + duration * 60
         else:
             duration = None
-        self.bans[ip] = (name or '(unknown)', reason, duration)
+        ban = (name or '(unknown)', reason, duration)
+        self.bans[ip] = ban
+        self.ban_journal.add(ip, ban)
         self.save_bans()
     
     def remove_ban(self, ip):
         results = self.bans.remove(ip)
+        self.ban_journal.remove(ip)
         print 'Removing ban:', ip, results
         self.save_bans()
 
     def undo_last_ban(self):
         result = self.bans.pop()
+        # the other servers of a farm can have their bans in another order,
+        # so the network is passed on rather than popping the newest ban
+        self.ban_journal.pop(result[0])
         self.save_bans()
         return result
     
     def save_bans(self):
-        json.dump(self.bans.make_list(), open_create('bans.txt', 'wb'))
+        # changes are written to disk by the ban journal as they are made
+        current_time = reactor.seconds()
+        if self.bans.remove_expired(current_time):
+            self.ban_journal.remove_expired(current_time)
         if self.ban_publish is not None:
             self.ban_publish.update()
     
@@ -891,8 +1035,9 @@ class FeatureProtocol(ServerProtocol):
             return
         dt = reactor.seconds() - current_time
         if dt > 1.0:
-            print '(warning: processing %r from %s took %s)' % (
-                packet.data, ip, dt)
+            self.log_limiter.msg('slow_packet',
+                '(warning: processing %r from %s took %s)' % (packet.data,
+                ip, dt), event = 'slow_packet', ip = ip, duration = dt)
     
     def irc_say(self, msg, me = False):
         if self.irc_relay:
@@ -914,19 +1059,25 @@ class FeatureProtocol(ServerProtocol):
 
     # log high CPU usage
     
-    def update_world(self):
+    def update(self):
         last_time = self.last_time
         current_time = reactor.seconds()
         if last_time is not None:
             dt = current_time - last_time
             if dt > 1.0:
-                print '(warning: high CPU usage detected - %s)' % dt
+                self.log_limiter.msg('high_cpu',
+                    '(warning: high CPU usage detected - %s)' % dt,
+                    event = 'high_cpu', duration = dt)
         self.last_time = current_time
-        ServerProtocol.update_world(self)
+        ServerProtocol.update(self)
+        self.timer_wheel.advance(current_time)
         time_taken = reactor.seconds() - current_time
+        self.max_update_time = max(self.max_update_time, time_taken)
         if time_taken > 1.0:
-            print 'World update iteration took %s, objects: %s' % (time_taken,
-                self.world.objects)
+            self.log_limiter.msg('slow_update',
+                'World update iteration took %s, objects: %s' % (time_taken,
+                self.world.objects), event = 'slow_update',
+                duration = time_taken)
     
     # events
     
@@ -973,6 +1124,10 @@ class FeatureProtocol(ServerProtocol):
     def getPage(self, *arg, **kw):
         return getPage(*arg, 
             bindAddress = (self.config.get('network_interface', ''), 0), **kw)
+    
+    def getPageFactory(self, *arg, **kw):
+        return getPageFactory(*arg, 
+            bindAddress = (self.config.get('network_interface', ''), 0), **kw)
         
     # before-end calls
     
@@ -1011,9 +1166,24 @@ for script in script_names[:]:
         print "(script '%s' not found: %r)" % (script, e)
         script_names.remove(script)
 
+# scripts can either subscribe to events through apply_hooks, or extend the
+# server classes through apply_script (or both). The hooks are dispatched
+# from the bottom of the class chain, so the apply_script overrides still
+# get to handle (and veto) events first
+hooks = HookRegistry()
+
+for name, script in zip(script_names, script_objects):
+    if hasattr(script, 'apply_hooks'):
+        hooks.load_script(name, script, config)
+
+protocol_class, connection_class = hooks.apply(protocol_class,
+    connection_class)
+protocol_class.hooks = hooks
+
 for script in script_objects:
-    protocol_class, connection_class = script.apply_script(protocol_class,
-        connection_class, config)
+    if hasattr(script, 'apply_script'):
+        protocol_class, connection_class = script.apply_script(protocol_class,
+            connection_class, config)
 
 protocol_class.connection_class = connection_class
 
@@ -15,8 +15,22 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+Scheduling of calls that belong to the game.
+
+Calls made through a Scheduler run on the TimerWheel of the protocol, which
+is advanced by the world update, so they fire in step with the simulation
+instead of as separate reactor calls. A Scheduler groups its calls so they
+can all be cancelled at once, and every connection has one that is reset on
+disconnect and map change.
+"""
+
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.python import log
+from operator import attrgetter
+import math
 try:
     from weakref import WeakSet
 except ImportError:
@@ -42,14 +56,188 @@ except ImportError:
         def __len__(self):
             return len(self._dict)
 
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+# calls further away than this wait in the last level, and are placed again
+# as it comes around
+MAX_TICKS = 1 << (WHEEL_BITS * WHEEL_LEVELS)
+# allowed rounding error when converting times to ticks, in ticks
+TICK_EPSILON = 1e-6
+
+get_sequence = attrgetter('sequence')
+
+class Timer(object):
+    """
+    A call scheduled on a TimerWheel, with the interface of the DelayedCall
+    returned by reactor.callLater
+    """
+    cancelled = False
+    called = False
+    slot = None
+    tick = None
+    sequence = None
+
+    def __init__(self, wheel, time, func, arg, kw):
+        self.wheel = wheel
+        self.time = time
+        self.func = func
+        self.arg = arg
+        self.kw = kw
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def check_active(self):
+        if self.cancelled:
+            raise AlreadyCancelled()
+        if self.called:
+            raise AlreadyCalled()
+
+    def cancel(self):
+        self.check_active()
+        self.cancelled = True
+        self.wheel.remove(self)
+
+    def reset(self, delay):
+        self.check_active()
+        self.wheel.remove(self)
+        self.time = self.wheel.seconds() + delay
+        self.wheel.add(self)
+
+    def delay(self, delay):
+        self.check_active()
+        self.wheel.remove(self)
+        self.time += delay
+        self.wheel.add(self)
+
+class TimerWheel(object):
+    """
+    A hierarchical timer wheel running calls on ticks of tick_length
+    seconds. Each level has WHEEL_SIZE slots, and a slot in one level covers
+    all the slots of the level below it. Calls are put in the lowest level
+    that reaches their tick, and move down a level whenever the level below
+    comes around, so scheduling and cancelling a call take constant time.
+
+    Calls due on the same tick run in the order they were scheduled in.
+    """
+    def __init__(self, tick_length, start_time = None):
+        self.tick_length = tick_length
+        if start_time is None:
+            start_time = self.seconds()
+        self.start_time = start_time
+        # the next tick to run
+        self.tick = 0
+        self.count = 0
+        self.sequence = 0
+        self.levels = [[set() for i in xrange(WHEEL_SIZE)]
+            for level in xrange(WHEEL_LEVELS)]
+
+    def seconds(self):
+        return reactor.seconds()
+
+    def call_later(self, delay, func, *arg, **kw):
+        timer = Timer(self, self.seconds() + delay, func, arg, kw)
+        self.add(timer)
+        return timer
+
+    def add(self, timer):
+        self.sequence += 1
+        timer.sequence = self.sequence
+        tick = int(math.ceil((timer.time - self.start_time) /
+            self.tick_length - TICK_EPSILON))
+        timer.tick = max(self.tick, tick)
+        self.count += 1
+        self.insert(timer)
+
+    def insert(self, timer):
+        tick = min(timer.tick, self.tick + MAX_TICKS - 1)
+        delta = tick - self.tick
+        level = 0
+        while delta >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+        slot = self.levels[level][(tick >> (WHEEL_BITS * level)) & WHEEL_MASK]
+        slot.add(timer)
+        timer.slot = slot
+
+    def remove(self, timer):
+        if timer.slot is None:
+            return
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.count -= 1
+
+    def advance(self, current_time = None):
+        """
+        Runs the calls that are due at the given time
+        """
+        if current_time is None:
+            current_time = self.seconds()
+        last_tick = int((current_time - self.start_time) / self.tick_length +
+            TICK_EPSILON)
+        while self.tick <= last_tick:
+            if not self.count:
+                self.tick = last_tick + 1
+                break
+            self.run_tick()
+
+    def run_tick(self):
+        tick = self.tick
+        # when a level comes around, the next slot of the level above is
+        # spread over it
+        level = 0
+        while (level + 1 < WHEEL_LEVELS and
+               (tick >> (WHEEL_BITS * level)) & WHEEL_MASK == 0):
+            level += 1
+            self.cascade(level, (tick >> (WHEEL_BITS * level)) & WHEEL_MASK)
+        slots = self.levels[0]
+        index = tick & WHEEL_MASK
+        timers = slots[index]
+        self.tick += 1
+        if not timers:
+            return
+        slots[index] = set()
+        self.count -= len(timers)
+        for timer in timers:
+            timer.slot = None
+        for timer in sorted(timers, key = get_sequence):
+            # skip calls cancelled or moved by the ones before them
+            if timer.cancelled or timer.slot is not None:
+                continue
+            timer.called = True
+            try:
+                timer.func(*timer.arg, **timer.kw)
+            except:
+                log.err()
+
+    def cascade(self, level, index):
+        slots = self.levels[level]
+        timers = slots[index]
+        if not timers:
+            return
+        slots[index] = set()
+        for timer in timers:
+            self.insert(timer)
+
+    def __len__(self):
+        return self.count
+
 class Scheduler(object):
+    """
+    A group of calls that can all be cancelled with reset(). call_later
+    schedules on the timer wheel of the protocol
+    """
     def __init__(self, protocol):
         self.protocol = protocol
         self.calls = WeakSet()
         self.loops = WeakSet()
     
     def call_later(self, *arg, **kw):
-        call = reactor.callLater(*arg, **kw)
+        call = self.protocol.timer_wheel.call_later(*arg, **kw)
         self.calls.add(call)
         return call
     
@@ -84,6 +84,15 @@ def apply_script(protocol, connection, config):
             self.afk_kick_call = None
             connection.on_disconnect(self)
         
+        def on_reset(self):
+            connection.on_reset(self)
+            # the calls of the connection are cancelled on map change, so
+            # start counting again from the last activity
+            if self.afk_kick_call is not None:
+                remaining = self.last_activity + time_limit - reactor.seconds()
+                self.afk_kick_call = self.call_later(max(0.0, remaining),
+                    self.afk_kick)
+        
         def on_user_login(self, user_type, verbose = True):
             if user_type in ('admin', 'trusted'):
                 if self.afk_kick_call and self.afk_kick_call.active():
@@ -93,7 +102,7 @@ def apply_script(protocol, connection, config):
         
         def on_connect(self):
             if time_limit:
-                self.afk_kick_call = reactor.callLater(time_limit, self.afk_kick)
+                self.afk_kick_call = self.call_later(time_limit, self.afk_kick)
             self.last_activity = reactor.seconds()
             return connection.on_connect(self)
         
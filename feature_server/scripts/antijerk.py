@@ -19,24 +19,23 @@ def antijerk_match(player, msg):
         return chat_pattern.match(msg) or chat_pattern_2.match(msg) or\
            admin_pattern.match(player.name)
     
-def apply_script(protocol, connection, config):
-    def jerk_kick(connection):
-        if connection.protocol.votekick_ban_duration:
-            connection.ban('Autoban: anti-jerk',
-               connection.protocol.votekick_ban_duration)
-        else:
-            connection.kick('Autokick: anti-jerk')
-        
-    class AntiJerkConnection(connection):
-        def on_chat(self, value, global_message):
-            if antijerk_match(self, value):
-                jerk_kick(self)
-            else:
-                return connection.on_chat(self, value, global_message)
-        def on_login(self, name):
-            if admin_pattern.match(name):
-                self.send_chat('Anti-jerk: Please remove "Admin" from your '+
-                               'name: TALKING WILL AUTOBAN YOU!')
-            return connection.on_login(self, name)
-                
-    return protocol, AntiJerkConnection
\ No newline at end of file
+def jerk_kick(connection):
+    if connection.protocol.votekick_ban_duration:
+        connection.ban('Autoban: anti-jerk',
+           connection.protocol.votekick_ban_duration)
+    else:
+        connection.kick('Autokick: anti-jerk')
+
+def on_chat(connection, value, global_message):
+    if antijerk_match(connection, value):
+        jerk_kick(connection)
+        return False
+
+def on_login(connection, name):
+    if admin_pattern.match(name):
+        connection.send_chat('Anti-jerk: Please remove "Admin" from your '+
+                             'name: TALKING WILL AUTOBAN YOU!')
+
+def apply_hooks(hooks, config):
+    hooks.add_connection_hook('on_chat', on_chat)
+    hooks.add_connection_hook('on_login', on_login)
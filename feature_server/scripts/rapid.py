@@ -13,7 +13,6 @@ Set ALWAYS_RAPID to TRUE to automatically get rapid when you login.
 Mantainer: hompy
 """
 
-from twisted.internet.reactor import callLater
 from twisted.internet.task import LoopingCall
 from pyspades.server import set_tool
 from pyspades.constants import *
@@ -85,7 +84,7 @@ def apply_script(protocol, connection, config):
             if self.rapid:
                 delay = max(0.0, RAPID_BLOCK_DELAY - self.latency / 1000.0)
                 if delay > 0.0:
-                    callLater(delay, resend_tool, self)
+                    self.call_later(delay, resend_tool, self)
                 else:
                     resend_tool(self)
             connection.on_block_build(self, x, y, z)
@@ -9,7 +9,7 @@ from pyspades.vxl import VXLData
 from pyspades.contained import BlockAction, SetColor
 from pyspades.constants import *
 from pyspades.common import coordinates, make_color
-from map import Map, MapNotFound, check_rotation
+from map import MapNotFound, check_rotation, prepare_map
 from commands import add, admin
 import time
 import operator
@@ -25,6 +25,8 @@ S_MAP_CHANGED = 'Map was changed'
 S_ROLLBACK_PROGRESS = 'Rollback progress {percent:.0%}'
 S_ROLLBACK_COLOR_PASS = 'Rollback doing color pass...'
 S_ROLLBACK_TIME_TAKEN = 'Time taken: {seconds:.3}s'
+S_ROLLBACK_LOADING = 'Loading {map} for the rollback...'
+S_ROLLBACK_LOAD_FAILED = 'Could not load {map}: {error}'
 
 NON_SURFACE_COLOR = (0, 0, 0)
 
@@ -59,6 +61,7 @@ def apply_script(protocol, connection, config):
 
     class RollbackProtocol(protocol):
         rollback_in_progress = False
+        rollback_loading = False
         rollback_max_rows = 10 # per 'cycle', intended to cap cpu usage
         rollback_max_packets = 180 # per 'cycle' cap for (unique packets * players)
         rollback_max_unique_packets = 12 # per 'cycle', each block op is at least 1
@@ -73,18 +76,46 @@ def apply_script(protocol, connection, config):
         
         def start_rollback(self, connection, mapname, start_x, start_y,
             end_x, end_y, ignore_indestructable = True):
-            if self.rollback_in_progress:
+            if self.rollback_in_progress or self.rollback_loading:
                 return S_ROLLBACK_IN_PROGRESS
             if mapname is None:
-                map = self.rollback_map
+                self.begin_rollback(connection, self.rollback_map, start_x,
+                    start_y, end_x, end_y, ignore_indestructable)
+                return
+            try:
+                maps = check_rotation([mapname])
+                if not maps:
+                    return S_INVALID_MAP_NAME
+            except MapNotFound as error:
+                return error.message
+            # load the map in the background instead of stalling the game
+            self.rollback_loading = True
+            args = (connection, self.map, maps[0], start_x, start_y, end_x,
+                end_y, ignore_indestructable)
+            prepare_map(maps[0]).addCallbacks(self.rollback_map_loaded,
+                self.rollback_map_failed, callbackArgs = args,
+                errbackArgs = args)
+            return S_ROLLBACK_LOADING.format(map = maps[0])
+        
+        def rollback_map_loaded(self, map_info, connection, current_map,
+                                *arg):
+            self.rollback_loading = False
+            if self.map is not current_map:
+                return
+            self.begin_rollback(connection, map_info.data, *arg[1:])
+        
+        def rollback_map_failed(self, failure, connection, current_map,
+                                rot_info, *arg):
+            self.rollback_loading = False
+            message = S_ROLLBACK_LOAD_FAILED.format(map = rot_info,
+                error = failure.getErrorMessage())
+            if connection is not None and connection.name is not None:
+                connection.send_chat(message)
             else:
-                try:
-                    maps = check_rotation([mapname])
-                    if not maps:
-                        return S_INVALID_MAP_NAME
-                    map = Map(maps[0]).data
-                except MapNotFound as error:
-                    return error.message
+                print message
+        
+        def begin_rollback(self, connection, map, start_x, start_y, end_x,
+                           end_y, ignore_indestructable):
             name = (connection.name if connection is not None
                 else S_AUTOMATIC_ROLLBACK_PLAYER_NAME)
             message = S_ROLLBACK_COMMENCED.format(player = name)
@@ -19,12 +19,16 @@ from twisted.internet.protocol import (Protocol, ReconnectingClientFactory,
     ServerFactory)
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
 from twisted.protocols.basic import Int16StringReceiver
 import json
 import hashlib
+import os
 
 CONNECTION_TIMEOUT = 5
 DEFAULT_PORT = 32880
+BATCH_INTERVAL = 5
+REPLAY_LIMIT = 1000 # batches kept until they are acknowledged
 
 def hash_password(value):
     return value # hashlib.md5(value).hexdigest()
@@ -66,7 +70,11 @@ class StatsServer(StatsProtocol):
                 self.factory.connections.append(self)
                 self.connection_accepted()
             return
-        if type == 'kill':
+        if type == 'stats':
+            sequence = obj['seq']
+            self.add_stats(obj['session'], sequence, obj['users']).addCallback(
+                self.send_ack, sequence)
+        elif type == 'kill':
             self.add_kill(obj['name'])
         elif type == 'death':
             self.add_death(obj['name'])
@@ -76,6 +84,23 @@ class StatsServer(StatsProtocol):
     
     def send_login_result(self, result):
         self.send_object({'type' : 'login', 'result' : result})
+    
+    def send_ack(self, result, sequence):
+        self.send_object({'type' : 'ack', 'seq' : sequence})
+    
+    def add_stats(self, session, sequence, users):
+        """
+        Adds a batch of kills and deaths, given as {name : [kills, deaths]}.
+        Batches can be sent again after a reconnect, so implementations
+        should skip sequence numbers they have already seen for the session.
+        Returns a Deferred that fires once the batch is stored
+        """
+        for name, (kills, deaths) in users.iteritems():
+            for _ in xrange(kills):
+                self.add_kill(name)
+            for _ in xrange(deaths):
+                self.add_death(name)
+        return succeed(None)
         
     def add_kill(self, name):
         pass
@@ -109,19 +134,27 @@ class StatsClient(StatsProtocol):
         self.send_object({'type' : 'auth', 'name' : self.factory.name, 
             'password' : self.factory.password})
     
+    def connectionLost(self, reason):
+        if self.factory.client is self:
+            self.factory.client = None
+    
     def object_received(self, obj):
         type = obj['type']
         if type == 'authed':
+            self.factory.client = self
+            self.factory.resend()
             self.factory.callback(self)
+        elif type == 'ack':
+            self.factory.acknowledge(obj['seq'])
         elif type == 'login':
             defer = self.login_defers.pop(0)
             defer.callback(obj['result'])
     
     def add_kill(self, name):
-        self.send_object({'type' : 'kill', 'name' : name})
+        self.factory.add_stat(name, 0)
     
     def add_death(self, name):
-        self.send_object({'type' : 'death', 'name' : name})
+        self.factory.add_stat(name, 1)
         
     def login_user(self, name, password):
         defer = Deferred()
@@ -132,13 +165,55 @@ class StatsClient(StatsProtocol):
         return defer
 
 class StatsClientFactory(ReconnectingClientFactory):
+    """
+    Collects kills and deaths into a batch every BATCH_INTERVAL seconds.
+    Batches are numbered and kept until the server acknowledges them, so
+    they are sent again after a reconnect instead of being lost
+    """
     protocol = StatsClient
     maxDelay = 20
+    client = None
+    sequence = 0
     
     def __init__(self, name, password, callback):
         self.name = name
         self.password = hash_password(password)
         self.callback = callback
+        # sequence numbers start over for every process
+        self.session = os.urandom(8).encode('hex')
+        self.pending = {}
+        self.unacked = []
+        self.batch_loop = LoopingCall(self.send_batch)
+        self.batch_loop.start(BATCH_INTERVAL, now = False)
+    
+    def add_stat(self, name, index):
+        stats = self.pending.get(name, None)
+        if stats is None:
+            stats = self.pending[name] = [0, 0]
+        stats[index] += 1
+    
+    def send_batch(self):
+        if not self.pending:
+            return
+        self.sequence += 1
+        batch = {'type' : 'stats', 'session' : self.session,
+            'seq' : self.sequence, 'users' : self.pending}
+        self.pending = {}
+        self.unacked.append(batch)
+        if len(self.unacked) > REPLAY_LIMIT:
+            print 'Statistics server unreachable, dropping old stats'
+            del self.unacked[:-REPLAY_LIMIT]
+        if self.client is not None:
+            self.client.send_object(batch)
+    
+    def resend(self):
+        for batch in self.unacked:
+            self.client.send_object(batch)
+    
+    def acknowledge(self, sequence):
+        unacked = self.unacked
+        while unacked and unacked[0]['seq'] <= sequence:
+            unacked.pop(0)
 
 def connect_statistics(host, port, name, password, callback, interface = ''):
     reactor.connectTCP(host, port, StatsClientFactory(name, password, callback),
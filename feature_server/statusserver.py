@@ -15,17 +15,46 @@
 # You should have received a copy of the GNU General Public License
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.internet import reactor
-from twisted.web import server
+from twisted.internet import reactor, defer, threads
+from twisted.internet.task import LoopingCall
+from twisted.web import server, http
 from twisted.web.resource import Resource
+from twisted.python import failure
 from string import Template
 import Image
 from jinja2 import Environment, PackageLoader
 import json
+import hashlib
+from hmac import compare_digest
 from cStringIO import StringIO
 
 STATUS_NAME = 'status.html'
+SNAPSHOT_INTERVAL = 1.0
+STREAM_KEEPALIVE = 15.0
+MAX_STREAMS = 64
 OVERVIEW_UPDATE_INTERVAL = 1 * 60 # 1 minute
+# must match the tile layout in vxl_c.h
+OVERVIEW_TILE_SIZE = 32
+OVERVIEW_TILES = 512 / OVERVIEW_TILE_SIZE
+
+def encode_png(data, width, height):
+    image = Image.fromstring('RGBA', (width, height), data)
+    out = StringIO()
+    image.save(out, 'png')
+    return out.getvalue()
+
+def compose_overview(tiles):
+    """
+    Encodes the full overview from the raw RGBA tiles, given row by row
+    """
+    size = OVERVIEW_TILE_SIZE * 4
+    rows = []
+    for tile_y in xrange(OVERVIEW_TILES):
+        row_tiles = tiles[tile_y * OVERVIEW_TILES:(tile_y + 1) * OVERVIEW_TILES]
+        for start in xrange(0, size * OVERVIEW_TILE_SIZE, size):
+            for tile in row_tiles:
+                rows.append(tile[start:start + size])
+    return encode_png(''.join(rows), 512, 512)
 
 class CommonResource(Resource):
     protocol = None
@@ -37,19 +66,50 @@ class CommonResource(Resource):
         self.parent = parent
         Resource.__init__(self)
 
-class JSONPage(CommonResource):
-    def render_GET(self, request):
-        protocol = self.protocol
+    def check_key(self, request):
+        """
+        Returns True if the request has the profile key. The comparison
+        takes the same time however much of a wrong key matches
+        """
+        key = request.args.get('key', [None])[0]
+        return key is not None and compare_digest(key,
+            self.parent.profile_key)
+
+def get_etag(data):
+    return '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+
+def get_player_state(player):
+    state = {
+        'name' : player.name,
+        'team' : player.team.id,
+        'kills' : player.kills,
+        'alive' : player.hp is not None and player.hp > 0
+    }
+    world_object = player.world_object
+    if world_object is not None and state['alive']:
+        position = world_object.position
+        state['position'] = [round(position.x, 1), round(position.y, 1),
+            round(position.z, 1)]
+    return state
+
+class StatusSnapshot(object):
+    """
+    The state of the server at one point in time. Snapshots are never
+    modified after they are made, so they can be shared by every request
+    until the next one is taken
+    """
+    def __init__(self, protocol, time):
+        self.time = time
         blues = []
         greens = []
-    
+        players = {}
         for player in protocol.players.values():
             if player.team is protocol.blue_team:
                 blues.append(player.name)
             else:
                 greens.append(player.name)
-                                
-        dictionary = {
+            players[str(player.player_id)] = get_player_state(player)
+        self.info = {
             "serverName" : protocol.name,
             "serverVersion": protocol.version,
             "map" : {
@@ -66,48 +126,380 @@ class JSONPage(CommonResource):
                 "currentGreenScore": protocol.green_team.score,
             "maxScore": protocol.max_score}
             }
+        self.players = players
+        self.json = json.dumps(self.info)
+        self.etag = get_etag(self.json)
 
-        return json.dumps(dictionary)
+    def get_state(self):
+        return {'info' : self.info, 'players' : self.players}
+
+    def get_delta(self, old):
+        """
+        Returns the changes since the given snapshot, or None if there are
+        none
+        """
+        delta = {}
+        if self.json != old.json:
+            delta['info'] = self.info
+        changed = {}
+        for player_id, state in self.players.iteritems():
+            if old.players.get(player_id, None) != state:
+                changed[player_id] = state
+        if changed:
+            delta['players'] = changed
+        removed = [player_id for player_id in old.players
+            if player_id not in self.players]
+        if removed:
+            delta['removed'] = removed
+        return delta or None
+
+def make_event(name, value):
+    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(value))
+
+def render_cached(request, data, etag, content_type):
+    request.setHeader('content-type', content_type)
+    if request.setETag(etag) == http.CACHED:
+        return ''
+    request.setHeader('content-length', str(len(data)))
+    if request.method == 'HEAD':
+        return ''
+    return data
+
+class JSONPage(CommonResource):
+    def render_GET(self, request):
+        snapshot = self.parent.get_snapshot()
+        return render_cached(request, snapshot.json, snapshot.etag,
+            'application/json')
+    render_HEAD = render_GET
 
 class StatusPage(CommonResource):
     def render_GET(self, request):
-        protocol = self.protocol
-        status = self.env.get_template('status.html')
-        return status.render(server = self.protocol, reactor = reactor).encode(
-            'utf-8', 'replace')
-            
+        data, etag = self.parent.get_status_page()
+        return render_cached(request, data, etag, 'text/html; charset=utf-8')
+    render_HEAD = render_GET
+
+class StreamPage(CommonResource):
+    """
+    Streams the changes to the server state as server-sent events. Every
+    stream starts with a 'snapshot' event holding the full state, followed
+    by 'delta' events with the players that changed or left
+    """
+    def render_GET(self, request):
+        if len(self.parent.streams) >= self.parent.max_streams:
+            request.setResponseCode(503)
+            return 'Too many streams'
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        self.parent.add_stream(request)
+        return server.NOT_DONE_YET
+
+class OverviewTile(object):
+    revision = None
+    data = None
+    png = None
+    png_revision = None
+    encoding = False
+
+    def __init__(self):
+        self.waiters = []
+
+class OverviewCache(object):
+    """
+    Keeps the overview of the current map as tiles, which are only redrawn
+    when their columns have changed. Tiles are drawn on the reactor, since
+    the map may be modified at any time, but the PNG encoding happens in a
+    worker thread
+    """
+    map = None
+    generation = 0
+    last_overview = None
+    overview = None
+    overview_key = None
+    overview_deferred = None
+
+    def __init__(self):
+        self.tiles = {}
+
+    def check_map(self, map):
+        if map is self.map:
+            return
+        self.map = map
+        self.generation += 1
+        self.tiles = {}
+        self.last_overview = self.overview_key = None
+
+    def update_tile(self, map, x, y):
+        tile = self.tiles.get((x, y), None)
+        if tile is None:
+            tile = self.tiles[(x, y)] = OverviewTile()
+        revision = map.get_tile_revision(x, y)
+        if revision != tile.revision:
+            tile.data = map.get_overview_tile(x, y, rgba = True)
+            tile.revision = revision
+        return tile
+
+    def get_etag(self, x, y, revision):
+        return '"%s-%s-%s-%s"' % (self.generation, x, y, revision)
+
+    def get_tile(self, map, x, y):
+        """
+        Returns a Deferred that fires with an up-to-date tile that has its
+        PNG data
+        """
+        self.check_map(map)
+        tile = self.update_tile(map, x, y)
+        if tile.png_revision == tile.revision:
+            return defer.succeed(tile)
+        deferred = defer.Deferred()
+        tile.waiters.append(deferred)
+        if not tile.encoding:
+            tile.encoding = True
+            threads.deferToThread(encode_png, tile.data, OVERVIEW_TILE_SIZE,
+                OVERVIEW_TILE_SIZE).addBoth(self.tile_encoded, tile,
+                tile.revision)
+        return deferred
+
+    def tile_encoded(self, result, tile, revision):
+        tile.encoding = False
+        waiters = tile.waiters
+        tile.waiters = []
+        if isinstance(result, failure.Failure):
+            for deferred in waiters:
+                deferred.errback(result)
+            return
+        tile.png = result
+        tile.png_revision = revision
+        for deferred in waiters:
+            deferred.callback(tile)
+
+    def get_overview(self, map):
+        """
+        Returns a Deferred that fires with the PNG data of the full overview
+        and its ETag. Only redrawn tiles are updated, and at most once per
+        OVERVIEW_UPDATE_INTERVAL
+        """
+        self.check_map(map)
+        current_time = reactor.seconds()
+        if (self.overview_deferred is None and (self.last_overview is None or
+                current_time - self.last_overview > OVERVIEW_UPDATE_INTERVAL)):
+            self.last_overview = current_time
+            tiles = [self.update_tile(map, x, y)
+                for y in xrange(OVERVIEW_TILES)
+                for x in xrange(OVERVIEW_TILES)]
+            key = tuple(tile.revision for tile in tiles)
+            if key != self.overview_key:
+                generation = self.generation
+                self.overview_deferred = threads.deferToThread(
+                    compose_overview, [tile.data for tile in tiles])
+                self.overview_deferred.addBoth(self.overview_encoded,
+                    generation, key)
+        if self.overview_deferred is not None:
+            deferred = defer.Deferred()
+            self.overview_deferred.addCallback(self.overview_ready, deferred)
+            return deferred
+        return defer.succeed(self.get_overview_result())
+
+    def get_overview_result(self):
+        etag = '"%s-%x"' % (self.generation, hash(self.overview_key) &
+            0xFFFFFFFF)
+        return self.overview, etag
+
+    def overview_encoded(self, result, generation, key):
+        self.overview_deferred = None
+        if isinstance(result, failure.Failure):
+            print 'Could not encode map overview: %s' % (
+                result.getErrorMessage())
+            self.last_overview = None
+        elif generation == self.generation:
+            self.overview = result
+            self.overview_key = key
+        return None
+
+    def overview_ready(self, result, deferred):
+        if self.overview is None:
+            deferred.errback(ValueError('no overview available'))
+        else:
+            deferred.callback(self.get_overview_result())
+        return result
 
 class MapOverview(CommonResource):
+    """
+    Serves the full overview at /overview, and single tiles at
+    /overview/tile/<x>/<y>
+    """
     def render_GET(self, request):
-        overview = self.parent.get_overview()
-        request.setHeader("content-type", 'png/image')
-        request.setHeader("content-length", str(len(overview)))
-        if request.method == "HEAD":
-            return ''
-        return overview
+        path = [item for item in request.postpath if item]
+        if not path:
+            deferred = self.parent.overview_cache.get_overview(
+                self.protocol.map)
+        elif len(path) == 3 and path[0] == 'tile':
+            try:
+                x = int(path[1])
+                y = int(path[2])
+                if not (0 <= x < OVERVIEW_TILES and 0 <= y < OVERVIEW_TILES):
+                    raise ValueError()
+            except ValueError:
+                request.setResponseCode(404)
+                return 'Invalid tile'
+            cache = self.parent.overview_cache
+            deferred = cache.get_tile(self.protocol.map, x, y)
+            deferred.addCallback(lambda tile: (tile.png,
+                cache.get_etag(x, y, tile.png_revision)))
+        else:
+            request.setResponseCode(404)
+            return 'Not found'
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        def overview_done(result):
+            if finished:
+                return
+            data, etag = result
+            request.setHeader('content-type', 'image/png')
+            if request.setETag(etag) == http.CACHED:
+                request.finish()
+                return
+            request.setHeader('content-length', str(len(data)))
+            if request.method != 'HEAD':
+                request.write(data)
+            request.finish()
+        def overview_failed(error):
+            if finished:
+                return
+            request.setResponseCode(500)
+            request.write(error.getErrorMessage())
+            request.finish()
+        deferred.addCallbacks(overview_done, overview_failed)
+        return server.NOT_DONE_YET
     render_HEAD = render_GET
 
+class ProfilePage(CommonResource):
+    """
+    Runs the sampling profiler and returns the collapsed stacks. Only
+    available when a profile_key is configured, which has to be passed as
+    the key argument
+    """
+    def render_GET(self, request):
+        if not self.check_key(request):
+            request.setResponseCode(403)
+            return 'Forbidden'
+        try:
+            duration = float(request.args.get('seconds', [10])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Invalid duration'
+        deferred = self.protocol.profiler.start(duration)
+        if deferred is None:
+            request.setResponseCode(409)
+            return 'A profile is already running'
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        def profile_done(result):
+            if finished:
+                return
+            request.setHeader('content-type', 'text/plain')
+            request.write(result.get_collapsed())
+            request.finish()
+        def profile_failed(failure):
+            if finished:
+                return
+            request.setResponseCode(500)
+            request.write(failure.getErrorMessage())
+            request.finish()
+        deferred.addCallbacks(profile_done, profile_failed)
+        return server.NOT_DONE_YET
+
+class MemoryPage(CommonResource):
+    """
+    Returns the memory usage of the server as JSON. Only available with the
+    profile_key, same as the profiler
+    """
+    def render_GET(self, request):
+        if not self.check_key(request):
+            request.setResponseCode(403)
+            return 'Forbidden'
+        usage = [{'name' : name, 'count' : count, 'bytes' : size}
+            for (name, count, size) in self.protocol.get_memory_usage()]
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('cache-control', 'no-cache')
+        return json.dumps({
+            'usage' : usage,
+            'total' : sum([item['bytes'] for item in usage])
+        })
+
 class StatusServerFactory(object):
-    last_overview = None
-    overview = None
+    snapshot = None
+    stream_snapshot = None
+    status_page = None
+    status_time = None
+    last_write = None
+
     def __init__(self, protocol, config):
         self.env = Environment(loader = PackageLoader('web'))
         self.protocol = protocol
+        self.overview_cache = OverviewCache()
+        self.streams = set()
+        self.max_streams = config.get('max_streams', MAX_STREAMS)
+        self.stream_loop = LoopingCall(self.update_streams)
         root = Resource()
         root.putChild('json', JSONPage(self))
+        root.putChild('stream', StreamPage(self))
         root.putChild('', StatusPage(self))
         root.putChild('overview', MapOverview(self))
+        self.profile_key = config.get('profile_key', None)
+        if self.profile_key:
+            # the key given in requests is a byte string
+            self.profile_key = self.profile_key.encode('utf-8')
+            root.putChild('profile', ProfilePage(self))
+            root.putChild('memory', MemoryPage(self))
         site = server.Site(root)
         protocol.listenTCP(config.get('port', 32886), site)
-    
-    def get_overview(self):
+
+    def get_snapshot(self):
         current_time = reactor.seconds()
-        if (self.last_overview is None or 
-        current_time - self.last_overview > OVERVIEW_UPDATE_INTERVAL):
-            overview = self.protocol.map.get_overview(rgba = True)
-            image = Image.fromstring('RGBA', (512, 512), overview)
-            data = StringIO()
-            image.save(data, 'png')
-            self.overview = data.getvalue()
-            self.last_overview = current_time
-        return self.overview
\ No newline at end of file
+        snapshot = self.snapshot
+        if (snapshot is None or
+                current_time - snapshot.time >= SNAPSHOT_INTERVAL):
+            snapshot = self.snapshot = StatusSnapshot(self.protocol,
+                current_time)
+        return snapshot
+
+    def get_status_page(self):
+        current_time = reactor.seconds()
+        if (self.status_page is None or
+                current_time - self.status_time >= SNAPSHOT_INTERVAL):
+            template = self.env.get_template(STATUS_NAME)
+            data = template.render(server = self.protocol,
+                reactor = reactor).encode('utf-8', 'replace')
+            self.status_page = (data, get_etag(data))
+            self.status_time = current_time
+        return self.status_page
+
+    def add_stream(self, request):
+        if not self.stream_loop.running:
+            self.stream_snapshot = self.get_snapshot()
+            self.last_write = reactor.seconds()
+            self.stream_loop.start(SNAPSHOT_INTERVAL, now = False)
+        self.streams.add(request)
+        request.notifyFinish().addBoth(self.remove_stream, request)
+        request.write(make_event('snapshot', self.stream_snapshot.get_state()))
+
+    def remove_stream(self, result, request):
+        self.streams.discard(request)
+        if not self.streams and self.stream_loop.running:
+            self.stream_loop.stop()
+
+    def update_streams(self):
+        current_time = reactor.seconds()
+        snapshot = self.snapshot = StatusSnapshot(self.protocol, current_time)
+        delta = snapshot.get_delta(self.stream_snapshot)
+        self.stream_snapshot = snapshot
+        if delta is not None:
+            data = make_event('delta', delta)
+        elif current_time - self.last_write >= STREAM_KEEPALIVE:
+            # stops proxies from closing idle streams
+            data = ':\n\n'
+        else:
+            return
+        self.last_write = current_time
+        for request in list(self.streams):
+            request.write(data)
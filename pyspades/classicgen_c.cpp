@@ -71,38 +71,48 @@ static inline float fgrad (int h, float x, float y, float z)
 
 // portable rand functions
 
-static unsigned int seed = 0;
-inline void set_seed(unsigned int value)
+inline unsigned int get_random(unsigned int * seed)
 {
-    seed = value;
+    *seed = *seed * 214013 + 2531011;
+    return (*seed >> 16) & 0x7FFF;
 }
 
-inline unsigned int get_random()
+// rows are generated in bands of this size, which can run on separate
+// threads. Each pixel only depends on the noise tables made from the seed,
+// so the result is the same however the bands are spread out
+#define GENLAND_BAND_SIZE 16
+
+struct GenLand
 {
-    seed = seed * 214013 + 2531011;
-    return (seed >> 16) & 0x7FFF;
-}
+    unsigned char noisep[512], noisep15[512];
+    double amplut[OCTMAX];
+    int msklut[OCTMAX];
+    vcol buf[VSID*VSID];
+};
 
-static unsigned char noisep[512], noisep15[512];
-static void noiseinit ()
+static void noiseinit (GenLand * land, unsigned int seed)
 {
 	int i, j, k;
+	unsigned char * noisep = land->noisep;
 
 	for(i=256-1;i>=0;i--) noisep[i] = i;
 	for(i=256-1;i> 0;i--) {
-        j = ((get_random()*(i+1))>>15); 
+        j = ((get_random(&seed)*(i+1))>>15); 
         k = noisep[i]; 
         noisep[i] = noisep[j]; 
         noisep[j] = k; 
     }
 	for(i=256-1;i>=0;i--) noisep[i+256] = noisep[i];
-	for(i=512-1;i>=0;i--) noisep15[i] = noisep[i]&15;
+	for(i=512-1;i>=0;i--) land->noisep15[i] = noisep[i]&15;
 }
 
-double noise3d (double fx, double fy, double fz, int mask)
+double noise3d (const GenLand * land, double fx, double fy, double fz,
+                int mask)
 {
 	int i, l[6], a[4];
 	float p[3], f[8];
+	const unsigned char * noisep = land->noisep;
+	const unsigned char * noisep15 = land->noisep15;
 
 	//if (mask > 255) mask = 255; //Checked before call
 	l[0] = floor(fx); p[0] = fx-((float)l[0]); l[0] &= mask; l[3] = (l[0]+1)&mask;
@@ -130,51 +140,66 @@ double noise3d (double fx, double fy, double fz, int mask)
 	return((f[1]-f[0])*p[0] + f[0]);
 }
 
-vcol buf[VSID*VSID];
-vcol amb[VSID*VSID]; // ambient
-
 inline int get_height_pos(int x, int y)
 {
     return y * VSID + x;
 }
 
-inline int get_height(int x, int y, int def)
+inline int get_height(const vcol * buf, int x, int y, int def)
 {
     if (!is_valid_position(x, y, 0))
         return def;
     return buf[get_height_pos(x, y)].a;
 }
 
-inline int get_lowest_height(int x, int y)
+inline int get_lowest_height(const vcol * buf, int x, int y)
 {
-    int z = get_height(x, y, 63);
-    z = max(get_height(x - 1, y, z),
-        max(get_height(x + 1, y, z),
-        max(get_height(x, y - 1, z),
-        max(get_height(x, y + 1, z),
+    int z = get_height(buf, x, y, 63);
+    z = max(get_height(buf, x - 1, y, z),
+        max(get_height(buf, x + 1, y, z),
+        max(get_height(buf, x, y - 1, z),
+        max(get_height(buf, x, y + 1, z),
             z))));
     return z;
 }
 
-void genland(unsigned int seed, MapData * map)
+GenLand * create_genland(unsigned int seed)
 {
-	double dx, dy, d, g, g2, river, amplut[OCTMAX], samp[3], csamp[3];
-	double nx, ny, nz, gr, gg, gb;
-	int i, x, y, k, o, maxa, msklut[OCTMAX];
-    
-    set_seed(seed);
+	double d;
+	int i;
+    GenLand * land = new GenLand;
     
-	noiseinit();
+	noiseinit(land, seed);
 
 	d = 1.0;
 	for(i=0;i<OCTMAX;i++)
 	{
-		amplut[i] = d; d *= .4;
-		msklut[i] = min((1<<(i+2))-1,255);
+		land->amplut[i] = d; d *= .4;
+		land->msklut[i] = min((1<<(i+2))-1,255);
 	}
-	k = 0;
-	for(y=0;y<VSID;y++)
+    return land;
+}
+
+void delete_genland(GenLand * land)
+{
+    delete land;
+}
+
+// computes the height and color of the rows from y1 up to y2. Rows don't
+// depend on each other, so bands of them can be generated at the same time
+void genland_rows(GenLand * land, int y1, int y2)
+{
+	double dx, dy, d, g, g2, river, samp[3], csamp[3];
+	double nx, ny, nz, gr, gg, gb;
+	int i, x, y, k, o, maxa;
+	const double * amplut = land->amplut;
+	const int * msklut = land->msklut;
+	vcol * buf = land->buf;
+	vcol amb; // ambient
+
+	for(y=y1;y<y2;y++)
 	{
+		k = get_height_pos(0, y);
 		for(x=0;x<VSID;x++,k++)
 		{
 				//Get 3 samples (0,0), (EPS,0), (0,EPS):
@@ -185,8 +210,8 @@ void genland(unsigned int seed, MapData * map)
 				d = 0; river = 0;
 				for(o=0;o<OCTMAX;o++)
 				{
-					d += noise3d(dx,dy,9.5,msklut[o])*amplut[o]*(d*1.6+1.0); //multi-fractal
-					river += noise3d(dx,dy,13.2,msklut[o])*amplut[o];
+					d += noise3d(land,dx,dy,9.5,msklut[o])*amplut[o]*(d*1.6+1.0); //multi-fractal
+					river += noise3d(land,dx,dy,13.2,msklut[o])*amplut[o];
 					dx *= 2; dy *= 2;
 				}
 				samp[i] = d*-20.0 + 28.0; 
@@ -203,7 +228,7 @@ void genland(unsigned int seed, MapData * map)
 			d = 1.0/sqrt(nx*nx + ny*ny + nz*nz); nx *= d; ny *= d; nz *= d;
 
 			gr = 140; gg = 125; gb = 115; //Ground
-			g = min(max(max(-nz,0)*1.4 - csamp[0]/32.0 + noise3d(x*(1.0/64.0),y*(1.0/64.0),.3,15)*.3,0),1);
+			g = min(max(max(-nz,0)*1.4 - csamp[0]/32.0 + noise3d(land,x*(1.0/64.0),y*(1.0/64.0),.3,15)*.3,0),1);
 			gr += (72-gr)*g; gg += (80-gg)*g; gb += (32-gb)*g; //Grass
 			g2 = (1-fabs(g-.5)*2)*.7;
 			gr += (68-gr)*g2; gg += (78-gg)*g2; gb += (40-gb)*g2; //Grass2
@@ -213,29 +238,28 @@ void genland(unsigned int seed, MapData * map)
 
 
 			d = .3;
-			amb[k].r = (unsigned char)min(max(gr*d,0),255);
-			amb[k].g = (unsigned char)min(max(gg*d,0),255);
-			amb[k].b = (unsigned char)min(max(gb*d,0),255);
-			maxa = max(max(amb[k].r,amb[k].g),amb[k].b);
+			amb.r = (unsigned char)min(max(gr*d,0),255);
+			amb.g = (unsigned char)min(max(gg*d,0),255);
+			amb.b = (unsigned char)min(max(gb*d,0),255);
+			maxa = max(max(amb.r,amb.g),amb.b);
 
             //lighting
 			d = (nx*.5 + ny*.25 - nz)/sqrt(.5*.5 + .25*.25 + 1.0*1.0); d *= 1.2;
 			// buf[k].a = (unsigned char)(175.0-samp[0]*((double)VSID/256.0));
 			buf[k].a = (unsigned char)(63-samp[0]);
-			buf[k].r = (unsigned char)min(max(gr*d,0),255-maxa);
-			buf[k].g = (unsigned char)min(max(gg*d,0),255-maxa);
-			buf[k].b = (unsigned char)min(max(gb*d,0),255-maxa);
+			buf[k].r = (unsigned char)min(max(gr*d,0),255-maxa) + amb.r;
+			buf[k].g = (unsigned char)min(max(gg*d,0),255-maxa) + amb.g;
+			buf[k].b = (unsigned char)min(max(gb*d,0),255-maxa) + amb.b;
 		}
 	}
+}
 
-	for(y=0,k=0;y<VSID;y++)
-		for(x=0;x<VSID;x++,k++) {
-			buf[k].r += amb[k].r;
-			buf[k].g += amb[k].g;
-			buf[k].b += amb[k].b;
-		}
-    
-    int height, z, lowest_z;
+// fills the map with the generated columns. This writes to the map's
+// tables, so it is done on one thread once all the rows are generated
+void write_genland(GenLand * land, MapData * map)
+{
+    const vcol * buf = land->buf;
+    int x, y, k, height, z, lowest_z;
     for (y = 0, k = 0; y < VSID; y++) {
     for (x = 0; x < VSID; x++, k++) {
         height = buf[k].a;
@@ -243,13 +267,11 @@ void genland(unsigned int seed, MapData * map)
             map->geometry[get_pos(x, y, z)] = true;
         }
         map->geometry[get_pos(x, y, z)] = true;
-        lowest_z = get_lowest_height(x, y) + 1;
+        lowest_z = get_lowest_height(buf, x, y) + 1;
         for (; z < lowest_z; z++) {
             map->colors[get_pos(x, y, z)] = ((int*)&buf[k])[0];
         }
     }}
-
-    return;
 }
 
 #pragma pack(pop)
\ No newline at end of file
@@ -16,9 +16,19 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from vxl cimport VXLData, MapData
+from cpython cimport array
+from libc.math cimport sin
 
 cdef extern from "classicgen_c.cpp":
-    void genland(unsigned long seed, MapData * map)
+    enum:
+        VSID
+        GENLAND_BAND_SIZE
+    struct GenLand:
+        pass
+    GenLand * create_genland(unsigned int seed) except +
+    void delete_genland(GenLand * land)
+    void genland_rows(GenLand * land, int y1, int y2) nogil
+    void write_genland(GenLand * land, MapData * map) nogil
 
 import array
 import random
@@ -26,10 +36,35 @@ import math
 import sys
 from collections import deque
 cimport cython
+from cython.parallel cimport prange
 
-def generate_classic(seed):
+cdef array.array float_template = array.array('f')
+cdef array.array int_template = array.array('i')
+
+# threads used by generate_classic when it isn't given a count
+default_threads = 1
+
+def generate_classic(seed, threads = None):
+    """
+    Generates a map with the classic generator. The rows are generated in
+    bands without the GIL, spread over the given number of threads, and the
+    map is the same for a seed whatever the number of threads
+    """
     cdef VXLData map = VXLData()
-    genland(seed, map.map)
+    cdef unsigned long value = seed
+    cdef int thread_count = max(1, threads or default_threads)
+    cdef int band
+    cdef GenLand * land = create_genland(value)
+    try:
+        with nogil:
+            for band in prange(VSID / GENLAND_BAND_SIZE,
+                               num_threads = thread_count,
+                               schedule = 'dynamic'):
+                genland_rows(land, band * GENLAND_BAND_SIZE,
+                             (band + 1) * GENLAND_BAND_SIZE)
+            write_genland(land, map.map)
+    finally:
+        delete_genland(land)
     return map
 
 class Biome(object):
@@ -118,11 +153,13 @@ cdef class BiomeMap:
     cpdef jitter(self):
         cdef int x
         cdef int y
+        cdef object rand = random.random
         for idx in xrange(len(self.tmap)):
             x = idx % self.width
             y = idx // self.height
-            self.tmap[idx] = self.get_repeat(x + random.randint(-1,1),
-                                             y + random.randint(-1,1))
+            x += get_random_int(rand, -1, 1)
+            y += get_random_int(rand, -1, 1)
+            self.tmap[idx] = self.get_repeat(x, y)
     cpdef create_heightmap(self):
         """Return a HeightMap with unfinished color data and a list of
         gradients. When finished with post-processing, use
@@ -153,66 +190,98 @@ cdef class BiomeMap:
 cdef class HeightMap:
     cdef public int width
     cdef public int height
-    cdef public object hmap
-    cdef public object cmap
+    cdef public array.array hmap
+    cdef public array.array cmap
     def __init__(self, height):
+        cdef float value = height
+        cdef int i
         self.width = 512
         self.height = 512
-        self.hmap = array.array('f',[height for n in xrange(0,
-                                    self.width*self.height)])
-        self.cmap = array.array('i',[<int>0xFF00FFFF for n in xrange(0,
-                                    self.width*self.height)])
+        self.hmap = array.clone(float_template, self.width*self.height, False)
+        self.cmap = array.clone(int_template, self.width*self.height, False)
+        for i in xrange(self.width*self.height):
+            self.hmap.data.as_floats[i] = value
+            self.cmap.data.as_ints[i] = <int>0xFF00FFFF
+    cdef inline int get_index(self, int x, int y):
+        """Wraps x and y around, so the algorithms tile at the edges."""
+        return (x%self.width)+(y%self.height)*self.width
     cpdef inline double get(self, int x, int y):
         return self.hmap[x+y*self.height]
     cpdef inline double get_repeat(self, int x, int y):
         """This allows the algorithm to tile at the edges."""
-        return self.hmap[(x%self.width)+(y%self.height)*self.width]
+        return self.hmap.data.as_floats[self.get_index(x, y)]
     cpdef inline set(self, int x, int y, double val):
         self.hmap[x+y*self.height] = val
     cpdef inline set_repeat(self, int x, int y, double val):
         """This allows the algorithm to tile at the edges."""
-        self.hmap[(x%self.width)+(y%self.height)*self.width] = val
+        self.hmap.data.as_floats[self.get_index(x, y)] = val
     cpdef inline add_repeat(self, int x, int y, double val):
-        self.hmap[(x%self.width)+(y%self.height)*self.width] += val
+        cdef float * data = self.hmap.data.as_floats
+        cdef int idx = self.get_index(x, y)
+        data[idx] = data[idx] + val
     cpdef inline int get_col(self, int x, int y):
         return self.cmap[x+y*self.height]
     cpdef inline int get_col_repeat(self, int x, int y):
-        return self.cmap[(x%self.width)+(y%self.height)*self.width]
+        return self.cmap.data.as_ints[self.get_index(x, y)]
     cpdef inline set_col_repeat(self, int x, int y, int val):
-        self.cmap[(x%self.width)+(y%self.height)*self.width] = val
+        self.cmap.data.as_ints[self.get_index(x, y)] = val
     cpdef inline fill_col(self, int col):
-        for n in xrange(len(self.cmap)):
-            self.cmap[n] = col
+        cdef int * colors = self.cmap.data.as_ints
+        cdef int idx
+        for idx in xrange(len(self.cmap)):
+            colors[idx] = col
     cpdef mult_repeat(self, int x, int y, double mult):
-        cdef int idx = (x%self.width)+(y%self.height)*self.width
-        self.hmap[idx] *= mult
-    cpdef seed(self, double jitter, double midpoint):        
+        cdef float * data = self.hmap.data.as_floats
+        cdef int idx = self.get_index(x, y)
+        data[idx] = data[idx] * mult
+    cpdef seed(self, double jitter, double midpoint):
         cdef double halfjitter = jitter * 0.5
+        cdef float * data = self.hmap.data.as_floats
+        cdef object rand = random.random
+        cdef int idx
         for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = midpoint + (random.random()*jitter -
-                                         halfjitter)
+            data[idx] = midpoint + (<double>rand()*jitter - halfjitter)
     cpdef peaking(self):
         """Adds a "peaking" feel to the map."""
+        cdef float * data = self.hmap.data.as_floats
+        cdef double value
+        cdef int idx
         for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = self.hmap[idx] * self.hmap[idx]
+            value = data[idx]
+            data[idx] = value * value
     cpdef dipping(self):
         """Adds a "dipping" feel to the map."""
+        cdef float * data = self.hmap.data.as_floats
+        cdef double pi = math.pi
+        cdef double value
+        cdef int idx
         for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = math.sin(self.hmap[idx]*(math.pi))
+            value = data[idx]
+            data[idx] = sin(value*(pi))
     cpdef rolling(self):
         """Adds a "rolling" feel to the map."""
+        cdef float * data = self.hmap.data.as_floats
+        cdef double pi = math.pi
+        cdef double value
+        cdef int idx
         for idx in xrange(len(self.hmap)):
-            self.hmap[idx] = math.sin(self.hmap[idx]*(math.pi/2))
+            value = data[idx]
+            data[idx] = sin(value*(pi/2))
     cpdef smoothing(self):
         """Does some simple averaging to bring down the noise level."""
+        cdef float * data = self.hmap.data.as_floats
+        cdef double top, left, right, bot, center
+        cdef int x, y
+        # this works in place, so the cells above and to the left are
+        # already smoothed when a cell is reached
         for x in xrange(0,self.width):
             for y in xrange(0,self.height):
-                top = self.get_repeat(x,y-1)
-                left = self.get_repeat(x-1,y)
-                right = self.get_repeat(x+1,y)
-                bot = self.get_repeat(x,y+1)
-                center = self.hmap[x+y*self.width]
-                self.hmap[x+y*self.width] = (top + left + right + bot + center)/5
+                top = data[self.get_index(x,y-1)]
+                left = data[self.get_index(x-1,y)]
+                right = data[self.get_index(x+1,y)]
+                bot = data[self.get_index(x,y+1)]
+                center = data[x+y*self.width]
+                data[x+y*self.width] = (top + left + right + bot + center)/5
     cpdef midpoint_displace(self, double jittervalue, \
                           double spanscalingmultiplier, \
                             int skip=0):
@@ -228,6 +297,9 @@ cdef class HeightMap:
         cdef float botleft
         cdef float botright
         cdef float center
+        cdef float * data = self.hmap.data.as_floats
+        cdef object rand = random.random
+        cdef int iterations, x, y
         
         for iterations in xrange(9): # hardcoded for 512x512
             if skip>0:
@@ -237,197 +309,250 @@ cdef class HeightMap:
                 continue
             jitterrange = jittervalue * spanscaling
             jitteroffset = - jitterrange / 2
-            for x in xrange(0,self.width,span):
-                for y in xrange(0,self.height,span):
-                    halfspan = span >> 1
-                    topleft = self.get_repeat(x,y)
-                    topright = self.get_repeat((x+span),y)
-                    botleft = self.get_repeat(x,(y+span))
-                    botright = self.get_repeat((x+span),(y+span))
+            halfspan = span >> 1
+            x = 0
+            while x < self.width:
+                y = 0
+                while y < self.height:
+                    topleft = data[self.get_index(x,y)]
+                    topright = data[self.get_index(x+span,y)]
+                    botleft = data[self.get_index(x,y+span)]
+                    botright = data[self.get_index(x+span,y+span)]
                     center = (topleft+topright+botleft+botright) * 0.25\
-                             + (random.random() * jitterrange + jitteroffset)
+                             + (<double>rand() * jitterrange + jitteroffset)
                     
-                    self.set_repeat(x+halfspan,y,(topleft+topright+center)*0.33)
-                    self.set_repeat(x,y+halfspan,(topleft+botleft+center)*0.33)
-                    self.set_repeat(x+halfspan,y+span,
-                                    (botleft+botright+center)*0.33)
-                    self.set_repeat(x+span,y+halfspan,
-                                    (topright+botright+center)*0.33)
-                    self.set_repeat(x + halfspan, y + halfspan, center)
+                    data[self.get_index(x+halfspan,y)] = (
+                        (topleft+topright+center)*0.33)
+                    data[self.get_index(x,y+halfspan)] = (
+                        (topleft+botleft+center)*0.33)
+                    data[self.get_index(x+halfspan,y+span)] = (
+                        (botleft+botright+center)*0.33)
+                    data[self.get_index(x+span,y+halfspan)] = (
+                        (topright+botright+center)*0.33)
+                    data[self.get_index(x+halfspan,y+halfspan)] = center
+                    y += span
+                x += span
             span = span >> 1
             spanscaling = spanscaling * spanscalingmultiplier
     cpdef jitter_heights(self, double amount):
         """Image jittering filter. Amount is max pixels distance to jitter."""
+        cdef float * data = self.hmap.data.as_floats
+        cdef object rand = random.random
         cdef int nx = 0
         cdef int ny = 0
-        cdef int idx = 0
+        cdef int idx
 
-        while idx<len(self.hmap):
-            nx = int((idx % self.width) + (random.random()-0.5)*amount)
-            ny = int((idx // self.width) + (random.random()-0.5)*amount)
-            self.hmap[idx] = self.get_repeat(nx, ny)            
-            idx+=1
+        for idx in xrange(len(self.hmap)):
+            nx = <int>((idx % self.width) + (<double>rand()-0.5)*amount)
+            ny = <int>((idx // self.width) + (<double>rand()-0.5)*amount)
+            data[idx] = data[self.get_index(nx, ny)]
     cpdef jitter_colors(self, double amount):
         """Image jittering filter. Amount is max pixels distance to jitter."""
+        cdef int * colors = self.cmap.data.as_ints
+        cdef object rand = random.random
         cdef int nx = 0
         cdef int ny = 0
-        cdef int idx = 0
+        cdef int idx
 
-        while idx<len(self.hmap):
-            nx = int((idx % self.width) + (random.random()-0.5)*amount)
-            ny = int((idx // self.width) + (random.random()-0.5)*amount)
-            self.cmap[idx] = self.get_col_repeat(nx, ny)            
-            idx+=1
+        for idx in xrange(len(self.hmap)):
+            nx = <int>((idx % self.width) + (<double>rand()-0.5)*amount)
+            ny = <int>((idx // self.width) + (<double>rand()-0.5)*amount)
+            colors[idx] = colors[self.get_index(nx, ny)]
         
     cpdef level_against_heightmap(self, HeightMap other, double height):
         """Use another HeightMap as an alpha-mask to force values to a
             specific height"""
+        cdef float * data = self.hmap.data.as_floats
+        cdef float * alpha = other.hmap.data.as_floats
+        cdef double orig, dist
+        cdef int x, y
         for x in xrange(0, self.width):
             for y in xrange(0, self.height):
-                orig = self.get_repeat(x,y)
+                orig = data[self.get_index(x,y)]
                 dist = orig - height
-                self.set_repeat(x,y, orig - dist * other.get_repeat(x,y))
+                data[self.get_index(x,y)] = (orig -
+                    dist * alpha[other.get_index(x,y)])
     cpdef blend_heightmaps(self, HeightMap alphamap, HeightMap HeightMap):
         """Blend according to two HeightMaps: one as an alpha-mask,
             the other contains desired heights"""
+        cdef float * data = self.hmap.data.as_floats
+        cdef float * alpha = alphamap.hmap.data.as_floats
+        cdef float * heights = HeightMap.hmap.data.as_floats
+        cdef double orig, dist
+        cdef int x, y
         for x in xrange(0, self.width):
             for y in xrange(0, self.height):
-                orig = self.get_repeat(x,y)
-                dist = orig - HeightMap.get_repeat(x,y)
-                self.set_repeat(x,y, orig - dist * alphamap.get_repeat(x,y))
+                orig = data[self.get_index(x,y)]
+                dist = orig - heights[HeightMap.get_index(x,y)]
+                data[self.get_index(x,y)] = (orig -
+                    dist * alpha[alphamap.get_index(x,y)])
     cpdef rect_solid(self, int x, int y, int w, int h, double z):
+        cdef float * data = self.hmap.data.as_floats
+        cdef int xx, yy
         for xx in xrange(x, x+w):
             for yy in xrange(y, y+h):
-                self.set_repeat(xx,yy,z)
+                data[self.get_index(xx,yy)] = z
     cpdef rect_noise(self, int x, int y, int w, int h,
                      double jitter, double midpoint):        
         cdef double halfjitter = jitter * 0.5
+        cdef float * data = self.hmap.data.as_floats
+        cdef int size = len(self.hmap)
+        cdef object rand = random.random
+        cdef double value
+        cdef int xx, yy, idx
         for xx in xrange(x,x+w):
             for yy in xrange(y,y+h):            
-                self.set(xx,yy, midpoint + (random.random()*jitter -
-                                         halfjitter))
+                value = midpoint + (<double>rand()*jitter - halfjitter)
+                idx = xx+yy*self.height
+                if 0 <= idx < size:
+                    data[idx] = value
+                else:
+                    # out of the map, so index the way set() does
+                    self.set(xx,yy,value)
     cpdef rect_color(self, int x, int y, int w, int h, int col):
+        cdef int * colors = self.cmap.data.as_ints
+        cdef int xx, yy
         for xx in xrange(x, x+w):
             for yy in xrange(y, y+h):
-                self.set_col_repeat(xx,yy,col)        
+                colors[self.get_index(xx,yy)] = col
     cpdef truncate(self):
         """Truncates the HeightMap to a valid (0-1) range.
         Do this before painting or writing to voxels to avoid crashing."""
+        cdef float * data = self.hmap.data.as_floats
+        cdef int idx
         for idx in xrange(0,len(self.hmap)):
-            self.hmap[idx] = min(max(self.hmap[idx],0.0),1.0)
+            if data[idx] < 0.0:
+                data[idx] = 0.0
+            elif data[idx] > 1.0:
+                data[idx] = 1.0
     cpdef offset_z(self, double qty):
+        cdef float * data = self.hmap.data.as_floats
+        cdef int idx
         for idx in xrange(0,len(self.hmap)):
-            self.hmap[idx] = self.hmap[idx]+qty
+            data[idx] = data[idx]+qty
     cpdef rescale_z(self, double multiple):
+        cdef float * data = self.hmap.data.as_floats
+        cdef int idx
         for idx in xrange(0,len(self.hmap)):
-            self.hmap[idx] = self.hmap[idx]*multiple
+            data[idx] = data[idx]*multiple
     cpdef paint_gradient_fill(self, gradient):
         """Surface the map with a single gradient."""
-        cdef zcoldef = gradient.array()        
-
-        cdef int idx = 0
+        cdef array.array zcoldef = gradient.array()
+        cdef float * data = self.hmap.data.as_floats
+        cdef int * colors = self.cmap.data.as_ints
+        cdef object rand = random.random
+        cdef int idx
         
-        while idx<len(self.hmap):
-            h = int(self.hmap[idx] * 63)
-            self.cmap[idx] = paint_gradient(zcoldef,h)
-            idx+=1
+        for idx in xrange(len(self.hmap)):
+            colors[idx] = paint_gradient(zcoldef, <int>(data[idx] * 63.0),
+                                         rand)
     cpdef rewrite_gradient_fill(self, list gradients):
         """Given a cmap of int-indexed gradient definitions,
         rewrite them as surface color definitions."""
 
-        cdef zcoldefs = []
+        cdef list zcoldefs = []
         for n in gradients:
             zcoldefs.append(n.array())
 
-        cdef int idx = 0
+        cdef float * data = self.hmap.data.as_floats
+        cdef int * colors = self.cmap.data.as_ints
+        cdef object rand = random.random
+        cdef int idx
         
-        while idx<len(self.hmap):
-            h = int(self.hmap[idx] * 63)
-            self.cmap[idx] = paint_gradient(zcoldefs[self.cmap[idx]],h)
-            idx+=1
+        for idx in xrange(len(self.hmap)):
+            colors[idx] = paint_gradient(zcoldefs[colors[idx]],
+                                         <int>(data[idx] * 63.0), rand)
     cpdef rgb_noise_colors(self, low, high):
         """Add noise to the heightmap colors."""
-        cdef int idx = 0
+        cdef int * colors = self.cmap.data.as_ints
+        cdef array.array patterns = array.array('i',
+            [random.randint(low,high) for n in xrange(101)])
+        cdef int * pattern = patterns.data.as_ints
+        cdef int count = len(patterns)
+        cdef int idx, mid, r, g, b
         
-        patterns = array.array('i', [random.randint(low,high) for n in xrange(101)])
-        
-        while idx<len(self.hmap):
-            mid = self.cmap[idx]
-            
-            r = max(0, min(0xFF,get_r(mid)+patterns[idx%len(patterns)]))
-            g = max(0, min(0xFF,get_g(mid)+patterns[(idx+1)%len(patterns)]))
-            b = max(0, min(0xFF,get_b(mid)+patterns[(idx+2)%len(patterns)]))
+        for idx in xrange(len(self.hmap)):
+            mid = colors[idx]
             
-            self.cmap[idx] = make_color(r,g,b)
+            r = max(0, min(0xFF,get_r(mid)+pattern[idx%count]))
+            g = max(0, min(0xFF,get_g(mid)+pattern[(idx+1)%count]))
+            b = max(0, min(0xFF,get_b(mid)+pattern[(idx+2)%count]))
             
-            idx+=1
+            colors[idx] = make_color(r,g,b)
             
     cpdef smooth_colors(self):
         """Average the color of each pixel to add smoothness."""
-        cdef int x = 0
-        cdef int y = 0
+        cdef array.array swap = array.copy(self.cmap)
+        cdef int * source = swap.data.as_ints
+        cdef int * colors = self.cmap.data.as_ints
+        cdef int left, right, up, down, mid, r, g, b
+        cdef int x, y
         
-        import copy        
-        
-        swap = copy.deepcopy(self.cmap)
-        
-        while y<self.height:
-            left = swap[((x-1)%self.width)+(y%self.height)*self.width]
-            right = swap[((x+1)%self.width)+(y%self.height)*self.width]
-            up = swap[((x)%self.width)+((y-1)%self.height)*self.width]
-            down = swap[((x)%self.width)+((y+1)%self.height)*self.width]
-            mid = swap[((x)%self.width)+((y)%self.height)*self.width]
-            
-            r = (get_r(left) + get_r(right) + get_r(up) + get_r(down) + get_r(mid))/5
-            g = (get_g(left) + get_g(right) + get_g(up) + get_g(down) + get_g(mid))/5
-            b = (get_b(left) + get_b(right) + get_b(up) + get_b(down) + get_b(mid))/5
-            
-            self.set_col_repeat(x,y,make_color(r,g,b))
-            
-            x += 1
-            if x>=self.width:
-                x = 0
-                y += 1
+        for y in xrange(self.height):
+            for x in xrange(self.width):
+                left = source[self.get_index(x-1,y)]
+                right = source[self.get_index(x+1,y)]
+                up = source[self.get_index(x,y-1)]
+                down = source[self.get_index(x,y+1)]
+                mid = source[self.get_index(x,y)]
+                
+                r = (get_r(left) + get_r(right) + get_r(up) + get_r(down) +
+                     get_r(mid))/5
+                g = (get_g(left) + get_g(right) + get_g(up) + get_g(down) +
+                     get_g(mid))/5
+                b = (get_b(left) + get_b(right) + get_b(up) + get_b(down) +
+                     get_b(mid))/5
+                
+                colors[self.get_index(x,y)] = make_color(r,g,b)
         
     cpdef write_vxl(self):
         cdef VXLData vxl = VXLData()
+        cdef array.array heights = array.clone(int_template,
+                                               len(self.hmap), False)
+        cdef float * data = self.hmap.data.as_floats
+        cdef int idx
 
-        cdef int x = 0
-        cdef int y = 0
-        cdef int h = 0
-        cdef int z = 0
-        cdef int idx = 0
-
-        while idx<len(self.hmap):
-            x = idx % self.width
-            y = idx // self.height
-            h = int(self.hmap[idx] * 63)
-            vxl.set_column_fast(x, y, h, 63, int(min(63,h+3)),
-                                self.cmap[idx])
-            idx+=1
+        for idx in xrange(len(self.hmap)):
+            heights.data.as_ints[idx] = get_z(data[idx])
+        vxl.set_columns(heights, self.cmap, 63, 3)
         return vxl
     cpdef line_add(self,int x,int y,
                 int x2,int y2,int radius, double depth):
-        cdef int posx, posy
-        for c in bresenham_line(x,y,x2,y2):
-            posx = c[0]
-            posy = c[1]
+        cdef array.array coords = bresenham_line(x,y,x2,y2)
+        cdef int * points = coords.data.as_ints
+        cdef float * data = self.hmap.data.as_floats
+        cdef int i, idx
+        for i in xrange(0, len(coords), 2):
             for x in xrange(-radius,radius+1):
                 for y in xrange(-radius,radius+1):
-                    self.add_repeat(posx+x,posy+y,depth)
+                    idx = self.get_index(points[i]+x,points[i+1]+y)
+                    data[idx] = data[idx] + depth
     cpdef line_set(self,int x,int y,
                 int x2,int y2,int radius, double height):
-        cdef int posx, posy
-        for c in bresenham_line(x,y,x2,y2):
-            posx = c[0]
-            posy = c[1]
+        cdef array.array coords = bresenham_line(x,y,x2,y2)
+        cdef int * points = coords.data.as_ints
+        cdef float * data = self.hmap.data.as_floats
+        cdef int i
+        for i in xrange(0, len(coords), 2):
             for x in xrange(-radius,radius+1):
                 for y in xrange(-radius,radius+1):
-                    self.set_repeat(posx+x,posy+y,height)
+                    data[self.get_index(points[i]+x,points[i+1]+y)] = height
 
-cdef lim_byte(int val):
+cdef inline int get_z(double height):
+    """Returns the voxel z of a height, or -1 if it is far out of range."""
+    cdef double z = height * 63
+    if z > -1.0 and z < 64.0:
+        return <int>z
+    return -1
+
+cdef inline int lim_byte(int val):
     return max(0,min(255,val))
 
+cdef inline int get_random_int(object rand, int a, int b):
+    """random.randint(a, b) without the call overhead. Uses the same
+    random() value, so the results are the same."""
+    return a + <int>(<double>rand() * (b - a + 1))
+
 cpdef inline int make_color(int r, int g, int b):
     return b | (g << 8) | (r << 16) | (<int>128 << 24)
 
@@ -440,18 +565,32 @@ cpdef inline int get_g(int color):
 cpdef inline int get_b(int color):
     return (color) & 0xFF
 
-cdef inline int paint_gradient(object zcoltable, int z):
+cdef inline int paint_gradient(array.array zcoltable, int z,
+                               object rand) except? -1:
     cdef int zz = z*3
-    cdef int rnd = random.randint(-4,4)
-    return make_color(lim_byte(zcoltable[zz]+rnd),
-                      lim_byte(zcoltable[zz+1]+rnd),
-                      lim_byte(zcoltable[zz+2]+rnd)
+    cdef int rnd = get_random_int(rand, -4, 4)
+    cdef int r, g, b
+    if zz >= 0 and zz+2 < len(zcoltable):
+        r = zcoltable.data.as_ints[zz]
+        g = zcoltable.data.as_ints[zz+1]
+        b = zcoltable.data.as_ints[zz+2]
+    else:
+        # heights out of range fail (or wrap) the way indexing the
+        # array does
+        r = zcoltable[zz]
+        g = zcoltable[zz+1]
+        b = zcoltable[zz+2]
+    return make_color(lim_byte(r+rnd),
+                      lim_byte(g+rnd),
+                      lim_byte(b+rnd)
                       )
 
-cdef inline list bresenham_line(int x, int y, int x2, int y2):
+cdef inline array.array bresenham_line(int x, int y, int x2, int y2):
+    """Returns the points on the line as an int array of x, y pairs."""
     cdef int steep = 0
-    cdef list coords = []
-    cdef int dx, dy, sx, sy, d
+    cdef array.array coords
+    cdef int * points
+    cdef int dx, dy, sx, sy, d, i
     dx = abs(x2 - x)
     if (x2 - x) > 0: sx = 1
     else: sx = -1
@@ -464,15 +603,22 @@ cdef inline list bresenham_line(int x, int y, int x2, int y2):
         dx,dy = dy,dx
         sx,sy = sy,sx
     d = (2 * dy) - dx
+    coords = array.clone(int_template, (dx + 1) * 2, False)
+    points = coords.data.as_ints
     for i in xrange(0,dx):
-        if steep: coords.append((y,x))
-        else: coords.append((x,y))
+        if steep:
+            points[i*2] = y
+            points[i*2+1] = x
+        else:
+            points[i*2] = x
+            points[i*2+1] = y
         while d >= 0:
             y = y + sy
             d = d - (2 * dx)
         x = x + sx
         d = d + (2 * dy)
-    coords.append((x2,y2))
+    points[dx*2] = x2
+    points[dx*2+1] = y2
     return coords    
 
 from color import *
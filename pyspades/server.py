@@ -27,6 +27,7 @@ from pyspades.types import MultikeyDict, IDPool
 from pyspades.master import get_master_connection
 from pyspades.collision import vector_collision, collision_3d
 from pyspades import world
+from pyspades import vxl
 from pyspades.debug import *
 from pyspades.weapon import WEAPONS
 import enet
@@ -93,6 +94,14 @@ def parse_command(input):
     splitted = [decode(value) for value in splitted]
     return decode(command), splitted
 
+def get_safe_search_location(location, center = True):
+    x, y, z = location
+    if center:
+        x -= 0.5
+        y -= 0.5
+        z += 0.5
+    return int(x), int(y), int(z)
+
 class SlidingWindow(object):
     def __init__(self, entries):
         self.entries = entries
@@ -128,6 +137,9 @@ class MapGeneratorChild(object):
     
     def data_left(self):
         return self.parent.data_left() or self.pos < self.parent.pos
+    
+    def get_buffers(self):
+        return self.parent.get_buffers()
 
 class ProgressiveMapGenerator(object):
     data = ''
@@ -170,6 +182,36 @@ class ProgressiveMapGenerator(object):
     
     def data_left(self):
         return bool(self.data) or self.generator is not None
+    
+    def get_buffers(self):
+        return [self.data, self.all_data]
+
+class CompressedMapStream(object):
+    """
+    Sends map data that has already been compressed, e.g. a cached transfer
+    stream of a map that hasn't been modified since it was loaded
+    """
+    pos = 0
+    def __init__(self, data):
+        self.data = data
+    
+    def get_size(self):
+        return len(self.data)
+    
+    def read(self, size):
+        pos = self.pos
+        data = self.data[pos:pos+size]
+        self.pos += len(data)
+        return data
+    
+    def get_child(self):
+        return CompressedMapStream(self.data)
+    
+    def data_left(self):
+        return self.pos < len(self.data)
+    
+    def get_buffers(self):
+        return [self.data]
 
 class ServerConnection(BaseConnection):
     address = None
@@ -632,30 +674,13 @@ class ServerConnection(BaseConnection):
                 self.protocol.map.get_solid(x, y, z + 3) == 1)
     
     def set_location_safe(self, location, center = True):
-        x, y, z = location
-        
-        if center:
-            x -= 0.5
-            y -= 0.5
-            z += 0.5
-        x = int(x)
-        y = int(y)
-        z = int(z)
-        
-        # search for valid locations near the specified point
-        modpos = 0
-        pos_table = self.protocol.pos_table
-        while (modpos<len(pos_table) and not
-               self.is_location_free(x + pos_table[modpos][0],
-                                     y + pos_table[modpos][1], 
-                                     z + pos_table[modpos][2])):
-            modpos+=1
-        if modpos == len(pos_table): # nothing nearby
+        x, y, z = get_safe_search_location(location, center)
+        # search for valid locations near the specified point, in the order
+        # of pos_table
+        location = self.protocol.map.find_free_location(x, y, z, 5)
+        if location is None: # nothing nearby
             return
-        x = x + pos_table[modpos][0]
-        y = y + pos_table[modpos][1]
-        z = z + pos_table[modpos][2]
-        self.set_location((x, y, z))
+        self.set_location(location)
         
     def set_location(self, location = None):
         if location is None:
@@ -684,9 +709,17 @@ class ServerConnection(BaseConnection):
     
     def respawn(self):
         if self.spawn_call is None:
-            self.spawn_call = reactor.callLater(
+            self.spawn_call = self.call_later(
                 self.get_respawn_time(), self.spawn)
     
+    def call_later(self, delay, func, *arg, **kw):
+        """
+        Schedules a call that belongs to this connection, such as a respawn
+        or a reload. Returns an object like the DelayedCall of
+        reactor.callLater
+        """
+        return reactor.callLater(delay, func, *arg, **kw)
+    
     def get_spawn_location(self):
         game_mode = self.protocol.game_mode
         if game_mode == TC_MODE:
@@ -728,6 +761,7 @@ class ServerConnection(BaseConnection):
                 position = Vertex3(x, y, z)
                 self.world_object = self.protocol.world.create_object(
                     world.Character, position, None, self._on_fall)
+                self.world_object.owner = self
             self.world_object.dead = False
             self.tool = WEAPON_TOOL
             self.refill(True)
@@ -872,7 +906,7 @@ class ServerConnection(BaseConnection):
         self.weapon = weapon
         if self.weapon_object is not None:
             self.weapon_object.reset()
-        self.weapon_object = WEAPONS[weapon](self._on_reload)
+        self.weapon_object = WEAPONS[weapon](self._on_reload, self.call_later)
         if not local:
             self.protocol.send_contained(change_weapon, save = True)
             if not no_kill:
@@ -916,7 +950,7 @@ class ServerConnection(BaseConnection):
     
     def _connection_ack(self):
         self._send_connection_data()
-        self.send_map(ProgressiveMapGenerator(self.protocol.map))
+        self.send_map(self.protocol.get_map_stream())
     
     def _send_connection_data(self):
         saved_loaders = self.saved_loaders = []
@@ -1004,24 +1038,30 @@ class ServerConnection(BaseConnection):
         z = position.z
         if x < 0 or x > 512 or y < 0 or y > 512 or z < 0 or z > 63:
             return
+        players = []
+        for character in self.protocol.world.players_in_box(x - 16, y - 16,
+                z - 16, x + 16, y + 16, z + 16):
+            player = character.owner
+            if player is not None and player.team is self.team.other:
+                players.append(player)
+        players.append(self)
         x = int(x)
         y = int(y)
         z = int(z)
-        for player_list in (self.team.other.get_players(), (self,)):
-            for player in player_list:
-                if not player.hp:
-                    continue
-                damage = grenade.get_damage(player.world_object.position)
-                if damage == 0:
-                    continue
-                returned = self.on_hit(damage, player, GRENADE_KILL, grenade)
-                if returned == False:
-                    continue
-                elif returned is not None:
-                    damage = returned
-                player.set_hp(player.hp - damage, self, 
-                    hit_indicator = position.get(), type = GRENADE_KILL,
-                    grenade = grenade)
+        for player in players:
+            if not player.hp:
+                continue
+            damage = grenade.get_damage(player.world_object.position)
+            if damage == 0:
+                continue
+            returned = self.on_hit(damage, player, GRENADE_KILL, grenade)
+            if returned == False:
+                continue
+            elif returned is not None:
+                damage = returned
+            player.set_hp(player.hp - damage, self, 
+                hit_indicator = position.get(), type = GRENADE_KILL,
+                grenade = grenade)
         if self.on_block_destroy(x, y, z, GRENADE_DESTROY) == False:
             return
         map = self.protocol.map
@@ -1444,6 +1484,7 @@ class ServerProtocol(BaseProtocol):
     master = False
     max_score = 10
     map = None
+    entity_map = None
     spade_teamkills_on_grief = False
     friendly_fire = False
     friendly_fire_time = 2
@@ -1502,6 +1543,18 @@ class ServerProtocol(BaseProtocol):
                                             abs(vec[1]*1.02) +\
                                             abs(vec[2]*1.01))
     
+    def set_locations_safe(self, items, center = True):
+        """
+        Like ServerConnection.set_location_safe for a list of (player,
+        location) pairs, without putting two players in the same spot
+        """
+        locations = self.map.find_free_locations(
+            [get_safe_search_location(location, center)
+             for (player, location) in items], 5)
+        for (player, _), location in zip(items, locations):
+            if location is not None:
+                player.set_location(location)
+    
     def send_contained(self, contained, unsequenced = False, sender = None,
                        team = None, save = False, rule = None):
         if unsequenced:
@@ -1594,6 +1647,46 @@ class ServerProtocol(BaseProtocol):
         world_update.items = items
         self.send_contained(world_update, unsequenced = True)
     
+    def get_map_stream(self, parent = False):
+        return ProgressiveMapGenerator(self.map, parent)
+    
+    def get_map_buffers(self):
+        """
+        Returns the buffers of compressed map data kept for map transfers
+        """
+        buffers = []
+        for connection in self.connections.values():
+            if connection.map_data is not None:
+                buffers.extend(connection.map_data.get_buffers())
+        return buffers
+    
+    def get_memory_usage(self):
+        """
+        Returns (name, count, bytes) tuples for the maps and the buffers kept
+        for connections
+        """
+        usage = vxl.get_memory_usage()
+        # streams can share their buffers with each other
+        buffers = {}
+        for data in self.get_map_buffers():
+            if data:
+                buffers[id(data)] = len(data)
+        saved = saved_size = in_transit = 0
+        for connection in self.connections.values():
+            if connection.saved_loaders is not None:
+                saved += len(connection.saved_loaders)
+                saved_size += sum([len(data)
+                    for data in connection.saved_loaders])
+            in_transit += connection.peer.reliableDataInTransit
+        return [
+            ('maps',) + usage['maps'],
+            ('map generators',) + usage['generators'],
+            ('map buffers', 1, usage['shared']),
+            ('map transfers', len(buffers), sum(buffers.values())),
+            ('saved packets', saved, saved_size),
+            ('packets in transit', len(self.connections), in_transit)
+        ]
+    
     def set_map(self, map):
         self.map = map
         self.world.map = map
@@ -1604,7 +1697,7 @@ class ServerProtocol(BaseProtocol):
             self.reset_tc()
         self.players = MultikeyDict()
         if self.connections:
-            data = ProgressiveMapGenerator(self.map, parent = True)
+            data = self.get_map_stream(parent = True)
             for connection in self.connections.values():
                 if connection.player_id is None:
                     continue
@@ -1691,9 +1784,20 @@ class ServerProtocol(BaseProtocol):
                 count += 1
         self.master_connection.set_count(count)
     
-    def update_entities(self):
+    def update_entities(self, force = False):
+        """
+        Moves the entities standing on changed columns back onto the ground.
+        If force is set, or the map was replaced, all entities are checked
+        """
         map = self.map
+        columns = map.pop_dirty_columns()
+        if map is not self.entity_map:
+            self.entity_map = map
+            columns = None
         for entity in self.entities:
+            if (not force and columns is not None and
+                    (int(entity.x), int(entity.y)) not in columns):
+                continue
             moved = False
             if map.get_solid(entity.x, entity.y, entity.z - 1):
                 moved = True
@@ -1,20 +1,30 @@
+from cpython cimport array
+
 cdef extern from "vxl_c.cpp":
     enum:
         MAP_X
         MAP_Y
         MAP_Z
         DEFAULT_COLOR
+        OVERVIEW_TILE_SIZE
+        OVERVIEW_TILES
     struct MapData:
-        pass
+        unsigned int revision
+        unsigned int * tile_revisions
     struct MapGenerator:
-        pass
+        MapData * map
     MapGenerator * create_map_generator(MapData * original)
     void delete_map_generator(MapGenerator * generator)
     object get_generator_data(MapGenerator * generator, int columns)
-    MapData * load_vxl(unsigned char * v)
+    MapData * load_vxl(unsigned char * v) nogil
+    long validate_vxl(unsigned char * v, size_t size) nogil
     MapData * copy_map(MapData * map)
+    void set_columns(MapData * map, int * heights, int * colors, int end_z,
+        int color_depth)
     void delete_vxl(MapData * map)
     object save_vxl(MapData * map)
+    size_t get_map_memory(MapData * map)
+    size_t get_shared_memory()
     int check_node(int x, int y, int z, MapData * map, int destroy)
     bint get_solid(int x, int y, int z, MapData * map)
     int get_color(int x, int y, int z, MapData * map)
@@ -25,15 +35,24 @@ cdef extern from "vxl_c.cpp":
         MapData * map, int color)
     int get_random_point(int x1, int y1, int x2, int y2, MapData * map, 
         float random_1, float random_2, int * x, int * y)
+    int get_land_count(int x1, int y1, int x2, int y2, MapData * map)
+    int get_dirty_count(MapData * map)
+    int get_dirty_column(int i, MapData * map)
+    bint clear_dirty_columns(MapData * map)
+    int find_free_locations(int * positions, char * found, int count,
+        int radius, int clearance, MapData * map, bint distinct)
     bint is_valid_position(int x, int y, int z)
 
 cdef class VXLData:
     cdef MapData * map
+    cdef object __weakref__
     
     cpdef get_solid(self, int x, int y, int z)
     cpdef get_color(self, int x, int y, int z)
     cpdef tuple get_random_point(self, int x1, int y1, int x2, int y2)
     cpdef int get_z(self, int x, int y, int start = ?)
+    cdef int draw_overview(self, unsigned int * data, int x1, int y1,
+        int width, int height, int z, bint rgba) except -1
     cpdef int get_height(self, int x, int y)
     cpdef bint has_neighbors(self, int x, int y, int z)
     cpdef bint is_surface(self, int x, int y, int z)
@@ -41,4 +60,6 @@ cdef class VXLData:
     cpdef bint check_node(self, int x, int y, int z, bint destroy = ?)
     cpdef bint build_point(self, int x, int y, int z, tuple color)
     cpdef bint set_column_fast(self, int x, int y, int start_z,
-        int end_z, int end_color_z, int color)
\ No newline at end of file
+        int end_z, int end_color_z, int color)
+    cpdef set_columns(self, array.array heights, array.array colors,
+        int end_z, int color_depth)
\ No newline at end of file
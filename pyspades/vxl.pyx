@@ -16,6 +16,7 @@
 # along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
 
 from pyspades.common cimport allocate_memory
+from cpython cimport array
 
 cdef tuple make_color_tuple(int color):
     cdef int r, g, b, a
@@ -30,15 +31,59 @@ cpdef inline int make_color(int r, int g, int b, int a = 255):
 
 import time
 import random
+import mmap
+import weakref
+import threading
+from pyspades.exceptions import InvalidData
+
+# id -> weak reference of the live maps and generators. Maps are also
+# created and freed by map preparation threads, so the dicts are only changed
+# and read under live_lock, and entries are removed when the object is freed
+# rather than by weak reference callbacks. The lock is reentrant, as a
+# garbage collection while it is held can free one of them
+live_lock = threading.RLock()
+live_maps = {}
+live_generators = {}
+
+cdef add_live(dict live, value):
+    ref = weakref.ref(value)
+    with live_lock:
+        live[id(value)] = ref
+
+cdef release_live(dict live, value):
+    # the module can already be torn down at exit
+    if live is None or live_lock is None:
+        return
+    with live_lock:
+        live.pop(id(value), None)
+
+cdef list get_live(dict live):
+    """
+    Returns the objects of the given dict that are still alive
+    """
+    with live_lock:
+        refs = live.values()
+    values = []
+    for ref in refs:
+        value = ref()
+        if value is not None:
+            values.append(value)
+    return values
+
+cdef extern from "Python.h":
+    int PyObject_AsReadBuffer(object obj, const void ** buffer,
+        Py_ssize_t * buffer_len) except -1
 
 cdef class Generator:
     cdef MapGenerator * generator
+    cdef object __weakref__
     cdef public:
         bint done
     
     def __init__(self, VXLData data):
         self.done = False
         self.generator = create_map_generator(data.map)
+        add_live(live_generators, self)
     
     def get_data(self, int columns = 2):
         if self.done:
@@ -49,27 +94,89 @@ cdef class Generator:
             return None
         return value
     
+    def get_memory_usage(self):
+        """
+        Returns the bytes used by the copy of the map being generated
+        """
+        return sizeof(MapGenerator) + get_map_memory(self.generator.map)
+    
     def __dealloc__(self):
+        release_live(live_generators, self)
         delete_map_generator(self.generator)
 
+def get_memory_usage():
+    """
+    Returns the number of live maps and map generators and the bytes they
+    use as (count, bytes) tuples, and the bytes used by the buffers they
+    share
+    """
+    maps = get_live(live_maps)
+    generators = get_live(live_generators)
+    return {
+        'maps' : (len(maps), sum([map.get_memory_usage() for map in maps])),
+        'generators' : (len(generators), sum([generator.get_memory_usage()
+            for generator in generators])),
+        'shared' : get_shared_memory()
+    }
+
+cdef MapData * load_data(data) except NULL:
+    cdef const void * buffer
+    cdef Py_ssize_t size
+    cdef long error
+    cdef MapData * map
+    PyObject_AsReadBuffer(data, &buffer, &size)
+    # parsing can take a while, so allow map preparation threads to run
+    # alongside the reactor
+    with nogil:
+        error = validate_vxl(<unsigned char*>buffer, size)
+        if error == -1:
+            map = load_vxl(<unsigned char*>buffer)
+    if error != -1:
+        raise InvalidData('invalid VXL data at offset %s' % error)
+    return map
+
 cdef class VXLData:
     def __init__(self, fp = None):
-        cdef unsigned char * c_data
-        if fp is not None:
-            data = fp.read()
-            c_data = data
+        add_live(live_maps, self)
+        if fp is None:
+            self.map = load_vxl(NULL)
+            return
+        # memory maps are parsed in place instead of being read into a
+        # string first
+        if isinstance(fp, mmap.mmap):
+            data = fp
         else:
-            c_data = NULL
-        self.map = load_vxl(c_data)
+            data = fp.read()
+        self.map = load_data(data)
     
     def load_vxl(self, c_data = None):
-        self.map = load_vxl(c_data)
+        cdef MapData * map
+        if c_data is None:
+            map = load_vxl(NULL)
+        else:
+            map = load_data(c_data)
+        if self.map != NULL:
+            delete_vxl(self.map)
+        self.map = map
     
     def copy(self):
-        cdef VXLData map = VXLData()
+        # skips __init__, so no empty map is loaded only to be replaced
+        cdef VXLData map = VXLData.__new__(VXLData)
         map.map = copy_map(self.map)
+        add_live(live_maps, map)
         return map
     
+    def get_memory_usage(self):
+        """
+        Returns the bytes used by the map data
+        """
+        if self.map == NULL:
+            return 0
+        return get_map_memory(self.map)
+    
+    def get_revision(self):
+        return self.map.revision
+    
     def get_point(self, int x, int y, int z):
         color = self.get_color(x, y, z)
         solid = color is not None
@@ -108,13 +215,61 @@ cdef class VXLData:
             random.random(), &x, &y)
         return x, y
     
-    def count_land(self, int x1, y1, x2, y2):
-        cdef int land = 0
-        for x in xrange(x1, x2):
-            for y in xrange(y1, y2):
-                if self.get_solid(x, y, 62):
-                    land += 1
-        return land
+    def find_free_location(self, int x, int y, int z, int radius = 5,
+                           int clearance = 3):
+        """
+        Returns the nearest location within radius of the given one with
+        clearance free blocks and a solid one below, or None
+        """
+        cdef int position[3]
+        cdef char found
+        if radius < 0 or clearance < 0:
+            raise ValueError('invalid radius or clearance')
+        position[0] = x
+        position[1] = y
+        position[2] = z
+        find_free_locations(position, &found, 1, radius, clearance,
+            self.map, False)
+        if not found:
+            return None
+        return position[0], position[1], position[2]
+    
+    def find_free_locations(self, locations, int radius = 5,
+                            int clearance = 3, bint distinct = True):
+        """
+        Like find_free_location, for a list of locations. If distinct is
+        set, no location is returned twice, so players placed at the
+        results don't end up inside each other
+        """
+        cdef int * positions
+        cdef char * found
+        cdef int i, count = len(locations)
+        if radius < 0 or clearance < 0:
+            raise ValueError('invalid radius or clearance')
+        positions_python = allocate_memory(sizeof(int) * 3 * count,
+            <char**>&positions)
+        found_python = allocate_memory(count, &found)
+        for i, (x, y, z) in enumerate(locations):
+            positions[i * 3] = x
+            positions[i * 3 + 1] = y
+            positions[i * 3 + 2] = z
+        find_free_locations(positions, found, count, radius, clearance,
+            self.map, distinct)
+        results = []
+        for i in range(count):
+            if found[i]:
+                results.append((positions[i * 3], positions[i * 3 + 1],
+                    positions[i * 3 + 2]))
+            else:
+                results.append(None)
+        return results
+    
+    def count_land(self, int x1, int y1, int x2, int y2):
+        x1 = max(0, min(x1, MAP_X))
+        y1 = max(0, min(y1, MAP_Y))
+        x2 = max(0, min(x2, MAP_X))
+        y2 = max(0, min(y2, MAP_Y))
+        return get_land_count(x1, y1, x2, y2, self.map)
     
     def destroy_point(self, int x, int y, int z):
         if not self.get_solid(x, y, z) or z >= 62:
@@ -193,18 +348,83 @@ cdef class VXLData:
         set_column_color(x, y, z_start, z_color_end, self.map, color)
         return True
     
+    cpdef set_columns(self, array.array heights, array.array colors,
+        int z_end, int color_depth):
+        """Set every column of the map at once. heights and colors are int
+            arrays indexed by x + y * 512, and each column is set like
+            set_column_fast(x, y, height, z_end, height + color_depth,
+            color) would. Columns with a height outside the map are
+            skipped."""
+        if (heights.ob_descr.typecode != 'i' or
+            colors.ob_descr.typecode != 'i'):
+            raise TypeError('heights and colors must be int arrays')
+        if len(heights) != MAP_X * MAP_Y or len(colors) != MAP_X * MAP_Y:
+            raise ValueError('heights and colors must have a value for '
+                             'every column')
+        if not 0 <= z_end < MAP_Z or color_depth < 0:
+            raise ValueError('invalid column range')
+        set_columns(self.map, heights.data.as_ints, colors.data.as_ints,
+            z_end, color_depth)
+    
     def get_overview(self, int z = -1, bint rgba = False):
         cdef unsigned int * data
-        cdef unsigned int i, r, g, b, a, color
         data_python = allocate_memory(sizeof(int[512][512]), <char**>&data)
+        self.draw_overview(data, 0, 0, 512, 512, z, rgba)
+        return data_python
+    
+    def pop_dirty_columns(self):
+        """
+        Returns the set of (x, y) columns that changed since the last call,
+        or None if too many changed to keep track of them
+        """
+        cdef int i, index
+        columns = set()
+        for i in range(get_dirty_count(self.map)):
+            index = get_dirty_column(i, self.map)
+            columns.add((index % MAP_X, index / MAP_X))
+        if not clear_dirty_columns(self.map):
+            return None
+        return columns
+    
+    def get_overview_tile(self, int tile_x, int tile_y, int z = -1,
+                          bint rgba = False):
+        """
+        Returns the overview of the OVERVIEW_TILE_SIZE * OVERVIEW_TILE_SIZE
+        columns of the given tile
+        """
+        if not (0 <= tile_x < OVERVIEW_TILES and 0 <= tile_y < OVERVIEW_TILES):
+            raise IndexError('invalid tile')
+        cdef unsigned int * data
+        data_python = allocate_memory(
+            sizeof(int) * OVERVIEW_TILE_SIZE * OVERVIEW_TILE_SIZE,
+            <char**>&data)
+        self.draw_overview(data, tile_x * OVERVIEW_TILE_SIZE,
+            tile_y * OVERVIEW_TILE_SIZE, OVERVIEW_TILE_SIZE,
+            OVERVIEW_TILE_SIZE, z, rgba)
+        return data_python
+    
+    def get_tile_revision(self, int tile_x, int tile_y):
+        """
+        Returns a number that changes whenever the columns of the given
+        overview tile are modified
+        """
+        if not (0 <= tile_x < OVERVIEW_TILES and 0 <= tile_y < OVERVIEW_TILES):
+            raise IndexError('invalid tile')
+        return self.map.tile_revisions[tile_x + tile_y * OVERVIEW_TILES]
+    
+    cdef int draw_overview(self, unsigned int * data, int x1, int y1,
+                           int width, int height, int z,
+                           bint rgba) except -1:
+        cdef unsigned int i, r, g, b, a, color
+        cdef int x, y
         i = 0
         cdef int current_z
         if z == -1:
             a = 255
         else:
             current_z = z
-        for y in xrange(512):
-            for x in xrange(512):
+        for y in xrange(y1, y1 + height):
+            for x in xrange(x1, x1 + width):
                 if z == -1:
                     current_z = self.get_z(x, y)
                 else:
@@ -221,7 +441,7 @@ cdef class VXLData:
                 else:
                     data[i] = (color & 0x00FFFFFF) | (a << 24)
                 i += 1
-        return data_python
+        return 0
     
     def set_overview(self, data_str, int z):
         cdef unsigned int * data
@@ -251,6 +471,7 @@ cdef class VXLData:
     
     def __dealloc__(self):
         cdef MapData * map
+        release_live(live_maps, self)
         if self.map != NULL:
             map = self.map
             self.map = NULL
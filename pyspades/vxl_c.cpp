@@ -20,7 +20,9 @@
 
 #include "Python.h"
 #include "vxl_c.h"
+#include <math.h>
 #include <vector>
+#include <algorithm>
 
 using namespace std;
 
@@ -35,6 +37,47 @@ void inline limit(int * value, int min, int max)
     }
 }
 
+// checks that the spans of every column lie within the data and describe
+// increasing, in-range heights, so load_vxl can decode them without any
+// checks of its own. Returns the offset of the first invalid span, or -1 if
+// the data is valid
+long validate_vxl(unsigned char * v, size_t size)
+{
+    unsigned char * start = v;
+    unsigned char * end = v + size;
+    for (int i = 0; i < MAP_X * MAP_Y; i++) {
+        int z = 0;
+        for (;;) {
+            if (end - v < 4)
+                return v - start;
+            int number_4byte_chunks = v[0];
+            int top_color_start = v[1];
+            int top_color_end = v[2]; // inclusive
+            int len_bottom = top_color_end - top_color_start + 1;
+            if (top_color_start < z || top_color_start > MAP_Z ||
+                top_color_end >= MAP_Z || len_bottom < 0 ||
+                end - v < 4 * (len_bottom + 1))
+                return v - start;
+            if (number_4byte_chunks == 0) {
+                v += 4 * (len_bottom + 1);
+                break;
+            }
+            int len_top = (number_4byte_chunks - 1) - len_bottom;
+            if (len_top < 0 || end - v < number_4byte_chunks * 4 + 4)
+                return v - start;
+            unsigned char * next = v + number_4byte_chunks * 4;
+            int bottom_color_end = next[3]; // aka air start
+            int bottom_color_start = bottom_color_end - len_top;
+            if (bottom_color_end > MAP_Z ||
+                bottom_color_start <= top_color_end)
+                return next - start;
+            z = bottom_color_end;
+            v = next;
+        }
+    }
+    return -1;
+}
+
 MapData * load_vxl(unsigned char * v)
 {
    MapData * map = new MapData;
@@ -175,8 +218,12 @@ int check_node(int x, int y, int z, MapData * map, int destroy)
         for (set_type<int>::const_iterator iter = marked.begin(); 
              iter != marked.end(); ++iter)
         {
-            map->geometry[*iter] = 0;
-            map->colors.erase(*iter);
+            int i = *iter;
+            mark_column(i % MAP_X, (i / MAP_X) % MAP_Y, map);
+            map->geometry[i] = 0;
+            map->colors.erase(i);
+            if (i / (MAP_X * MAP_Y) == LAND_Z)
+                update_land(i % MAP_X, (i / MAP_X) % MAP_Y, map);
         }
     }
     
@@ -223,12 +270,13 @@ inline void write_color(char ** out, int color)
    *out += 1;
 }
 
+#define OUT_GLOBAL_SIZE (10 * 1024 * 1024) // allocate 10 mb
 char * out_global = 0;
 
 void create_temp()
 {
    if (out_global == 0)
-       out_global = (char *)malloc(10 * 1024 * 1024); // allocate 10 mb
+       out_global = (char *)malloc(OUT_GLOBAL_SIZE);
 }
 
 PyObject * save_vxl(MapData * map)
@@ -331,16 +379,56 @@ inline MapData * copy_map(MapData * map)
     return new MapData(*map);
 }
 
-struct Point2D
+// sets every column of the map from heights and colors indexed by
+// x + y * MAP_X, like set_column_fast would: solid from the height down to
+// z_end, and colored color_depth blocks deep. Columns with a height outside
+// the map are left alone
+void set_columns(MapData * map, const int * heights, const int * colors,
+    int z_end, int color_depth)
 {
-    int x, y;
-};
+    // make room for all the colors up front instead of rehashing as the
+    // table grows
+    size_t count = map->colors.size() +
+        size_t(color_depth + 1) * MAP_X * MAP_Y;
+    map->colors.rehash(size_t(count / map->colors.max_load_factor()) + 1);
+    int i = 0;
+    for (int y = 0; y < MAP_Y; y++) {
+        for (int x = 0; x < MAP_X; x++, i++) {
+            int z = heights[i];
+            if (z < 0 || z > z_end)
+                continue;
+            set_column_solid(x, y, z, z_end, map, true);
+            set_column_color(x, y, z, std::min(z_end, z + color_depth), map,
+                colors[i]);
+        }
+    }
+}
+
+// heap memory of a boost::unordered_map/set, following the node layout of
+// the bundled boost (the value, the next pointer and the cached hash) and
+// its bucket array with the extra sentinel bucket. Allocator overhead is
+// not included
+template <class T>
+inline size_t get_table_memory(const T & table)
+{
+    size_t node = sizeof(typename T::value_type) + sizeof(void*) +
+        sizeof(size_t);
+    return (table.bucket_count() + 1) * sizeof(void*) + table.size() * node;
+}
+
+size_t get_map_memory(MapData * map)
+{
+    return sizeof(MapData) + get_table_memory(map->colors) +
+        map->dirty_columns.capacity() * sizeof(int);
+}
 
 inline unsigned int random(unsigned int a, unsigned int b, float value)
 {
     return (unsigned int)(value * (b - a) + a);
 }
 
+// picks a random land column in the area, which is the same one a scan of
+// the area in x, y order would pick for the same random value
 inline void get_random_point(int x1, int y1, int x2, int y2, MapData * map,
                              float random_1, float random_2,
                              int * end_x, int * end_y)
@@ -349,28 +437,137 @@ inline void get_random_point(int x1, int y1, int x2, int y2, MapData * map,
     limit(&y1, 0, 511);
     limit(&x2, 0, 511);
     limit(&y2, 0, 511);
-    vector<Point2D> items;
-    int size = 0;
-    int x, y;
-    for(x = x1; x < x2; x++){
-        for(y = y1; y < y2; y++) {
-            if (map->geometry[get_pos(x, y, 62)]) {
-                Point2D item;
-                item.x = x;
-                item.y = y;
-                items.push_back(item);
-                size += 1;
-            }
-        }
-    }
+    int size = get_land_count(x1, y1, x2, y2, map);
     if (size == 0) {
         *end_x = random(x1, x2, random_1);
         *end_y = random(y1, y2, random_2);
-    } else {
-        Point2D item = items[random(0, size, random_1)];
-        *end_x = item.x;
-        *end_y = item.y;
+        return;
+    }
+    int index = random(0, size, random_1);
+    if (index >= size)
+        index = size - 1;
+    // find the column, then the row within it
+    int low = x1, high = x2 - 1, middle;
+    while (low < high) {
+        middle = (low + high) / 2;
+        if (get_land_count(x1, y1, middle + 1, y2, map) > index)
+            high = middle;
+        else
+            low = middle + 1;
     }
+    int x = low;
+    index -= get_land_count(x1, y1, x, y2, map);
+    low = y1;
+    high = y2 - 1;
+    while (low < high) {
+        middle = (low + high) / 2;
+        if (get_land_count(x, y1, x + 1, middle + 1, map) > index)
+            high = middle;
+        else
+            low = middle + 1;
+    }
+    *end_x = x;
+    *end_y = low;
+}
+
+// offsets around a point, nearest first, in the order of the pos_table of
+// ServerProtocol
+
+struct OffsetKey
+{
+    double key;
+    Position offset;
+
+    bool operator<(const OffsetKey & other) const
+    {
+        return key < other.key;
+    }
+};
+
+static map_type<int, vector<Position> > offset_tables;
+
+const vector<Position> & get_offset_table(int radius)
+{
+    map_type<int, vector<Position> >::iterator iter =
+        offset_tables.find(radius);
+    if (iter != offset_tables.end())
+        return iter->second;
+    vector<OffsetKey> keys;
+    for (int x = -radius; x <= radius; x++)
+    for (int y = -radius; y <= radius; y++)
+    for (int z = -radius; z <= radius; z++) {
+        OffsetKey item;
+        item.key = fabs(x * 1.03) + fabs(y * 1.02) + fabs(z * 1.01);
+        item.offset.x = x;
+        item.offset.y = y;
+        item.offset.z = z;
+        keys.push_back(item);
+    }
+    stable_sort(keys.begin(), keys.end());
+    vector<Position> & table = offset_tables[radius];
+    for (size_t i = 0; i < keys.size(); i++)
+        table.push_back(keys[i].offset);
+    return table;
+}
+
+// clearance free voxels with a solid one below them
+inline bool is_location_free(int x, int y, int z, int clearance,
+                             MapData * map)
+{
+    if (!is_valid_position(x, y, z) ||
+        !is_valid_position(x, y, z + clearance))
+        return false;
+    for (int i = 0; i < clearance; i++) {
+        if (map->geometry[get_pos(x, y, z + i)])
+            return false;
+    }
+    return map->geometry[get_pos(x, y, z + clearance)];
+}
+
+// looks for a free location near each of the count points in positions,
+// and replaces them with the location found. If distinct is set, locations
+// that were already handed out are skipped. Returns the number of points
+// a location was found for, and sets found[i] accordingly
+int find_free_locations(int * positions, char * found, int count, int radius,
+                        int clearance, MapData * map, bool distinct)
+{
+    const vector<Position> & table = get_offset_table(radius);
+    set_type<int> taken;
+    int found_count = 0;
+    for (int i = 0; i < count; i++) {
+        int * position = positions + i * 3;
+        found[i] = 0;
+        for (size_t j = 0; j < table.size(); j++) {
+            int x = position[0] + table[j].x;
+            int y = position[1] + table[j].y;
+            int z = position[2] + table[j].z;
+            if (!is_location_free(x, y, z, clearance, map))
+                continue;
+            if (distinct && !taken.insert(get_pos(x, y, z)).second)
+                continue;
+            position[0] = x;
+            position[1] = y;
+            position[2] = z;
+            found[i] = 1;
+            found_count++;
+            break;
+        }
+    }
+    return found_count;
+}
+
+// memory of the buffers shared by all maps
+size_t get_shared_memory()
+{
+    size_t size = get_table_memory(marked) + get_table_memory(offset_tables);
+    if (nodes != NULL)
+        size += nodes_size * sizeof(Position);
+    if (out_global != 0)
+        size += OUT_GLOBAL_SIZE;
+    map_type<int, vector<Position> >::const_iterator iter;
+    for (iter = offset_tables.begin(); iter != offset_tables.end(); iter++)
+        size += iter->second.capacity() * sizeof(Position);
+    return size;
 }
 
 struct MapGenerator
@@ -2,6 +2,8 @@
 #define VXL_C_H
 
 #include <bitset>
+#include <vector>
+#include <string.h>
 #include <boost/unordered_map.hpp>
 #include <boost/unordered_set.hpp>
 
@@ -13,14 +15,154 @@
 #define MAP_Z 64
 #define get_pos(x, y, z) (x + (y) * MAP_Y + (z) * MAP_X * MAP_Y)
 #define DEFAULT_COLOR 0xFF674028
+#define OVERVIEW_TILE_SIZE 32
+#define OVERVIEW_TILES (MAP_X / OVERVIEW_TILE_SIZE)
+// columns that are solid at this height count as land
+#define LAND_Z 62
+// past this, changed columns are no longer listed one by one
+#define MAX_DIRTY_COLUMNS 4096
 
 struct MapData
 {
     std::bitset<MAP_X * MAP_Y * MAP_Z> geometry;
     // char geometry[MAP_X * MAP_Y * MAP_Z];
     map_type<int, int> colors;
+    // bumped on every modification, so data derived from the map can be
+    // checked for staleness
+    unsigned int revision;
+    // same, for each OVERVIEW_TILE_SIZE * OVERVIEW_TILE_SIZE area of columns
+    unsigned int tile_revisions[OVERVIEW_TILES * OVERVIEW_TILES];
+    // 2D Fenwick tree over the land columns, and the land columns it was
+    // built from. Code that writes to the geometry directly has to reset
+    // land_valid, and the index is rebuilt when it is next used
+    int land_tree[MAP_X * MAP_Y];
+    std::bitset<MAP_X * MAP_Y> land;
+    bool land_valid;
+    // columns changed since they were last collected, in order. If there
+    // were more than MAX_DIRTY_COLUMNS, dirty_overflow is set instead
+    std::bitset<MAP_X * MAP_Y> dirty;
+    std::vector<int> dirty_columns;
+    bool dirty_overflow;
+
+    MapData() : revision(0), land_valid(false), dirty_overflow(false)
+    {
+        memset(tile_revisions, 0, sizeof(tile_revisions));
+    }
 };
 
+void inline add_land(int x, int y, int value, MapData * map)
+{
+    for (int i = x + 1; i <= MAP_X; i += i & -i)
+        for (int j = y + 1; j <= MAP_Y; j += j & -j)
+            map->land_tree[(i - 1) + (j - 1) * MAP_X] += value;
+}
+
+void inline build_land_index(MapData * map)
+{
+    int * tree = map->land_tree;
+    int x, y, i;
+    for (y = 0; y < MAP_Y; y++) {
+        for (x = 0; x < MAP_X; x++) {
+            bool solid = map->geometry[x + y * MAP_X + LAND_Z * MAP_X * MAP_Y];
+            map->land[x + y * MAP_X] = solid;
+            tree[x + y * MAP_X] = solid;
+        }
+    }
+    // the tree can be built in linear time, one dimension at a time
+    for (y = 0; y < MAP_Y; y++) {
+        for (x = 1; x <= MAP_X; x++) {
+            i = x + (x & -x);
+            if (i <= MAP_X)
+                tree[(i - 1) + y * MAP_X] += tree[(x - 1) + y * MAP_X];
+        }
+    }
+    for (x = 0; x < MAP_X; x++) {
+        for (y = 1; y <= MAP_Y; y++) {
+            i = y + (y & -y);
+            if (i <= MAP_Y)
+                tree[x + (i - 1) * MAP_X] += tree[x + (y - 1) * MAP_X];
+        }
+    }
+    map->land_valid = true;
+}
+
+void inline update_land(int x, int y, MapData * map)
+{
+    if (!map->land_valid)
+        return;
+    int i = x + y * MAP_X;
+    bool solid = map->geometry[i + LAND_Z * MAP_X * MAP_Y];
+    if (solid == map->land[i])
+        return;
+    map->land[i] = solid;
+    add_land(x, y, solid ? 1 : -1, map);
+}
+
+// land columns with x < x2 and y < y2
+int inline get_land_prefix(int x2, int y2, MapData * map)
+{
+    int count = 0;
+    for (int i = x2; i > 0; i -= i & -i)
+        for (int j = y2; j > 0; j -= j & -j)
+            count += map->land_tree[(i - 1) + (j - 1) * MAP_X];
+    return count;
+}
+
+// land columns with x1 <= x < x2 and y1 <= y < y2, with the bounds already
+// limited to the map
+int inline get_land_count(int x1, int y1, int x2, int y2, MapData * map)
+{
+    if (x2 <= x1 || y2 <= y1)
+        return 0;
+    if (!map->land_valid)
+        build_land_index(map);
+    return get_land_prefix(x2, y2, map) - get_land_prefix(x1, y2, map) -
+           get_land_prefix(x2, y1, map) + get_land_prefix(x1, y1, map);
+}
+
+void inline mark_column(int x, int y, MapData * map)
+{
+    map->revision++;
+    map->tile_revisions[x / OVERVIEW_TILE_SIZE +
+                        (y / OVERVIEW_TILE_SIZE) * OVERVIEW_TILES]++;
+    if (map->dirty_overflow)
+        return;
+    int i = x + y * MAP_X;
+    if (map->dirty[i])
+        return;
+    if (map->dirty_columns.size() >= MAX_DIRTY_COLUMNS) {
+        map->dirty_overflow = true;
+        return;
+    }
+    map->dirty[i] = true;
+    map->dirty_columns.push_back(i);
+}
+
+int inline get_dirty_count(MapData * map)
+{
+    return map->dirty_columns.size();
+}
+
+int inline get_dirty_column(int i, MapData * map)
+{
+    return map->dirty_columns[i];
+}
+
+// resets the changed columns, returns false if they overflowed
+bool inline clear_dirty_columns(MapData * map)
+{
+    bool overflow = map->dirty_overflow;
+    if (overflow)
+        map->dirty.reset();
+    else {
+        for (size_t i = 0; i < map->dirty_columns.size(); i++)
+            map->dirty[map->dirty_columns[i]] = false;
+    }
+    map->dirty_columns.clear();
+    map->dirty_overflow = false;
+    return !overflow;
+}
+
 int inline is_valid_position(int x, int y, int z)
 {
     return x >= 0 && x < 512 && y >= 0 && y < 512 && z >= 0 && z < 64;
@@ -45,11 +187,14 @@ int inline get_color(int x, int y, int z, MapData * map)
 void inline set_point(int x, int y, int z, MapData * map, bool solid, int color)
 {
     int i = get_pos(x, y, z);
+    mark_column(x, y, map);
     map->geometry[i] = solid;
     if (!solid)
         map->colors.erase(i);
     else
         map->colors[i] = color;
+    if (z == LAND_Z)
+        update_land(x, y, map);
 }
 
 void inline set_column_solid(int x, int y, int z_start, int z_end,
@@ -57,6 +202,7 @@ void inline set_column_solid(int x, int y, int z_start, int z_end,
 {
     int i = get_pos(x, y, z_start);
     int i_end = get_pos(x, y, z_end);
+    mark_column(x, y, map);
     if (!solid)
     {
         while (i <= i_end)
@@ -73,6 +219,8 @@ void inline set_column_solid(int x, int y, int z_start, int z_end,
             i += MAP_X * MAP_Y;
         }
     }
+    if (z_start <= LAND_Z && LAND_Z <= z_end)
+        update_land(x, y, map);
 }
 
 void inline set_column_color(int x, int y, int z_start, int z_end,
@@ -80,6 +228,7 @@ void inline set_column_color(int x, int y, int z_start, int z_end,
 {
     int i = get_pos(x, y, z_start);
     int i_end = get_pos(x, y, z_end);
+    mark_column(x, y, map);
     while (i <= i_end)
     {
         map->colors[i] = color;
@@ -11,8 +11,9 @@ class BaseWeapon(object):
     next_shot = None
     start = None
     
-    def __init__(self, reload_callback):
+    def __init__(self, reload_callback, call_later = reactor.callLater):
         self.reload_callback = reload_callback
+        self.call_later = call_later
         self.reset()
         
     def restock(self):
@@ -21,8 +22,7 @@ class BaseWeapon(object):
     def reset(self):
         self.shoot = False
         if self.reloading:
-            self.reload_call.cancel()
-            self.reloading = False
+            self.cancel_reload()
         self.current_ammo = self.ammo
         self.current_stock = self.stock
     
@@ -38,8 +38,7 @@ class BaseWeapon(object):
                 return
             self.shoot_time = max(current_time, self.next_shot)
             if self.reloading:
-                self.reloading = False
-                self.reload_call.cancel()
+                self.cancel_reload()
         else:
             ammo = self.current_ammo
             self.current_ammo = self.get_ammo(True)
@@ -58,7 +57,14 @@ class BaseWeapon(object):
         self.reloading = True
         self.set_shoot(False)
         self.current_ammo = ammo
-        self.reload_call = reactor.callLater(self.reload_time, self.on_reload)
+        self.reload_call = self.call_later(self.reload_time, self.on_reload)
+    
+    def cancel_reload(self):
+        self.reloading = False
+        # the call may already be cancelled together with the other calls
+        # of the connection
+        if self.reload_call.active():
+            self.reload_call.cancel()
     
     def on_reload(self):
         self.reloading = False
@@ -3,7 +3,11 @@ from twisted.web import client
 from twisted.web.client import HTTPClientFactory
 
 def getPage(url, bindAddress = None, *arg, **kw):
-    # reimplemented here to insert bindAddress
+    return getPageFactory(url, bindAddress, *arg, **kw).deferred
+
+def getPageFactory(url, bindAddress = None, *arg, **kw):
+    # reimplemented here to insert bindAddress, and returns the factory so
+    # the status and headers of the response can be read
 
     # _parse() deprecated in twisted 13.1.0 in favor of the _URI class
     if hasattr(client, '_parse'):
@@ -26,4 +30,4 @@ def getPage(url, bindAddress = None, *arg, **kw):
             bindAddress = bindAddress)
     else:
         reactor.connectTCP(host, port, factory, bindAddress = bindAddress)
-    return factory.deferred
\ No newline at end of file
+    return factory
\ No newline at end of file
@@ -17,13 +17,19 @@
 
 import math
 import time
-from pyspades.vxl cimport VXLData, MapData
+from pyspades.vxl cimport VXLData, MapData, OVERVIEW_TILES
 from pyspades.common cimport Vertex3, create_proxy_vector
 from pyspades.constants import *
 
 cdef extern from "math.h":
     double fabs(double x)
 
+from libc.string cimport memset, memcpy
+from libc.stdlib cimport realloc, free
+from cython.parallel cimport prange
+from cpython cimport array
+import array
+
 cdef extern from "common_c.h":
     struct LongVector:
         int x, y, z
@@ -38,9 +44,10 @@ cdef extern from "world_c.cpp":
         float orientation_x, float orientation_y, float orientation_z,
         float victim_x, float victim_y, float victim_z, float tolerance)
     int c_can_see "can_see" (MapData * map, float x0, float y0, float z0,
-        float x1, float y1, float z1)
+        float x1, float y1, float z1) nogil
     int c_cast_ray "cast_ray" (MapData * map, float x0, float y0, float z0,
-        float x1, float y1, float z1, float length, long* x, long* y, long* z)
+        float x1, float y1, float z1, float length, long* x, long* y,
+        long* z) nogil
     size_t cube_line_c "cube_line"(int, int, int, int, int, int, LongVector *)
     void set_globals(MapData * map, float total_time, float dt)
     struct PlayerType:
@@ -52,6 +59,7 @@ cdef extern from "world_c.cpp":
         
     struct GrenadeType:
         Vector p, v
+        float fuse
     PlayerType * create_player()
     void destroy_player(PlayerType * player)
     void destroy_grenade(GrenadeType * player)
@@ -62,9 +70,91 @@ cdef extern from "world_c.cpp":
     int try_uncrouch(PlayerType * p)
     GrenadeType * create_grenade(Vector * p, Vector * v)
     int move_grenade(GrenadeType * grenade)
+    int move_players(PlayerType ** players, int count, long * results)
+    int move_grenades(GrenadeType ** grenades, int count, float dt,
+        int * exploded)
+    int predict_grenade(GrenadeType * grenade, MapData * map, float dt,
+        int max_steps, float * path, unsigned char * tiles, int * collided)
     
 from libc.math cimport sqrt
 
+# the character index divides the map into INDEX_SIZE * INDEX_SIZE cells of
+# 2 ** INDEX_SHIFT blocks each
+DEF INDEX_SHIFT = 4
+DEF INDEX_SIZE = 32
+DEF INDEX_CELLS = 1024
+
+cdef inline int get_index_coordinate(float value):
+    cdef int i = (<int>value) >> INDEX_SHIFT
+    if i < 0:
+        return 0
+    elif i >= INDEX_SIZE:
+        return INDEX_SIZE - 1
+    return i
+
+cdef inline int get_index_cell(float x, float y):
+    return get_index_coordinate(x) + get_index_coordinate(y) * INDEX_SIZE
+
+cdef inline int get_position(position, float * x, float * y,
+                             float * z) except -1:
+    cdef Vertex3 vertex
+    if isinstance(position, Vertex3):
+        vertex = position
+        x[0] = vertex.value.x
+        y[0] = vertex.value.y
+        z[0] = vertex.value.z
+    else:
+        x[0], y[0], z[0] = position
+    return 0
+
+cdef array.array float_template = array.array('f')
+cdef array.array char_template = array.array('b')
+cdef array.array int_template = array.array('i')
+
+cdef array.array get_float_array(values):
+    """
+    Returns the given positions as a flat float array of x, y, z values.
+    Float arrays are passed through as-is
+    """
+    if (isinstance(values, array.array) and
+            (<array.array>values).ob_descr.typecode == 'f'):
+        if len(values) % 3:
+            raise ValueError('array length must be a multiple of 3')
+        return values
+    cdef list items = list(values)
+    cdef array.array result = array.clone(float_template, len(items) * 3,
+        False)
+    cdef float * data = result.data.as_floats
+    cdef int i
+    for i in xrange(len(items)):
+        get_position(items[i], &data[i * 3], &data[i * 3 + 1],
+            &data[i * 3 + 2])
+    return result
+
+cdef inline void cast_ray_at(MapData * map, float * origin, float * direction,
+                             float length, char * hit, int * block) nogil:
+    cdef long x, y, z
+    if c_cast_ray(map, origin[0], origin[1], origin[2], direction[0],
+                  direction[1], direction[2], length, &x, &y, &z):
+        hit[0] = 1
+        block[0] = x
+        block[1] = y
+        block[2] = z
+    else:
+        hit[0] = 0
+        block[0] = block[1] = block[2] = -1
+
+cdef int get_trajectory_steps(double dt, double max_time) except -1:
+    # same as stepping the grenade until max_time has passed
+    if dt <= 0.0:
+        raise ValueError('dt must be positive')
+    cdef double eta = 0.0
+    cdef int steps = 0
+    while eta <= max_time:
+        eta += dt
+        steps += 1
+    return steps
+
 cdef inline bint can_see(VXLData map, float x1, float y1, float z1,
     float x2, float y2, float z2):
     return c_can_see(map.map, x1, y1, z1, x2, y2, z2)
@@ -82,9 +172,13 @@ cdef class Object:
     cdef public: 
         object name
         World world
+    cdef:
+        # position in World.objects and in the World's simulation arrays
+        int object_index, slot
 
     def __init__(self, world, *arg, **kw):
         self.world = world
+        self.object_index = self.slot = -1
         self.initialize(*arg, **kw)
         if self.name is None:
             self.name = 'object'
@@ -92,22 +186,22 @@ cdef class Object:
     def initialize(self, *arg, **kw):
         pass
     
-    cdef int update(self, double dt) except -1:
-        return 0
-    
     def delete(self):
         self.world.delete_object(self)
         
 cdef class Character(Object):
     cdef:
         PlayerType * player
+        int index_cell
     cdef public:
         Vertex3 position, orientation, velocity
         object fall_callback
+        object owner
     
     def initialize(self, Vertex3 position, Vertex3 orientation, 
                    fall_callback = None):
         self.name = 'character'
+        self.index_cell = -1
         self.player = create_player()
         self.fall_callback = fall_callback
         self.position = create_proxy_vector(&self.player.p)
@@ -147,6 +241,8 @@ cdef class Character(Object):
         self.player.p.x = self.player.e.x = x
         self.player.p.y = self.player.e.y = y
         self.player.p.z = self.player.e.z = z
+        if get_index_cell(x, y) != self.index_cell:
+            self.world.index_dirty = True
         if reset:
             self.velocity.set(0.0, 0.0, 0.0)
             self.primary_fire = self.secondary_fire = False 
@@ -197,6 +293,7 @@ cdef class Character(Object):
         
     def set_dead(self, value):
         self.player.alive = not value
+        self.world.index_dirty = True
         self.player.mf = False
         self.player.mb = False
         self.player.ml = False
@@ -207,12 +304,6 @@ cdef class Character(Object):
         self.player.secondary_fire = False
         self.player.sprint = False
         
-    cdef int update(self, double dt) except -1:
-        cdef long ret = move_player(self.player)
-        if ret > 0:
-            self.fall_callback(ret)
-        return 0
-    
     # properties
     property up:
         def __get__(self):
@@ -291,10 +382,19 @@ cdef class Character(Object):
 cdef class Grenade(Object):
     cdef public:
         Vertex3 position, velocity
-        float fuse
         object callback
         object team
     cdef GrenadeType * grenade
+    cdef:
+        # the last predicted trajectory, what it was predicted from and the
+        # revisions of the map tiles it passed through
+        array.array trajectory
+        bint trajectory_collided
+        GrenadeType trajectory_start
+        float trajectory_dt
+        int trajectory_steps
+        VXLData trajectory_map
+        list trajectory_tiles
     
     def initialize(self, double fuse, Vertex3 position, Vertex3 orientation, 
                    Vertex3 velocity, callback = None):
@@ -312,21 +412,71 @@ cdef class Grenade(Object):
         return can_see(self.world.map, position.x, position.y, position.z,
                        nade.x, nade.y, nade.z)
     
+    cdef bint is_trajectory_valid(self, VXLData map, float dt, int steps):
+        if (self.trajectory is None or map is not self.trajectory_map or
+                dt != self.trajectory_dt or steps != self.trajectory_steps):
+            return False
+        cdef GrenadeType * start = &self.trajectory_start
+        cdef GrenadeType * current = self.grenade
+        if (start.p.x != current.p.x or start.p.y != current.p.y or
+                start.p.z != current.p.z or start.v.x != current.v.x or
+                start.v.y != current.v.y or start.v.z != current.v.z):
+            return False
+        cdef int tile
+        cdef unsigned int revision
+        for tile, revision in self.trajectory_tiles:
+            if map.map.tile_revisions[tile] != revision:
+                return False
+        return True
+    
+    cdef int predict(self, float dt, int steps) except -1:
+        cdef VXLData map = self.world.map
+        if map is None:
+            raise ValueError('world has no map')
+        if self.is_trajectory_valid(map, dt, steps):
+            return 0
+        cdef unsigned char tiles[OVERVIEW_TILES * OVERVIEW_TILES]
+        cdef int collided, count, i
+        memset(tiles, 0, sizeof(tiles))
+        cdef array.array path = array.clone(float_template, steps * 3, False)
+        count = predict_grenade(self.grenade, map.map, dt, steps,
+            path.data.as_floats, tiles, &collided)
+        array.resize(path, count * 3)
+        self.trajectory_tiles = [(i, map.map.tile_revisions[i])
+            for i in xrange(OVERVIEW_TILES * OVERVIEW_TILES) if tiles[i]]
+        self.trajectory = path
+        self.trajectory_collided = collided
+        self.trajectory_start = self.grenade[0]
+        self.trajectory_dt = dt
+        self.trajectory_steps = steps
+        self.trajectory_map = map
+        return 0
+    
+    def get_trajectory(self, double dt, double max_time = 5.0):
+        """
+        Returns the predicted positions of the grenade after every tick of
+        dt seconds as a flat float array of x, y, z values, until it first
+        hits the map or max_time has passed, and whether it hit the map.
+        The prediction is kept until the grenade moves or the map changes
+        around its path
+        """
+        self.predict(dt, get_trajectory_steps(dt, max_time))
+        return array.copy(self.trajectory), self.trajectory_collided
+    
     cpdef get_next_collision(self, double dt):
         if self.velocity.is_zero():
             return None
+        self.predict(dt, get_trajectory_steps(dt, 5.0))
+        cdef array.array path = self.trajectory
+        cdef int count = len(path) / 3
+        cdef int i
         cdef double eta = 0.0
-        cdef double x, y, z
-        cdef Vertex3 old_position = self.position.copy()
-        cdef Vertex3 old_velocity = self.velocity.copy()
-        while move_grenade(self.grenade) == 0:
+        # the tick that collides doesn't move the grenade
+        if self.trajectory_collided:
+            count -= 1
+        for i in xrange(count):
             eta += dt
-            if eta > 5.0:
-                break
-        x, y, z = self.position.x, self.position.y, self.position.z
-        self.position.set_vector(old_position)
-        self.velocity.set_vector(old_velocity)
-        return eta, x, y, z
+        return eta, path[-3], path[-2], path[-1]
     
     cpdef double get_damage(self, Vertex3 player_position):
         cdef Vector * position = self.position.value
@@ -345,14 +495,11 @@ cdef class Grenade(Object):
             return 4096.0 / value
         return 0
         
-    cdef int update(self, double dt) except -1:
-        self.fuse -= dt
-        if self.fuse <= 0:
-            if self.callback is not None:
-                self.callback(self)
-            self.delete()
-            return 0
-        move_grenade(self.grenade)
+    property fuse:
+        def __get__(self):
+            return self.grenade.fuse
+        def __set__(self, float value):
+            self.grenade.fuse = value
     
     def __dealloc__(self):
         destroy_grenade(self.grenade)
@@ -362,27 +509,314 @@ cdef class World(object):
         VXLData map
         list objects
         float time
+    cdef:
+        # characters and grenades are stepped in C. their structs are kept in
+        # arrays parallel to the characters/grenades lists, and removal swaps
+        # the last item into the freed slot
+        list characters, grenades
+        PlayerType ** player_data
+        long * fall_results
+        int player_capacity
+        GrenadeType ** grenade_data
+        int * exploded
+        int grenade_capacity
+
+        # characters sorted by index cell. the characters in cell i are
+        # index_items[index_start[i]:index_start[i + 1]]
+        list index_items
+        int index_start[INDEX_CELLS + 1]
+        bint index_dirty
 
     def __init__(self):
         self.objects = []
+        self.characters = []
+        self.grenades = []
         self.time = 0
+        self.index_items = []
+        self.index_dirty = True
     
     def update(self, double dt):
         if self.map is None:
             return
         self.time += dt
         set_globals(self.map.map, self.time, dt)
-        cdef Object instance
-        for instance in self.objects[:]:
-            instance.update(dt)
+        cdef int i, count
+        cdef Character character
+        cdef Grenade grenade
+        cdef list falls = []
+        cdef list exploded = []
+        count = move_players(self.player_data, len(self.characters),
+            self.fall_results)
+        if count:
+            for i in xrange(len(self.characters)):
+                if self.fall_results[i] > 0:
+                    falls.append((self.characters[i], self.fall_results[i]))
+        count = move_grenades(self.grenade_data, len(self.grenades), dt,
+            self.exploded)
+        for i in xrange(count):
+            exploded.append(self.grenades[self.exploded[i]])
+        self.index_dirty = True
+        # run callbacks once everything has moved, since they may add or
+        # remove objects
+        for character, damage in falls:
+            if character.fall_callback is not None:
+                character.fall_callback(damage)
+        for grenade in exploded:
+            if grenade.callback is not None:
+                grenade.callback(grenade)
+            grenade.delete()
     
     cpdef delete_object(self, Object item):
-        self.objects.remove(item)
+        cdef int index = item.object_index
+        cdef Object last
+        if index == -1:
+            return
+        last = self.objects.pop()
+        if last is not item:
+            self.objects[index] = last
+            last.object_index = index
+        item.object_index = -1
+        if isinstance(item, Character):
+            self.remove_character(item)
+        elif isinstance(item, Grenade):
+            self.remove_grenade(item)
         
     def create_object(self, klass, *arg, **kw):
-        new_object = klass(self, *arg, **kw)
+        cdef Object new_object = klass(self, *arg, **kw)
+        new_object.object_index = len(self.objects)
         self.objects.append(new_object)
+        if isinstance(new_object, Character):
+            self.add_character(new_object)
+        elif isinstance(new_object, Grenade):
+            self.add_grenade(new_object)
         return new_object
+    
+    cdef int add_character(self, Character character) except -1:
+        cdef int count = len(self.characters)
+        cdef int capacity
+        if count == self.player_capacity:
+            capacity = max(16, count * 2)
+            self.player_data = <PlayerType**>realloc(self.player_data,
+                capacity * sizeof(PlayerType*))
+            self.fall_results = <long*>realloc(self.fall_results,
+                capacity * sizeof(long))
+            if self.player_data == NULL or self.fall_results == NULL:
+                raise MemoryError()
+            self.player_capacity = capacity
+        self.player_data[count] = character.player
+        character.slot = count
+        self.characters.append(character)
+        self.index_dirty = True
+        return 0
+    
+    cdef int remove_character(self, Character character) except -1:
+        cdef int slot = character.slot
+        cdef Character last = self.characters.pop()
+        if last is not character:
+            self.characters[slot] = last
+            self.player_data[slot] = last.player
+            last.slot = slot
+        character.slot = -1
+        self.index_dirty = True
+        return 0
+    
+    cdef int add_grenade(self, Grenade grenade) except -1:
+        cdef int count = len(self.grenades)
+        cdef int capacity
+        if count == self.grenade_capacity:
+            capacity = max(16, count * 2)
+            self.grenade_data = <GrenadeType**>realloc(self.grenade_data,
+                capacity * sizeof(GrenadeType*))
+            self.exploded = <int*>realloc(self.exploded,
+                capacity * sizeof(int))
+            if self.grenade_data == NULL or self.exploded == NULL:
+                raise MemoryError()
+            self.grenade_capacity = capacity
+        self.grenade_data[count] = grenade.grenade
+        grenade.slot = count
+        self.grenades.append(grenade)
+        return 0
+    
+    cdef int remove_grenade(self, Grenade grenade) except -1:
+        cdef int slot = grenade.slot
+        cdef Grenade last = self.grenades.pop()
+        if last is not grenade:
+            self.grenades[slot] = last
+            self.grenade_data[slot] = last.grenade
+            last.slot = slot
+        grenade.slot = -1
+        return 0
+    
+    def __dealloc__(self):
+        free(self.player_data)
+        free(self.fall_results)
+        free(self.grenade_data)
+        free(self.exploded)
+    
+    # character index. rebuilt lazily whenever characters die, spawn or
+    # move to another cell, so it is at most rebuilt once per tick during
+    # normal play
+    
+    cdef int update_index(self) except -1:
+        cdef int fill[INDEX_CELLS]
+        cdef int * start = self.index_start
+        cdef Character character
+        cdef list characters = []
+        cdef list items
+        cdef int i
+        memset(start, 0, sizeof(self.index_start))
+        for character in self.characters:
+            if not character.player.alive:
+                character.index_cell = -1
+                continue
+            character.index_cell = get_index_cell(character.player.p.x,
+                character.player.p.y)
+            start[character.index_cell + 1] += 1
+            characters.append(character)
+        for i in xrange(INDEX_CELLS):
+            start[i + 1] += start[i]
+        memcpy(fill, start, sizeof(fill))
+        items = [None] * len(characters)
+        for character in characters:
+            items[fill[character.index_cell]] = character
+            fill[character.index_cell] += 1
+        self.index_items = items
+        self.index_dirty = False
+        return 0
+    
+    cdef list query_box(self, float x1, float y1, float z1, float x2,
+                        float y2, float z2):
+        if self.index_dirty:
+            self.update_index()
+        cdef list items = self.index_items
+        cdef list result = []
+        cdef Character character
+        cdef Vector * p
+        cdef int cell, i
+        cdef int cell_x1 = get_index_coordinate(x1)
+        cdef int cell_x2 = get_index_coordinate(x2)
+        cdef int cell_y1 = get_index_coordinate(y1)
+        cdef int cell_y2 = get_index_coordinate(y2)
+        cdef int cell_x, cell_y
+        for cell_y in xrange(cell_y1, cell_y2 + 1):
+            for cell_x in xrange(cell_x1, cell_x2 + 1):
+                cell = cell_x + cell_y * INDEX_SIZE
+                for i in xrange(self.index_start[cell],
+                                self.index_start[cell + 1]):
+                    character = items[i]
+                    p = &character.player.p
+                    if (p.x >= x1 and p.x <= x2 and p.y >= y1 and p.y <= y2
+                        and p.z >= z1 and p.z <= z2):
+                        result.append(character)
+        return result
+    
+    cdef list query_radius(self, float x, float y, float z, float radius):
+        cdef list result = []
+        cdef Character character
+        cdef float dx, dy, dz
+        for character in self.query_box(x - radius, y - radius, z - radius,
+                                        x + radius, y + radius, z + radius):
+            dx = character.player.p.x - x
+            dy = character.player.p.y - y
+            dz = character.player.p.z - z
+            if dx * dx + dy * dy + dz * dz <= radius * radius:
+                result.append(character)
+        return result
+    
+    def players_in_box(self, float x1, float y1, float z1, float x2, float y2,
+                       float z2):
+        """
+        Returns the live characters inside the given box (inclusive)
+        """
+        return self.query_box(x1, y1, z1, x2, y2, z2)
+    
+    def players_in_radius(self, position, float radius):
+        """
+        Returns the live characters within the given distance of position
+        """
+        cdef float x, y, z
+        get_position(position, &x, &y, &z)
+        return self.query_radius(x, y, z, radius)
+    
+    def visible_players(self, position, float radius):
+        """
+        Returns the live characters within the given distance of position
+        that have line of sight to it
+        """
+        cdef float x, y, z
+        cdef list result = []
+        cdef Character character
+        cdef Vector * p
+        if self.map is None:
+            return result
+        cdef MapData * map = self.map.map
+        get_position(position, &x, &y, &z)
+        for character in self.query_radius(x, y, z, radius):
+            p = &character.player.p
+            if c_can_see(map, p.x, p.y, p.z, x, y, z):
+                result.append(character)
+        return result
+
+    # batched ray queries. origins, targets and directions are sequences of
+    # positions or flat float arrays (typecode 'f') of x, y, z values. the
+    # rays are traced without the GIL, and split across threads when
+    # pyspades is built with OpenMP
+
+    def can_see_many(self, origins, targets, int threads = 1):
+        """
+        Tests the line of sight between each origin and the target at the
+        same index, and returns the results as an array of bytes (1 if
+        visible)
+        """
+        cdef array.array origin_data = get_float_array(origins)
+        cdef array.array target_data = get_float_array(targets)
+        cdef int count = len(origin_data) / 3
+        if len(target_data) != len(origin_data):
+            raise ValueError('origins and targets differ in length')
+        cdef array.array result = array.clone(char_template, count, True)
+        if self.map is None:
+            return result
+        cdef MapData * map = self.map.map
+        cdef float * a = origin_data.data.as_floats
+        cdef float * b = target_data.data.as_floats
+        cdef char * visible = result.data.as_chars
+        cdef int i
+        for i in prange(count, nogil = True, num_threads = max(1, threads),
+                        schedule = 'static'):
+            visible[i] = c_can_see(map, a[i * 3], a[i * 3 + 1], a[i * 3 + 2],
+                b[i * 3], b[i * 3 + 1], b[i * 3 + 2])
+        return result
+    
+    def cast_rays(self, origins, directions, float length = 32.0,
+                  int threads = 1):
+        """
+        Casts a ray from each origin along the direction at the same index.
+        Returns an array of bytes (1 if a block was hit) and an int array of
+        the x, y, z coordinates of the blocks that were hit, with -1 for rays
+        that hit nothing
+        """
+        cdef array.array origin_data = get_float_array(origins)
+        cdef array.array direction_data = get_float_array(directions)
+        cdef int count = len(origin_data) / 3
+        if len(direction_data) != len(origin_data):
+            raise ValueError('origins and directions differ in length')
+        cdef array.array hits = array.clone(char_template, count, True)
+        cdef array.array blocks = array.clone(int_template, count * 3, False)
+        cdef int * block = blocks.data.as_ints
+        cdef int i
+        if self.map is None:
+            for i in xrange(count * 3):
+                block[i] = -1
+            return hits, blocks
+        cdef MapData * map = self.map.map
+        cdef float * a = origin_data.data.as_floats
+        cdef float * b = direction_data.data.as_floats
+        cdef char * hit = hits.data.as_chars
+        for i in prange(count, nogil = True, num_threads = max(1, threads),
+                        schedule = 'static'):
+            cast_ray_at(map, &a[i * 3], &b[i * 3], length, &hit[i],
+                &block[i * 3])
+        return hits, blocks
 
 # utility functions
 
@@ -70,6 +70,7 @@ struct PlayerType
 struct GrenadeType
 {
     Vector p, v;
+    float fuse;
 };
 
 inline void get_orientation(Orientation * o,
@@ -146,17 +147,17 @@ int clipbox(float x, float y, float z)
 }
 
 //same as isvoxelsolid() but with wrapping
-long isvoxelsolidwrap(long x, long y, long z)
+long isvoxelsolidwrap(long x, long y, long z, MapData * map)
 {
     if (z < 0)
         return 0;
     else if (z >= 64)
         return 1;
-	return get_solid((int)x & VSIDM, (int)y & VSIDM, z, global_map);
+	return get_solid((int)x & VSIDM, (int)y & VSIDM, z, map);
 }
 
 //same as isvoxelsolid but water is empty
-long clipworld(long x, long y, long z)
+inline long clipworld_map(long x, long y, long z, MapData * map)
 {
     int sz;
 
@@ -171,7 +172,12 @@ long clipworld(long x, long y, long z)
         return 1;
     else if (sz < 0)
         return 0;
-    return get_solid((int)x, (int)y, sz, global_map);
+    return get_solid((int)x, (int)y, sz, map);
+}
+
+long clipworld(long x, long y, long z)
+{
+    return clipworld_map(x, y, z, global_map);
 }
 
 long can_see(MapData * map, float x0, float y0, float z0, float x1, float y1,
@@ -227,7 +233,7 @@ long can_see(MapData * map, float x0, float y0, float z0, float x1, float y1,
             a.y += d.y; p.y += i.z; p.z += i.x;
         }
 
-        if (isvoxelsolidwrap(a.x, a.y, a.z))
+        if (isvoxelsolidwrap(a.x, a.y, a.z, map))
             return 0;
         cnt--;
     }
@@ -290,7 +296,7 @@ long cast_ray(MapData * map, float x0, float y0, float z0, float x1, float y1,
             a.y += d.y; p.y += i.z; p.z += i.x;
         }
 
-        if (isvoxelsolidwrap(a.x, a.y,a.z)) {
+        if (isvoxelsolidwrap(a.x, a.y, a.z, map)) {
             *x = a.x;
             *y = a.y;
             *z = a.z;
@@ -628,16 +634,20 @@ GrenadeType * create_grenade(Vector * p, Vector * v)
     GrenadeType * g = new GrenadeType;
     g->p = *p;
     g->v = *v;
+    g->fuse = 0.0f;
     return g;
 }
 
-// returns 1 if there was a collision, 2 if sound should be played
-int move_grenade(GrenadeType * g)
+// moves a grenade by one tick of dt on the given map, and stores the cell
+// it moved into (and was checked for collisions) in cell. Returns 1 if
+// there was a collision, 2 if sound should be played
+inline int step_grenade(GrenadeType * g, MapData * map, float dt,
+                        LongVector * cell)
 {
     Vector fpos = g->p; //old position
     //do velocity & gravity (friction is negligible)
-    float f = fsynctics*32;
-    g->v.z += fsynctics;
+    float f = dt*32;
+    g->v.z += dt;
     g->p.x += g->v.x*f;
     g->p.y += g->v.y*f;
     g->p.z += g->v.z*f;
@@ -652,10 +662,11 @@ int move_grenade(GrenadeType * g)
     lp.x = (long)floor(g->p.x);
     lp.y = (long)floor(g->p.y);
     lp.z = (long)floor(g->p.z);
+    *cell = lp;
     
     int ret = 0;
     
-    if(clipworld(lp.x, lp.y, lp.z))  //hit a wall
+    if(clipworld_map(lp.x, lp.y, lp.z, map))  //hit a wall
     {
         #define BOUNCE_SOUND_THRESHOLD 0.1f
         
@@ -669,11 +680,11 @@ int move_grenade(GrenadeType * g)
         lp2.x = (long)floor(fpos.x);
         lp2.y = (long)floor(fpos.y);
         lp2.z = (long)floor(fpos.z);
-        if (lp.z != lp2.z && ((lp.x == lp2.x && lp.y == lp2.y) || !clipworld(lp.x, lp.y, lp2.z)))
+        if (lp.z != lp2.z && ((lp.x == lp2.x && lp.y == lp2.y) || !clipworld_map(lp.x, lp.y, lp2.z, map)))
             g->v.z = -g->v.z;
-        else if(lp.x != lp2.x && ((lp.y == lp2.y && lp.z == lp2.z) || !clipworld(lp2.x, lp.y, lp.z)))
+        else if(lp.x != lp2.x && ((lp.y == lp2.y && lp.z == lp2.z) || !clipworld_map(lp2.x, lp.y, lp.z, map)))
             g->v.x = -g->v.x;
-        else if(lp.y != lp2.y && ((lp.x == lp2.x && lp.z == lp2.z) || !clipworld(lp.x, lp2.y, lp.z)))
+        else if(lp.y != lp2.y && ((lp.x == lp2.x && lp.z == lp2.z) || !clipworld_map(lp.x, lp2.y, lp.z, map)))
             g->v.y = -g->v.y;
         g->p = fpos; //set back to old position
         g->v.x *= 0.36f;
@@ -683,6 +694,87 @@ int move_grenade(GrenadeType * g)
     return ret;
 }
 
+// returns 1 if there was a collision, 2 if sound should be played
+int move_grenade(GrenadeType * g)
+{
+    LongVector cell;
+    return step_grenade(g, global_map, fsynctics, &cell);
+}
+
+inline void mark_tile(long x, long y, unsigned char * tiles)
+{
+    if (x < 0 || x >= MAP_X || y < 0 || y >= MAP_Y)
+        return;
+    tiles[x / OVERVIEW_TILE_SIZE + (y / OVERVIEW_TILE_SIZE) * OVERVIEW_TILES]
+        = 1;
+}
+
+// simulates a copy of the grenade tick by tick until it collides with the
+// map, for at most max_steps ticks. The position after every tick is stored
+// in path, and the overview tiles of every cell that was checked for
+// collisions are marked in tiles. Returns the number of ticks simulated,
+// and sets collided if the last one hit the map
+int predict_grenade(GrenadeType * grenade, MapData * map, float dt,
+                    int max_steps, float * path, unsigned char * tiles,
+                    int * collided)
+{
+    GrenadeType g = *grenade;
+    LongVector cell;
+    *collided = 0;
+    for (int i = 0; i < max_steps; i++) {
+        long x = (long)floor(g.p.x);
+        long y = (long)floor(g.p.y);
+        int ret = step_grenade(&g, map, dt, &cell);
+        // collision checks can combine the coordinates of both cells
+        mark_tile(x, y, tiles);
+        mark_tile(cell.x, cell.y, tiles);
+        mark_tile(x, cell.y, tiles);
+        mark_tile(cell.x, y, tiles);
+        path[i * 3] = g.p.x;
+        path[i * 3 + 1] = g.p.y;
+        path[i * 3 + 2] = g.p.z;
+        if (ret) {
+            *collided = 1;
+            return i + 1;
+        }
+    }
+    return max_steps;
+}
+
+// batched versions of move_player/move_grenade for World.update
+
+// stores the move_player() result of every player in results, and returns
+// the number of players that took fall damage
+int move_players(PlayerType ** players, int count, long * results)
+{
+    int hurt = 0;
+    for (int i = 0; i < count; i++) {
+        results[i] = move_player(players[i]);
+        if (results[i] > 0)
+            hurt++;
+    }
+    return hurt;
+}
+
+// burns the fuse of every grenade and moves the ones that haven't exploded.
+// the indices of exploded grenades are stored in exploded, and their number
+// is returned
+int move_grenades(GrenadeType ** grenades, int count, float dt, 
+                  int * exploded)
+{
+    int exploded_count = 0;
+    for (int i = 0; i < count; i++) {
+        GrenadeType * g = grenades[i];
+        g->fuse -= dt;
+        if (g->fuse <= 0) {
+            exploded[exploded_count++] = i;
+            continue;
+        }
+        move_grenade(g);
+    }
+    return exploded_count;
+}
+
 // C interface
 
 PlayerType * create_player()
@@ -695,7 +787,8 @@ PlayerType * create_player()
     player->e = player->p;
     player->v.x = player->v.y = player->v.z = 0;
     player->mf = player->mb = player->ml = player->mr = player->jump =
-        player->crouch = player->sneak = 0;
+        player->crouch = player->sneak = player->sprint =
+        player->primary_fire = player->secondary_fire = 0;
     player->airborne = player->wade = 0;
     player->lastclimb = 0;
     player->alive = 1;
@@ -35,17 +35,20 @@ from twisted.internet import reactor
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet.defer import Deferred
 from twisted.internet.task import LoopingCall
+from collections import deque
 from twisted.web.client import getPage
 from twisted.web import static, server
 from twisted.web.resource import Resource
 from pyspades.site import get_servers
 from pyspades.tools import make_server_identifier
-import json
 import jinja2
 import urllib
 
 UPDATE_INTERVAL = 10
 PYSPADES_TIMEOUT = 2
+MIN_TIMEOUT = 0.25
+PROBE_INTERVAL = 0.02
+PROBES_PER_INTERVAL = 10
 INPUT = 'in.html'
 
 SITE = 'http://ace-spades.com/forums/ucp.php?mode=login'
@@ -68,18 +71,22 @@ def check_user(name, password):
 from feature_server.statistics import (StatsFactory, StatsServer,
     DEFAULT_PORT)
 
+from statstore import StatStore
+
 class SiteStatisticsProtocol(StatsServer):
     def connection_accepted(self):
         print 'Statistics client %s (%s) connected.' % (self.name,
             self.transport.getPeer().host)
     
+    def add_stats(self, session, sequence, users):
+        return self.factory.store.add_stats(self.name, session, sequence,
+            users)
+    
     def add_kill(self, name):
-        self.factory.get_user(name)['kills'] += 1
-        self.factory.save()
+        self.factory.store.add_single(name, 1, 0)
     
     def add_death(self, name):
-        self.factory.get_user(name)['deaths'] += 1
-        self.factory.save()
+        self.factory.store.add_single(name, 0, 1)
     
     def check_user(self, name, password):
         print 'Checking auth for %s' % name
@@ -90,59 +97,141 @@ class SiteStatisticsFactory(StatsFactory):
     
     def __init__(self, *arg, **kw):
         StatsFactory.__init__(self, *arg, **kw)
-        try:
-            self.users = json.load(open('users.txt', 'rb'))
-        except IOError:
-            self.users = {}
-    
-    def get_user(self, name):
-        key = name.lower()
-        if key not in self.users:
-            self.users[key] = {
-                'name' : name,
-                'kills' : 0,
-                'deaths' : 0
-            }
-        return self.users[key]
-
+        self.store = StatStore()
+    
     def get_highscores(self):
-        return sorted(self.users.iteritems(), 
-            key = lambda x: x[1]['kills'], reverse = True)
+        return self.store.get_highscores()
+
+class ServerProbe(object):
+    """
+    Smoothed round-trip time of a server, like TCP's estimate
+    """
+    rtt = None
+    rtt_variance = None
+    sent = None
+    timeout_call = None
+    
+    def add_sample(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+            self.rtt_variance = rtt / 2.0
+        else:
+            self.rtt_variance = (0.75 * self.rtt_variance +
+                0.25 * abs(self.rtt - rtt))
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
     
-    def save(self):
-        json.dump(self.users, open('users.txt', 'wb'))
+    def get_timeout(self):
+        if self.rtt is None:
+            return PYSPADES_TIMEOUT
+        return max(MIN_TIMEOUT, min(PYSPADES_TIMEOUT,
+            self.rtt + 4 * self.rtt_variance))
 
 class QueryProtocol(DatagramProtocol):
+    """
+    Sends HELLO to every listed server, paced to PROBES_PER_INTERVAL every
+    PROBE_INTERVAL seconds, and waits for each reply as long as the round
+    trip time of that server suggests. The results are saved once every
+    server has answered or timed out, and version changes whenever they
+    differ from the previous ones
+    """
     pyspades_set = None
     saved_pyspades = None
+    version = 0
+    results = None
+    
     def startProtocol(self):
         self.saved_pyspades = set()
         self.pyspades_numbers = []
         self.servers = []
+        self.latencies = {}
+        self.probes = {}
+        self.pending = {}
+        self.send_queue = deque()
+        self.send_loop = LoopingCall(self.send_probes)
         self.update()
     
     def save(self, servers):
-        self.saved_pyspades = self.pyspades_set or set()
-        self.pyspades_numbers = self.saved_pyspades.copy()
+        latencies = {}
+        for identifier in self.pyspades_set:
+            rtt = self.probes[identifier].rtt
+            latencies[identifier] = int(rtt * 1000)
+        results = (tuple(sorted(server.__dict__.items())
+            for server in servers), latencies)
+        if results != self.results:
+            self.results = results
+            self.version += 1
+        self.saved_pyspades = self.pyspades_set
+        self.pyspades_numbers = sorted(self.saved_pyspades)
+        self.latencies = latencies
         self.servers = servers
         self.pyspades_set = None
     
     def got_servers(self, servers):
+        for probe in self.pending.itervalues():
+            probe.timeout_call.cancel()
+        self.pending = {}
+        self.send_queue.clear()
         self.pyspades_set = set()
+        self.round_servers = servers
+        seen = set()
         for server in servers:
-            self.transport.write('HELLO', (server.ip, server.port))
-        reactor.callLater(PYSPADES_TIMEOUT, self.save, servers)
+            identifier = make_server_identifier(server.ip, server.port)
+            if identifier in seen:
+                continue
+            seen.add(identifier)
+            self.send_queue.append((identifier, (server.ip, server.port)))
+        # forget servers that are no longer listed
+        for identifier in self.probes.keys():
+            if identifier not in seen:
+                del self.probes[identifier]
+        if not self.send_queue:
+            self.save(servers)
+        elif not self.send_loop.running:
+            self.send_loop.start(PROBE_INTERVAL)
+    
+    def send_probes(self):
+        current_time = reactor.seconds()
+        for _ in xrange(PROBES_PER_INTERVAL):
+            if not self.send_queue:
+                self.send_loop.stop()
+                return
+            identifier, address = self.send_queue.popleft()
+            probe = self.probes.get(identifier, None)
+            if probe is None:
+                probe = self.probes[identifier] = ServerProbe()
+            probe.sent = current_time
+            probe.timeout_call = reactor.callLater(probe.get_timeout(),
+                self.probe_finished, identifier)
+            self.pending[identifier] = probe
+            self.transport.write('HELLO', address)
+    
+    def probe_finished(self, identifier):
+        probe = self.pending.pop(identifier)
+        if probe.timeout_call.active():
+            probe.timeout_call.cancel()
+        if not self.pending and not self.send_queue:
+            self.save(self.round_servers)
     
     def update(self):
         get_servers().addCallback(self.got_servers)
         reactor.callLater(UPDATE_INTERVAL, self.update)
     
     def datagramReceived(self, data, address):
-        if self.pyspades_set is None or data != 'HI':
+        if data != 'HI':
+            return
+        identifier = make_server_identifier(address[0], address[1])
+        probe = self.pending.get(identifier, None)
+        if probe is None:
             return
-        self.pyspades_set.add(make_server_identifier(address[0], address[1]))
+        probe.add_sample(reactor.seconds() - probe.sent)
+        self.pyspades_set.add(identifier)
+        self.probe_finished(identifier)
 
 class MainResource(Resource):
+    statistics = None
+    page = None
+    page_key = None
+    
     def __init__(self, root):
         self.query = QueryProtocol()
         reactor.listenUDP(0, self.query)
@@ -154,15 +243,30 @@ class MainResource(Resource):
         self.template = env.get_template(INPUT)
         Resource.__init__(self)
     
+    def get_page_key(self):
+        key = [self.query.version]
+        statistics = self.statistics
+        if statistics is not None:
+            key.append(statistics.store.revision)
+            key.extend(connection.name
+                for connection in statistics.connections)
+        return key
+    
     def render_GET(self, request):
+        key = self.get_page_key()
+        if key == self.page_key:
+            return self.page
         query = self.query
         data = str(self.template.render(
             protocol = query, 
             servers = query.servers,
             has_pyspades = query.saved_pyspades, 
+            latencies = query.latencies,
             make_server_identifier = make_server_identifier,
             statistics = self.statistics)
         )
+        self.page = data
+        self.page_key = key
         return data
         
 class CommonResource(Resource):
@@ -171,8 +275,15 @@ class CommonResource(Resource):
         Resource.__init__(self)
 
 class ListResource(CommonResource):
+    data = None
+    version = None
+    
     def render_GET(self, request):
-        return '\n'.join(self.main.query.pyspades_numbers)
+        query = self.main.query
+        if query.version != self.version:
+            self.data = '\n'.join(query.pyspades_numbers)
+            self.version = query.version
+        return self.data
 
 root = Resource()
 main = MainResource(root)
@@ -0,0 +1,229 @@
+# Copyright (c) Mathias Kaerlev 2011-2012.
+
+# This file is part of pyspades.
+
+# pyspades is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# pyspades is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with pyspades.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+SQLite storage for the site statistics.
+
+All users are kept in memory, so the totals can be updated as stats come
+in. Changes are written to the database by a writer thread, which commits
+everything that queued up since its last commit in a single transaction,
+and then reads the ranking by kills back from the database for the
+highscores, so the reactor never has to sort or reorder it.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+import os
+import json
+import sqlite3
+import threading
+import Queue
+
+DEFAULT_FILENAME = 'users.db'
+OLD_FILENAME = 'users.txt'
+
+STOP = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    kills INTEGER NOT NULL,
+    deaths INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_kills ON users (kills DESC);
+CREATE TABLE IF NOT EXISTS sessions (
+    server TEXT NOT NULL,
+    session TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    PRIMARY KEY (server, session)
+);
+"""
+
+# sequences kept only the last session of every server name, which servers
+# of a farm share
+MIGRATE_SEQUENCES = """
+INSERT OR IGNORE INTO sessions SELECT server, session, sequence
+    FROM sequences;
+DROP TABLE sequences;
+"""
+
+RANKING_QUERY = ('SELECT key, name, kills, deaths FROM users '
+    'ORDER BY kills DESC, key')
+
+def get_ranking(connection):
+    return [(key, {'name' : name, 'kills' : kills, 'deaths' : deaths})
+        for (key, name, kills, deaths) in connection.execute(RANKING_QUERY)]
+
+class StatStore(object):
+    thread = None
+    # changes whenever the highscores do
+    revision = 0
+
+    def __init__(self, filename = DEFAULT_FILENAME):
+        self.filename = filename
+        # key -> {'name', 'kills', 'deaths'}
+        self.users = {}
+        # (key, user) pairs with the most kills first, as last committed
+        self.ranking = []
+        # (server, session) -> last sequence
+        self.sequences = {}
+        self.queue = Queue.Queue()
+        self.load()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def load(self):
+        connection = sqlite3.connect(self.filename)
+        connection.executescript(SCHEMA)
+        if connection.execute("SELECT name FROM sqlite_master WHERE "
+                "type = 'table' AND name = 'sequences'").fetchone():
+            connection.executescript(MIGRATE_SEQUENCES)
+        for key, name, kills, deaths in connection.execute(
+                'SELECT key, name, kills, deaths FROM users'):
+            self.users[key] = {'name' : name, 'kills' : kills,
+                'deaths' : deaths}
+        for server, session, sequence in connection.execute(
+                'SELECT server, session, sequence FROM sessions'):
+            self.sequences[(server, session)] = sequence
+        if not self.users and os.path.isfile(OLD_FILENAME):
+            self.users = json.load(open(OLD_FILENAME, 'rb'))
+            print 'Importing %s users from %s' % (len(self.users),
+                OLD_FILENAME)
+            with connection:
+                connection.executemany('INSERT INTO users VALUES (?, ?, ?, ?)',
+                    [(key, user['name'], user['kills'], user['deaths'])
+                     for (key, user) in self.users.iteritems()])
+        self.ranking = get_ranking(connection)
+        connection.close()
+
+    def get_user(self, name):
+        key = name.lower()
+        user = self.users.get(key, None)
+        if user is None:
+            user = self.users[key] = {
+                'name' : name,
+                'kills' : 0,
+                'deaths' : 0
+            }
+        return key, user
+
+    def add_user_stats(self, name, kills, deaths):
+        key, user = self.get_user(name)
+        user['kills'] += kills
+        user['deaths'] += deaths
+        return (key, user['name'], user['kills'], user['deaths'])
+
+    def add_stats(self, server, session, sequence, users):
+        """
+        Adds a batch of stats from the given server, unless it was already
+        added. Returns a Deferred that fires once the batch is committed
+        """
+        deferred = Deferred()
+        # several servers can share a name, so batches are told apart by
+        # the session as well
+        key = (server, session)
+        if sequence <= self.sequences.get(key, 0):
+            # a batch sent again after a reconnect
+            self.queue.put(([], None, deferred))
+            return deferred
+        rows = [self.add_user_stats(name, kills, deaths)
+            for (name, (kills, deaths)) in users.iteritems()]
+        self.sequences[key] = sequence
+        self.queue.put((rows, (server, session, sequence), deferred))
+        return deferred
+
+    def add_single(self, name, kills, deaths):
+        self.queue.put(([self.add_user_stats(name, kills, deaths)], None,
+            None))
+
+    def get_highscores(self, count = None):
+        """
+        Returns (key, user) pairs with the most kills first, as of the last
+        commit
+        """
+        if count is None:
+            return self.ranking
+        return self.ranking[:count]
+
+    def set_ranking(self, ranking):
+        self.ranking = ranking
+        self.revision += 1
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(STOP)
+        self.thread.join()
+        self.thread = None
+
+    # writer thread
+
+    def run(self):
+        connection = sqlite3.connect(self.filename)
+        stopped = False
+        # later rows for the same user replace the earlier ones, and
+        # changes that fail to commit are retried with the next ones
+        rows = {}
+        sequences = {}
+        deferreds = []
+        while not stopped:
+            items = [self.queue.get()]
+            while 1:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if items[-1] is STOP:
+                items.pop()
+                stopped = True
+            for user_rows, sequence, deferred in items:
+                for row in user_rows:
+                    rows[row[0]] = row
+                if sequence is not None:
+                    sequences[sequence[:2]] = sequence
+                if deferred is not None:
+                    deferreds.append(deferred)
+            try:
+                with connection:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+                        rows.values())
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                        sequences.values())
+            except sqlite3.Error, e:
+                print 'Could not save statistics: %s' % e
+                continue
+            if rows:
+                self.update_ranking(connection)
+            for deferred in deferreds:
+                reactor.callFromThread(deferred.callback, None)
+            rows = {}
+            sequences = {}
+            deferreds = []
+        connection.close()
+
+    def update_ranking(self, connection):
+        try:
+            ranking = get_ranking(connection)
+        except sqlite3.Error, e:
+            print 'Could not read the ranking: %s' % e
+            return
+        reactor.callFromThread(self.set_ranking, ranking)